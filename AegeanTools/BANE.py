@@ -7,18 +7,19 @@ The function filter_image should be imported from elsewhere and run as is.
 
 # standard imports
 from astropy.io import fits
-import copy
 import logging
 import multiprocessing
 import numpy as np
 import os
-from scipy.interpolate import LinearNDInterpolator
+import shutil
 import sys
-from tempfile import NamedTemporaryFile
+from scipy.ndimage import maximum_filter
+from tempfile import mkdtemp
 from time import gmtime, strftime
 
 # Aegean tools
-from .fits_interp import compress
+from .fits_interp import compress_header
+from .executors import LocalExecutor
 
 __author__ = 'Paul Hancock'
 __version__ = 'v1.4.6'
@@ -75,6 +76,221 @@ def sigmaclip(arr, lo, hi, reps=3):
     return clipped
 
 
+def box_stats(data, xvals, yvals, box_size, lo=3, hi=3, reps=3, dobkg=True):
+    """
+    Compute the sigma clipped median and standard deviation within a box centered on each point of a grid.
+    The result is the same as applying :func:`sigmaclip` to each box in turn, but the boxes are processed
+    in batches.
+
+    Each box is [x - box_size/2, x + box_size/2), truncated to the interior of the data array.
+    As in :func:`sigma_filter`, the last row/column of the data are not included in any box.
+
+    Parameters
+    ----------
+    data : 2d-array
+        The image data.
+
+    xvals, yvals : [int, ...]
+        The grid locations along the first and second axes of `data`.
+
+    box_size : (int, int)
+        The size of the box.
+
+    lo, hi, reps : float, float, int
+        Clipping parameters, as for :func:`sigmaclip`.
+        Defaults are 3, 3, 3
+
+    dobkg : bool
+        If False then the median is not calculated. Default = True.
+
+    Returns
+    -------
+    bkg, rms : 2d-array
+        The median and std of the clipped data in each box, with shape (len(xvals), len(yvals)).
+        Boxes that contain no data after clipping are nan. `bkg` is None if `dobkg` is False.
+    """
+    xvals = np.asarray(xvals, dtype=int)
+    yvals = np.asarray(yvals, dtype=int)
+    # the lower edges of the boxes, before truncation
+    bx, by = box_size
+    xlo = xvals - bx // 2 - bx % 2
+    ylo = yvals - by // 2 - by % 2
+    ypad = by // 2 + by % 2
+
+    rms = np.full((len(xvals), len(yvals)), np.nan)
+    bkg = rms.copy() if dobkg else None
+
+    # A row of the data, padded with nans, so that every box is a full window of size box_size.
+    # The last row/column of the data are left as nan.
+    ncols = ypad + max(yvals.max() + by, data.shape[1])
+    band = np.empty((bx, ncols), dtype=np.result_type(data.dtype, np.float32).newbyteorder('='))
+    # process batches of boxes so that the working memory stays bounded
+    batch = max(1, 2 ** 20 // (bx * by))
+
+    for i in range(len(xvals)):
+        band[:] = np.nan
+        rmin = max(0, xlo[i])
+        rmax = min(data.shape[0] - 1, xlo[i] + bx)
+        if rmax > rmin:
+            band[rmin - xlo[i]:rmax - xlo[i], ypad:ypad + data.shape[1] - 1] = data[rmin:rmax, :data.shape[1] - 1]
+        # a view of every window of the band, of which we take one for each grid point
+        windows = np.lib.stride_tricks.as_strided(band, shape=(ncols - by + 1, bx, by),
+                                                  strides=(band.strides[1],) + band.strides)
+        for j in range(0, len(yvals), batch):
+            boxes = windows[ylo[j:j + batch] + ypad].reshape(-1, bx * by)
+            b, r = _clipped_stats(boxes, lo, hi, reps, dobkg)
+            rms[i, j:j + batch] = r
+            if dobkg:
+                bkg[i, j:j + batch] = b
+    return bkg, rms
+
+
+def _clipped_stats(boxes, lo, hi, reps, dobkg):
+    """
+    Sigma clip each row of an array, and return the median and std of the remaining data.
+    Equivalent to running :func:`sigmaclip` on each row.
+
+    Parameters
+    ----------
+    boxes : 2d-array
+        The data, one row per box. Non-finite values are ignored.
+        This array is modified.
+
+    lo, hi, reps : float, float, int
+        Clipping parameters, as for :func:`sigmaclip`.
+
+    dobkg : bool
+        If False then the median is not calculated.
+
+    Returns
+    -------
+    bkg, rms : 1d-array
+        The median and std of each row, or nan where no data remain.
+    """
+    keep = np.isfinite(boxes)
+    boxes[~keep] = 0
+
+    def moments():
+        n = keep.sum(axis=1)
+        mean = np.einsum('ij,ij->i', boxes, keep, dtype=np.float64) / n
+        resid = (boxes - mean[:, None]) * keep
+        std = np.sqrt(np.einsum('ij,ij->i', resid, resid, dtype=np.float64) / n)
+        return n, mean, std
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n, mean, std = moments()
+        active = n > 0
+        for _ in range(int(reps)):
+            if not np.any(active):
+                break
+            # only clip the rows that are still iterating
+            clip = (boxes > (mean - std * lo)[:, None]) & (boxes < (mean + std * hi)[:, None])
+            keep &= clip | ~active[:, None]
+            pstd = std
+            n, mean, std = moments()
+            # rows that have been clipped to nothing are finished, as are those which have converged
+            active &= (n > 0) & ~(2 * abs(pstd - std) / (pstd + std) < 0.2)
+
+    empty = n < 1
+    rms = np.where(empty, np.nan, std)
+    if not dobkg:
+        return None, rms
+
+    # Replace the clipped values with -inf/+inf so that the median of the remaining data is in the middle
+    # of each row, and can then be found for all rows at once with a partial sort.
+    width = boxes.shape[1]
+    mid = (width - 1) // 2
+    nlow = mid - (np.maximum(n, 1) - 1) // 2
+    excluded = ~keep
+    rank = np.cumsum(excluded, axis=1)
+    boxes[excluded & (rank <= nlow[:, None])] = -np.inf
+    boxes[excluded & (rank > nlow[:, None])] = np.inf
+    kth = [mid, min(mid + 1, width - 1)]
+    part = np.partition(boxes, kth, axis=1)
+    bkg = np.where(n % 2 == 1, part[:, kth[0]], 0.5 * (part[:, kth[0]] + part[:, kth[1]]))
+    bkg[empty] = np.nan
+    return bkg, rms
+
+
+def interpolate_grid(values, xvals, yvals, xpix, ypix, rows=256):
+    """
+    Generator function.
+    Bilinear interpolation of values on a regular grid onto a grid of pixels.
+    The interpolation is separable so the result is built a band of rows at a time, as 32 bit floats.
+
+    Grid points whose value is nan are ignored, and the remaining points are re-weighted.
+    Pixels that have no neighbouring grid points with finite values are nan.
+
+    Parameters
+    ----------
+    values : 2d-array
+        The values at the grid points, with shape (len(xvals), len(yvals)).
+
+    xvals, yvals : [int, ...]
+        The (increasing) locations of the grid points along each axis.
+        There must be at least two points along each axis.
+
+    xpix, ypix : [int, ...]
+        The locations of the pixels along each axis.
+        Pixels beyond the last grid point take the value at the edge of the grid.
+
+    rows : int
+        The number of rows in each band. Default = 256.
+
+    Yields
+    ------
+    start : int
+        The index within `xpix` of the first row in this band.
+
+    band : 2d-array
+        The interpolated values, with shape (rows, len(ypix)), or less for the last band.
+    """
+    mask = np.isfinite(values)
+    filled = np.where(mask, values, 0)
+
+    # interpolate along the second axis for each row of the grid
+    j, t = _grid_weights(yvals, ypix)
+    num = np.array(filled[:, j] * (1 - t) + filled[:, j + 1] * t, dtype=np.float32)
+    den = np.array(mask[:, j] * (1 - t) + mask[:, j + 1] * t, dtype=np.float32)
+    del filled, mask
+
+    # then along the first axis, for a band of rows at a time
+    i, t = _grid_weights(xvals, xpix)
+    t = np.array(t, dtype=np.float32)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for start in range(0, len(xpix), rows):
+            bi, bt = i[start:start + rows], t[start:start + rows]
+            band = num[bi] * (1 - bt) + num[bi + 1] * bt
+            band /= den[bi] * (1 - bt) + den[bi + 1] * bt
+            yield start, band
+
+
+def _grid_weights(grid, pix):
+    """
+    Find the grid interval that contains each pixel, and the fractional distance of the pixel along it.
+
+    Parameters
+    ----------
+    grid : [int, ...]
+        The increasing grid locations.
+
+    pix : [int, ...]
+        The pixel locations.
+
+    Returns
+    -------
+    idx : 1d-array
+        The index of the grid point below each pixel.
+
+    frac : 1d-array
+        The fractional distance between grid points idx and idx+1, clipped to [0, 1].
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    idx = np.clip(np.searchsorted(grid, pix, side='right') - 1, 0, len(grid) - 2)
+    frac = np.clip((pix - grid[idx]) / (grid[idx + 1] - grid[idx]), 0, 1)
+    return idx, frac
+
+
 def _sf2(args):
     """
     A shallow wrapper for sigma_filter.
@@ -91,10 +307,28 @@ def _sf2(args):
     return sigma_filter(*args)
 
 
-def sigma_filter(filename, region, step_size, box_size, shape, dobkg=True):
+def _ft2(args):
+    """
+    A shallow wrapper for filter_tile.
+
+    Parameters
+    ----------
+    args : list
+        A list of arguments for filter_tile
+
+    Returns
+    -------
+    results : list
+        All of the results from filter_tile.
+    """
+    return list(filter_tile(*args))
+
+
+def sigma_filter(filename, region, step_size, box_size, shape, dobkg=True, bkg_out=None, rms_out=None, mask=False,
+                 bkg_in=None, plane=0, factor=None, out_plane=None):
     """
     Calculate the background and rms for a sub region of an image. The results are
-    written to shared memory - irms and ibkg.
+    written directly into the output fits files.
 
     Parameters
     ----------
@@ -116,10 +350,107 @@ def sigma_filter(filename, region, step_size, box_size, shape, dobkg=True):
     dobkg : bool
         Do a background calculation. If false then only the rms is calculated. Default = True.
 
+    bkg_out, rms_out : (str, int)
+        The file name and data offset of the output files, as created by :func:`init_fits_output`.
+        The region of interest is written into each file. If None then the file is not written.
+
+    mask : bool
+        If True then the output is nan wherever the input image is nan. Default = False.
+
+    bkg_in : (str, int)
+        The file name and data offset of a background image (see :func:`init_fits_output`) that is
+        subtracted from the input image before filtering. Default = None.
+
+    plane : int
+        The plane of the input image to filter, and of the output images to write. Default = 0.
+
+    factor : int
+        If not None then the output images (and `bkg_in`) are compressed by this factor, as described by
+        :func:`AegeanTools.fits_interp.compress_header`, and only the pixels of the compressed images are
+        calculated. Default = None.
+
+    out_plane : int
+        The plane of the output images (and `bkg_in`), if it is not the same as `plane`. Default = None.
+
     Returns
     -------
     None
     """
+    outputs = {'bkg': bkg_out, 'rms': rms_out}
+    names = [name for name in ('bkg', 'rms') if outputs[name] is not None]
+    out_shape = compressed_shape(shape, factor)
+    # Each region is written by just one process, so the output files don't need to be locked.
+    images = {}
+    for name, row, col, band in filter_tile(filename, region, step_size, box_size, shape, dobkg=dobkg, mask=mask,
+                                            bkg_in=bkg_in, plane=plane, factor=factor, names=names,
+                                            out_plane=out_plane):
+        if name not in images:
+            images[name] = open_fits_output(outputs[name], out_shape, plane=plane if out_plane is None else out_plane)
+        images[name][row:row + band.shape[0], col:col + band.shape[1]] = band
+    for name in images:
+        images[name].flush()
+        logging.debug(" .. done writing {0}".format(name))
+    return
+
+
+def filter_tile(filename, region, step_size, box_size, shape, dobkg=True, mask=False, bkg_in=None, plane=0,
+                factor=None, names=('bkg', 'rms'), out_plane=None):
+    """
+    Generator function.
+    Calculate the background and rms for a sub region of an image, a band of rows at a time.
+
+    Parameters
+    ----------
+    filename : string
+        Fits file to open
+
+    region : (float, float, float, float)
+        Region within the fits file that is to be processed. (ymin, ymax, xmin, xmax).
+
+    step_size : (int, int)
+        The filtering step size
+
+    box_size : (int, int)
+        The size of the box over which the filter is applied (each step).
+
+    shape : tuple
+        The shape of the fits image
+
+    dobkg : bool
+        Do a background calculation. If false then only the rms is calculated. Default = True.
+
+    mask : bool
+        If True then the output is nan wherever the input image is nan. Default = False.
+
+    bkg_in : (str, int)
+        The file name and data offset of a background image (see :func:`init_fits_output`) that is
+        subtracted from the input image before filtering. Default = None.
+
+    plane : int
+        The plane of the input image to filter. Default = 0.
+
+    factor : int
+        If not None then the output images (and `bkg_in`) are compressed by this factor, as described by
+        :func:`AegeanTools.fits_interp.compress_header`, and only the pixels of the compressed images are
+        calculated. Default = None.
+
+    names : [str, ...]
+        The images to calculate, 'bkg' and/or 'rms'. Default = ('bkg', 'rms').
+
+    out_plane : int
+        The plane of `bkg_in`, if it is not the same as `plane`. Default = None.
+
+    Yields
+    ------
+    name : str
+        The image, 'bkg' or 'rms'.
+
+    row, col : int
+        The location of the band within the (compressed) output image.
+
+    band : 2d-array
+        The values for part of the region.
+    """
 
     # Caveat emptor: The code that follows is very difficult to read.
     # xmax is not x_max, and x,y actually should be y,x
@@ -129,25 +460,21 @@ def sigma_filter(filename, region, step_size, box_size, shape, dobkg=True):
     logging.debug('{0}x{1},{2}x{3} starting at {4}'.format(xmin, xmax, ymin, ymax,
                                                            strftime("%Y-%m-%d %H:%M:%S", gmtime())))
 
-    cmin = max(0, ymin - box_size[1]//2)
-    cmax = min(shape[1], ymax + box_size[1]//2)
-    rmin = max(0, xmin - box_size[0]//2)
-    rmax = min(shape[0], xmax + box_size[0]//2)
+    # Read enough data that the boxes of all the grid points are complete, so that the result does not
+    # depend on how the image is split into regions.
+    # (see box_stats: the boxes are [x - ceil(box/2), x + floor(box/2)) and exclude the last row of the data)
+    cmin = max(0, ymin - box_size[1]//2 - box_size[1] % 2)
+    cmax = min(shape[1], ymax + box_size[1]//2 + 1)
+    rmin = max(0, xmin - box_size[0]//2 - box_size[0] % 2)
+    rmax = min(shape[0], xmax + box_size[0]//2 + 1)
 
-    # Figure out how many axes are in the datafile
-    NAXIS = fits.getheader(filename)["NAXIS"]
     # It seems that I cannot memmap the same file multiple times without errors
     with fits.open(filename, memmap=False) as a:
-        if NAXIS == 2:
-            data = a[0].section[rmin:rmax, cmin:cmax]
-        elif NAXIS == 3:
-            data = a[0].section[0, rmin:rmax, cmin:cmax]
-        elif NAXIS == 4:
-            data = a[0].section[0, 0, rmin:rmax, cmin:cmax]
-        else:
-            logging.error("Too many NAXIS for me {0}".format(NAXIS))
-            logging.error("fix your file to be more sane")
-            sys.exit(1)
+        data = read_section(a[0], rmin, rmax, cmin, cmax, plane=plane)
+
+    if bkg_in is not None:
+        data = data - read_background(bkg_in, shape, rmin, rmax, cmin, cmax,
+                                      plane=plane if out_plane is None else out_plane, factor=factor)
 
     # x/y min/max should refer to indices into data
     # this is the region over which we want to operate
@@ -156,95 +483,39 @@ def sigma_filter(filename, region, step_size, box_size, shape, dobkg=True):
     xmin -= rmin
     xmax -= rmin
 
-    def locations(step_size, xmin, xmax, ymin, ymax):
-        """
-        Generator function to iterate over a grid of x,y coords
-        operates only within the given bounds
-        Returns:
-        x, y
-        """
-
-        xvals = list(range(xmin, xmax, step_size[0]))
-        if xvals[-1] != xmax:
-            xvals.append(xmax)
-        yvals = list(range(ymin, ymax, step_size[1]))
-        if yvals[-1] != ymax:
-            yvals.append(ymax)
-        # initial data
-        for y in yvals:
-            for x in xvals:
-                yield x, y
-
-    def box(x, y):
-        """
-        calculate the boundaries of the box centered at x,y
-        with size = box_size
-        """
-        x_min = int(max(0, x-box_size[0]/2))
-        x_max = int(min(data.shape[0]-1, x+box_size[0]/2))
-        y_min = int(max(0, y-box_size[1]/2))
-        y_max = int(min(data.shape[1]-1, y+box_size[1]/2))
-        return x_min, x_max, y_min, y_max
-
-    bkg_points = []
-    bkg_values = []
-    rms_points = []
-    rms_values = []
-
-    for x, y in locations(step_size, xmin, xmax, ymin, ymax):
-        x_min, x_max, y_min, y_max = box(x, y)
-        new = data[x_min:x_max, y_min:y_max]
-        new = np.ravel(new)
-        new = sigmaclip(new, 3, 3)
-        # If we are left with (or started with) no data, then just move on
-        if len(new) < 1:
-            continue
+    # the grid of locations at which the bkg/rms are calculated, covering the region of interest
+    xvals = list(range(xmin, xmax, step_size[0]))
+    if xvals[-1] != xmax:
+        xvals.append(xmax)
+    yvals = list(range(ymin, ymax, step_size[1]))
+    if yvals[-1] != ymax:
+        yvals.append(ymax)
 
-        if dobkg:
-            bkg = np.median(new)
-            bkg_points.append((x+rmin, y+cmin))  # these coords need to be indices into the larger array
-            bkg_values.append(bkg)
-        rms = np.std(new)
-        rms_points.append((x+rmin, y+cmin))
-        rms_values.append(rms)
+    bkg_grid, rms_grid = box_stats(data, xvals, yvals, box_size, dobkg=dobkg)
 
+    # the grid and the region of interest as indices into the larger array
+    xgrid = np.array(xvals) + rmin
+    ygrid = np.array(yvals) + cmin
     ymin, ymax, xmin, xmax = region
-    gx, gy = np.mgrid[xmin:xmax, ymin:ymax]
-    # If the bkg/rms calculation above didn't yield any points, then our interpolated values are all nans
-    if len(rms_points) > 1:
-        logging.debug("Interpolating rms")
-        ifunc = LinearNDInterpolator(rms_points, rms_values)
-        # force 32 bit floats
-        interpolated_rms = np.array(ifunc((gx, gy)), dtype=np.float32)
-        del ifunc
-    else:
-        interpolated_rms = np.empty((len(gx), len(gy)), dtype=np.float32)*np.nan
-    with irms.get_lock():
-        logging.debug("Writing rms to sharemem")
-        for i, row in enumerate(interpolated_rms):
-            start_idx = np.ravel_multi_index((xmin + i, ymin), shape)
-            end_idx = start_idx + len(row)
-            irms[start_idx:end_idx] = row
-    logging.debug(" .. done writing rms")
-
-    if dobkg:
-        if len(bkg_points)>1:
-            logging.debug("Interpolating bkg")
-            ifunc = LinearNDInterpolator(bkg_points, bkg_values)
-            interpolated_bkg = np.array(ifunc((gx, gy)), dtype=np.float32)
-            del ifunc
-        else:
-            interpolated_bkg = np.empty((len(gx), len(gy)), dtype=np.float32)*np.nan
-        with ibkg.get_lock():
-            logging.debug("Writing bkg to sharemem")
-            for i, row in enumerate(interpolated_bkg):
-                start_idx = np.ravel_multi_index((xmin + i, ymin), shape)
-                end_idx = start_idx + len(row)
-                ibkg[start_idx:end_idx] = row
-        logging.debug(" .. done writing bkg")
+    # the pixels that are to be calculated, and where they go in the output images
+    xpix, xout = sample_pixels(xmin, xmax, shape[0], factor)
+    ypix, yout = sample_pixels(ymin, ymax, shape[1], factor)
+
+    # the pixels within data that are to be masked
+    if mask:
+        blank = np.isnan(data[np.ix_(xpix - rmin, ypix - cmin)])
+
+    # Where the bkg/rms calculation above didn't yield any points, the interpolated values are nans
+    for grid, name in [(bkg_grid, 'bkg'), (rms_grid, 'rms')]:
+        if grid is None or name not in names:
+            continue
+        logging.debug("Interpolating {0}".format(name))
+        for start, band in interpolate_grid(grid, xgrid, ygrid, xpix, ypix):
+            if mask:
+                band[blank[start:start + band.shape[0]]] = np.nan
+            yield name, xout + start, yout, band
     logging.debug('{0}x{1},{2}x{3} finished at {4}'.format(xmin, xmax, ymin, ymax,
                                                            strftime("%Y-%m-%d %H:%M:%S", gmtime())))
-    return
 
 
 def gen_factors(m, permute=True):
@@ -308,6 +579,154 @@ def optimum_sections(cores, data_shape):
     return best
 
 
+def tile_edges(size, step, box, ntiles, max_width=None):
+    """
+    Choose the edges of the tiles along one axis of an image.
+    Tiles are multiples of the step size, and not smaller than the box size (so that the overlap
+    between neighbouring tiles is small).
+
+    Parameters
+    ----------
+    size : int
+        The length of the axis.
+
+    step : int
+        The grid step size.
+
+    box : int
+        The box size.
+
+    ntiles : int
+        The total number of tiles that the image should be split into.
+        The number of tiles along this axis will be about sqrt(ntiles).
+
+    max_width : int
+        The largest tile that is allowed, or None for no limit.
+        Tiles are never smaller than the box or step size, even if that is more than max_width.
+
+    Returns
+    -------
+    edges : [int, ...]
+        The tile edges, starting with 0 and ending with `size`.
+    """
+    width = int(np.ceil(size / np.sqrt(ntiles)))
+    # tiles are a multiple of the step size, and no smaller than the box
+    min_steps = int(np.ceil(max(box, step) / float(step)))
+    if max_width is None:
+        nsteps = int(np.ceil(width / float(step)))
+    else:
+        nsteps = min(width, max_width) // step
+        if max_width < min_steps * step:
+            logging.warning("Tiles should be at most {0} pixels, but must be at least {1} pixels".format(
+                max_width, min_steps * step))
+    width = max(nsteps, min_steps) * step
+    edges = list(range(0, size, width))
+    edges.append(size)
+    return edges
+
+
+def count_finite(filename, row_edges, col_edges, max_pix=None, plane=0):
+    """
+    Count the number of finite pixels within each tile of an image.
+    The image is read in bands of rows.
+
+    Parameters
+    ----------
+    filename : str
+        The fits image.
+
+    row_edges, col_edges : [int, ...]
+        The edges of the tiles along each axis.
+
+    max_pix : int
+        The maximum number of pixels to read at once. Default = None, which means read
+        one row of tiles at a time.
+
+    plane : int
+        The plane of the image to use. Default = 0.
+
+    Returns
+    -------
+    counts : 2d-array
+        The number of finite pixels in each tile, with shape (len(row_edges)-1, len(col_edges)-1).
+    """
+    counts = np.zeros((len(row_edges) - 1, len(col_edges) - 1), dtype=int)
+    with fits.open(filename, memmap=False) as a:
+        for i in range(len(row_edges) - 1):
+            rows = row_edges[i + 1] - row_edges[i]
+            if max_pix is not None:
+                rows = int(max(1, min(rows, max_pix // col_edges[-1])))
+            for r in range(row_edges[i], row_edges[i + 1], rows):
+                band = np.isfinite(read_section(a[0], r, min(r + rows, row_edges[i + 1]), 0, col_edges[-1],
+                                                  plane=plane))
+                # sum over rows, then within each range of columns
+                counts[i] += np.add.reduceat(band.sum(axis=0), col_edges[:-1])
+    return counts
+
+
+def mem_to_pixels(max_mem, cores):
+    """
+    Convert a memory limit into the largest tile (including the margins for the boxes) that each
+    core can work on.
+
+    Parameters
+    ----------
+    max_mem : float
+        The memory limit in GB, for all cores together.
+
+    cores : int
+        The number of cores.
+
+    Returns
+    -------
+    max_pix : int
+        The maximum number of pixels in a tile.
+    """
+    # Memory is shared between the worker processes and the main process.
+    budget = max_mem * 2 ** 30 / (cores + 1)
+    # Each worker keeps about 10 bytes for each pixel of its tile (data, background and mask), plus about 64MB
+    # of buffers for the box statistics and interpolation.
+    max_pix = int(max(budget - 64 * 2 ** 20, 0) / 10)
+    if max_pix < 1:
+        logging.warning("A memory limit of {0}GB is too small for {1} cores".format(max_mem, cores))
+        max_pix = 1
+    return max_pix
+
+
+def read_section(hdu, rmin, rmax, cmin, cmax, plane=0):
+    """
+    Read part of one plane of an image, without reading the entire image.
+
+    Parameters
+    ----------
+    hdu : astropy.io.fits.ImageHDU
+        The image.
+
+    rmin, rmax, cmin, cmax : int
+        The rows and columns to read.
+
+    plane : int
+        The plane to read. The planes of a 4d image are numbered with NAXIS3 varying fastest.
+        Default = 0.
+
+    Returns
+    -------
+    data : 2d-array
+        The image data.
+    """
+    naxis = hdu.header["NAXIS"]
+    if naxis == 2:
+        return hdu.section[rmin:rmax, cmin:cmax]
+    elif naxis == 3:
+        return hdu.section[plane, rmin:rmax, cmin:cmax]
+    elif naxis == 4:
+        naxis3 = hdu.header["NAXIS3"]
+        return hdu.section[plane // naxis3, plane % naxis3, rmin:rmax, cmin:cmax]
+    logging.error("Too many NAXIS for me {0}".format(naxis))
+    logging.error("fix your file to be more sane")
+    sys.exit(1)
+
+
 def mask_img(data, mask_data):
     """
     Take two images of the same shape, and transfer the mask from one to the other.
@@ -336,10 +755,13 @@ def mask_img(data, mask_data):
         logging.info("failed to mask file, not a critical failure")
 
 
-def filter_mc_sharemem(filename, step_size, box_size, cores, shape, dobkg=True):
+def filter_mc_sharemem(filename, step_size, box_size, cores, shape, dobkg=True, bkg_out=None, rms_out=None,
+                       mask=False, bkg_in=None, max_mem=None, planes=None, factor=None, executor=None,
+                       out_planes=None):
     """
     Calculate the background and noise images corresponding to the input file.
-    The calculation is done via a box-car approach and uses multiple cores and shared memory.
+    The calculation is done via a box-car approach and uses multiple cores.
+    Each core writes its part of the image directly into the (memory mapped) output files.
 
     Parameters
     ----------
@@ -354,6 +776,7 @@ def filter_mc_sharemem(filename, step_size, box_size, cores, shape, dobkg=True):
 
     cores : int
         Number of cores to use. If None then use all available.
+        When an executor is given this is the number of workers that the tiles should be shared between.
 
     shape : (int, int)
         The shape of the image in the given file.
@@ -361,85 +784,129 @@ def filter_mc_sharemem(filename, step_size, box_size, cores, shape, dobkg=True):
     dobkg : bool
         If True then calculate the background, otherwise assume it is zero.
 
+    bkg_out, rms_out : (str, int)
+        The file name and data offset of the output files, as created by :func:`init_fits_output`.
+        If None then the corresponding image is not written.
+
+    mask : bool
+        If True then the output images are nan wherever the input image is nan. Default = False.
+
+    bkg_in : (str, int)
+        The file name and data offset of a background image that is subtracted from the input image.
+        Default = None.
+
+    max_mem : float
+        The approximate amount of memory (GB) to use, shared between all cores. Default = None (no limit).
+
+    planes : [int, ...]
+        The planes of the input image to filter. Each plane is written to the same plane of the output images.
+        All planes share one pool of workers. Default = None, which means only the first plane.
+
+    factor : int
+        If not None then the output images (and `bkg_in`) are compressed by this factor. Default = None.
+
+    executor : :class:`AegeanTools.executors.LocalExecutor` or :class:`AegeanTools.executors.FileQueueExecutor`
+        The executor that runs the tiles. Default = None, which means use a LocalExecutor with the given cores.
+        Executors that are not local return the results for each tile to this process, which writes them.
+
+    out_planes : [int, ...]
+        The planes of the output images (and `bkg_in`) that each of the `planes` is written to.
+        Default = None, which means the same as `planes`.
+
     Returns
     -------
-    bkg, rms : numpy.ndarray
-        The interpolated background and noise images.
+    None
     """
 
     if cores is None:
         cores = multiprocessing.cpu_count()
 
-    img_y, img_x = shape
-    # initialise some shared memory
-    alen = shape[0]*shape[1]
-    if dobkg:
-        global ibkg
-        ibkg = multiprocessing.Array('f', alen)
+    if executor is None or executor.local:
+        logging.info("using {0} cores".format(cores))
+    else:
+        logging.info("sharing the work between {0} workers".format(cores))
+    # Split the image into many small tiles that are aligned with the grid, so that the work can be shared
+    # evenly between the cores regardless of the shape of the image or where it is masked.
+    if cores > 1:
+        ntiles = 8 * cores
     else:
-        ibkg = None
-    global irms
-    irms = multiprocessing.Array('f', alen)
-
-    logging.info("using {0} cores".format(cores))
-    nx, ny = optimum_sections(cores, shape)
-
-    # box widths should be multiples of the step_size, and not zero
-    width_x = int(max(img_x/nx/step_size[0], 1) * step_size[0])
-    width_y = int(max(img_y/ny/step_size[1], 1) * step_size[1])
-
-    xstart = width_x
-    ystart = width_y
-    xend = img_x - img_x % width_x  # the end point of the last "full" box
-    yend = img_y - img_y % width_y
-
-    # locations of the box edges
-    xmins = [0]
-    xmins.extend(list(range(xstart, xend, width_x)))
-
-    xmaxs = [xstart]
-    xmaxs.extend(list(range(xstart+width_x, xend+1, width_x)))
-    xmaxs[-1] = img_x
-
-    ymins = [0]
-    ymins.extend(list(range(ystart, yend, width_y)))
-
-    ymaxs = [ystart]
-    ymaxs.extend(list(range(ystart+width_y, yend+1, width_y)))
-    ymaxs[-1] = img_y
-
-    args = []
-    for xmin, xmax in zip(xmins, xmaxs):
-        for ymin, ymax in zip(ymins, ymaxs):
-            region = [xmin, xmax, ymin, ymax]
-            args.append((filename, region, step_size, box_size, shape, dobkg))
-
-    pool = multiprocessing.Pool(processes=cores)
-    pool.map(_sf2, args)
-    pool.close()
-    pool.join()
-
-    # reshape our 1d arrays back into a 2d image
-    if dobkg:
-        logging.debug("reshaping bkg")
-        interpolated_bkg = np.reshape(np.array(ibkg[:], dtype=np.float32), shape)
-        logging.debug(" bkg is {0}".format(interpolated_bkg.dtype))
-        logging.debug(" ... done at {0}".format(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
+        ntiles = 1
+    if max_mem is not None:
+        max_pix = mem_to_pixels(max_mem, cores)
+        max_width = [int(np.sqrt(max_pix)) - box_size[i] for i in (0, 1)]
+        logging.debug("Memory limit of {0}GB gives tiles of up to {1} pixels".format(max_mem, max_width))
     else:
-        interpolated_bkg = None
-    del ibkg
-    logging.debug("reshaping rms")
-    interpolated_rms = np.reshape(np.array(irms[:], dtype=np.float32), shape)
+        max_pix = None
+        max_width = [None, None]
+    row_edges, col_edges = [tile_edges(shape[i], step_size[i], box_size[i], ntiles, max_width[i]) for i in (0, 1)]
+    logging.debug("Using {0}x{1} tiles".format(len(row_edges) - 1, len(col_edges) - 1))
+
+    if planes is None:
+        planes = [0]
+    if out_planes is None:
+        out_planes = planes
+
+    # Tiles which (with their neighbours) contain no data will have no bkg/rms so are skipped.
+    # The rest are sorted so that the most expensive tiles are done first, regardless of which plane they are in.
+    tasks = []
+    nskipped = 0
+    for plane, out_plane in zip(planes, out_planes):
+        counts = count_finite(filename, row_edges, col_edges, max_pix=max_pix, plane=plane)
+        needed = maximum_filter(counts > 0, size=3, mode='constant')
+        skipped = []
+        for i, j in np.ndindex(counts.shape):
+            xmin, xmax = row_edges[i], row_edges[i + 1]
+            ymin, ymax = col_edges[j], col_edges[j + 1]
+            if not needed[i, j]:
+                skipped.append((xmin, xmax, ymin, ymax))
+                continue
+            tasks.append((-counts[i, j], plane, out_plane, [ymin, ymax, xmin, xmax]))
+        nskipped += len(skipped)
+
+        for out in [bkg_out if dobkg else None, rms_out]:
+            if out is None or not skipped:
+                continue
+            out_img = open_fits_output(out, compressed_shape(shape, factor), plane=out_plane)
+            for xmin, xmax, ymin, ymax in skipped:
+                xpix, xout = sample_pixels(xmin, xmax, shape[0], factor)
+                ypix, yout = sample_pixels(ymin, ymax, shape[1], factor)
+                out_img[xout:xout + len(xpix), yout:yout + len(ypix)] = np.nan
+            out_img.flush()
+            del out_img
+    logging.debug("Skipping {0} tiles with no data".format(nskipped))
+    # a stable sort, so tiles of equal cost are done in order
+    tasks = [t[1:] for t in sorted(tasks, key=lambda t: t[0])]
+
+    if executor is None:
+        executor = LocalExecutor(cores)
+    if executor.local:
+        args = [(filename, region, step_size, box_size, shape, dobkg, bkg_out, rms_out, mask, bkg_in, plane, factor,
+                 out_plane) for plane, out_plane, region in tasks]
+        for _ in executor.map(_sf2, args, ordered=False):
+            pass
+    else:
+        # The workers may not be able to share the output files, so their results are written here.
+        # Each tile covers a different part of the output, so the result doesn't depend on which worker did what.
+        outputs = {'bkg': bkg_out if dobkg else None, 'rms': rms_out}
+        names = [name for name in ('bkg', 'rms') if outputs[name] is not None]
+        args = [(filename, region, step_size, box_size, shape, dobkg, mask, bkg_in, plane, factor, names, out_plane)
+                for plane, out_plane, region in tasks]
+        out_shape = compressed_shape(shape, factor)
+        for (_, out_plane, _), results in zip(tasks, executor.map(_ft2, args)):
+            for name, row, col, band in results:
+                out_img = open_fits_output(outputs[name], out_shape, plane=out_plane)
+                out_img[row:row + band.shape[0], col:col + band.shape[1]] = band
+                out_img.flush()
+                del out_img
     logging.debug(" ... done at {0}".format(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
-    del irms
-
-    return interpolated_bkg, interpolated_rms
+    return
 
 
-def filter_image(im_name, out_base, step_size=None, box_size=None, twopass=False, cores=None, mask=True, compressed=False):
+def filter_image(im_name, out_base, step_size=None, box_size=None, twopass=False, cores=None, mask=True, compressed=False,
+                 max_mem=None, cube=False, executor=None, plane=None):
     """
     Create a background and noise image from an input image.
-    Resulting images are written to `outbase_bkg.fits` and `outbase_rms.fits`
+    Resulting images are written to `outbase_bkg.fits` and `outbase_rms.fits`, and returned.
 
     Parameters
     ----------
@@ -447,6 +914,7 @@ def filter_image(im_name, out_base, step_size=None, box_size=None, twopass=False
         Image to filter. Either a string filename or an astropy.io.fits.HDUList.
     out_base : str
         The output filename base. Will be modified to make _bkg and _rms files.
+        If None then no files are written, and the images are only returned.
     step_size : (int,int)
         Tuple of the x,y step size in pixels
     box_size : (int,int)
@@ -463,15 +931,43 @@ def filter_image(im_name, out_base, step_size=None, box_size=None, twopass=False
     compressed : bool
         Return a compressed version of the background/noise images.
         Default = False
+    max_mem : float
+        The approximate amount of memory (GB) that BANE may use, shared between all cores.
+        The image is processed in tiles that are small enough to stay within this limit.
+        Default = None, which means no limit.
+    cube : bool
+        Filter every plane of an image cube, and write cube shaped background/noise images.
+        Default = False, which means only the first plane is filtered.
+    executor : :class:`AegeanTools.executors.LocalExecutor` or :class:`AegeanTools.executors.FileQueueExecutor`
+        The executor that runs the work. The input image (and the output files) must be readable by all of the
+        workers. Default = None, which means use the given number of cores on this host.
+    plane : int
+        Filter only this plane of an image cube, and write 2d background/noise images.
+        Default = None, which means the first plane (or every plane if `cube` is True).
 
     Returns
     -------
-    None
+    bkg, rms : numpy.ndarray
+        The background and noise images (compressed if `compressed` is True).
+        If the images were written to files then these are read-only memory maps of the files.
 
     """
 
     header = fits.getheader(im_name)
     shape = (header['NAXIS2'],header['NAXIS1'])
+    if cube:
+        # the output images have the same shape as the input, which is treated as a stack of planes
+        out_shape = tuple(header['NAXIS{0}'.format(i)] for i in range(header['NAXIS'], 0, -1))
+        planes = list(range(int(np.prod(out_shape[:-2]))))
+        if compressed:
+            logging.warning("Cannot compress the output for a cube, writing the full size images")
+            compressed = False
+    else:
+        out_shape = shape
+        planes = None if plane is None else [plane]
+    if out_base is None and compressed:
+        logging.warning("Compression is only done for output files, returning the full size images")
+        compressed = False
 
     if step_size is None:
         if 'BMAJ' in header and 'BMIN' in header:
@@ -506,53 +1002,55 @@ def filter_image(im_name, out_base, step_size=None, box_size=None, twopass=False
 
     logging.info("using grid_size {0}, box_size {1}".format(step_size,box_size))
     logging.info("on data shape {0}".format(shape))
-    bkg, rms = filter_mc_sharemem(im_name, step_size=step_size, box_size=box_size, cores=cores, shape=shape)
-    logging.info("done")
+    if cube:
+        logging.info("for {0} planes".format(len(planes)))
+    elif plane is not None:
+        logging.info("for plane {0}".format(plane))
+    if out_base is None:
+        # the subprocesses still need somewhere to write their results
+        temp_dir = mkdtemp() if executor is None else executor.scratch_dir(prefix='bane_')
+        bkg_out, rms_out = os.path.join(temp_dir, 'bkg.fits'), os.path.join(temp_dir, 'rms.fits')
+    else:
+        bkg_out = '_'.join([os.path.expanduser(out_base), 'bkg.fits'])
+        rms_out = '_'.join([os.path.expanduser(out_base), 'rms.fits'])
 
-    # force float 32s to avoid bloated files
-    bkg = np.array(bkg, dtype=np.float32)
-    rms = np.array(rms, dtype=np.float32)
+    header['HISTORY'] = 'BANE {0}-({1})'.format(__version__, __date__)
+    factor = None
+    if compressed:
+        # only the pixels of the compressed images are calculated, and they are written directly
+        compressed_header = compress_header(header.copy(), step_size[0])
+        if compressed_header is None:
+            logging.warning("Cannot compress the output, writing the full size images")
+        else:
+            header = compressed_header
+            factor = step_size[0]
+            out_shape = compressed_shape(shape, factor)
+            mask = False
+    # the output files are filled in place by the subprocesses
+    bkg_file = (bkg_out, init_fits_output(bkg_out, header, out_shape))
+    rms_file = (rms_out, init_fits_output(rms_out, header, out_shape))
+
+    filter_mc_sharemem(im_name, step_size=step_size, box_size=box_size, cores=cores, shape=shape,
+                       bkg_out=bkg_file, rms_out=rms_file, mask=mask, max_mem=max_mem, planes=planes, factor=factor,
+                       executor=executor, out_planes=None if cube else [0])
+    logging.info("done")
 
     if twopass:
-        # TODO: check what this does for our memory usage
-        # Answer: The interpolation step peaks at about 5x the normal value.
-        tempfile = NamedTemporaryFile(delete=False)
-        data = fits.getdata(im_name) - bkg
-        header = fits.getheader(im_name)
-        # write 32bit floats to reduce memory overhead
-        write_fits(np.array(data, dtype=np.float32), header, tempfile)
-        tempfile.close()
-        temp_name = tempfile.name
-        del data, header, tempfile, rms
+        # the subprocesses subtract the background from their part of the image as they read it
         logging.info("running second pass to get a better rms")
-        junk, rms = filter_mc_sharemem(temp_name, step_size=step_size, box_size=box_size, cores=cores, shape=shape, dobkg=False)
-        del junk
-        rms = np.array(rms, dtype=np.float32)
-        os.remove(temp_name)
+        filter_mc_sharemem(im_name, step_size=step_size, box_size=box_size, cores=cores, shape=shape, dobkg=False,
+                           rms_out=rms_file, mask=mask, bkg_in=bkg_file, max_mem=max_mem, planes=planes,
+                           factor=factor, executor=executor, out_planes=None if cube else [0])
 
-    bkg_out = '_'.join([os.path.expanduser(out_base), 'bkg.fits'])
-    rms_out = '_'.join([os.path.expanduser(out_base), 'rms.fits'])
+    if out_base is None:
+        bkg, rms = [np.array(open_fits_output(out, out_shape, mode='r'), dtype=np.float32)
+                    for out in (bkg_file, rms_file)]
+        shutil.rmtree(temp_dir)
+        return bkg, rms
 
-
-    # load the file since we are now going to fiddle with it
-    header = fits.getheader(im_name)
-    header['HISTORY'] = 'BANE {0}-({1})'.format(__version__, __date__)
-    if compressed:
-        hdu = fits.PrimaryHDU(bkg)
-        hdu.header = copy.deepcopy(header)
-        hdulist = fits.HDUList([hdu])
-        compress(hdulist, step_size[0], bkg_out)
-        hdulist[0].header = copy.deepcopy(header)
-        hdulist[0].data = rms
-        compress(hdulist, step_size[0], rms_out)
-        return
-    if mask:
-        ref = fits.getdata(im_name)
-        mask_img(bkg, ref)
-        mask_img(rms, ref)
-        del ref
-    write_fits(bkg, header, bkg_out)
-    write_fits(rms, header, rms_out)
+    logging.info("Wrote {0}".format(bkg_out))
+    logging.info("Wrote {0}".format(rms_out))
+    return open_fits_output(bkg_file, out_shape, mode='r'), open_fits_output(rms_file, out_shape, mode='r')
 
 
 ###
@@ -583,3 +1081,175 @@ def write_fits(data, header, file_name):
     hdulist.writeto(file_name, clobber=True)
     logging.info("Wrote {0}".format(file_name))
     return
+
+
+def init_fits_output(file_name, header, shape):
+    """
+    Create a fits file that contains an image of 32 bit floats, so that the data can then be filled in
+    via a memory map. The data are not initialised.
+
+    Parameters
+    ----------
+    file_name : str
+        The file to create. An existing file will be overwritten.
+
+    header : astropy.io.fits.Header
+        The header for the fits file. The BITPIX and NAXIS keywords are updated to describe the image,
+        and BSCALE/BZERO are removed.
+
+    shape : (int, ..., int)
+        The shape of the image. Images with more than two dimensions are written as a stack of 2d planes.
+
+    Returns
+    -------
+    offset : int
+        The offset of the image data within the file, in bytes.
+
+    See Also
+    --------
+    :func:`AegeanTools.BANE.open_fits_output`
+    """
+    header = header.copy()
+    header['BITPIX'] = -32
+    header['NAXIS'] = len(shape)
+    for i, n in enumerate(reversed(shape)):
+        header['NAXIS{0}'.format(i + 1)] = n
+    for key in ['NAXIS{0}'.format(i) for i in range(len(shape) + 1, 5)] + ['BSCALE', 'BZERO']:
+        if key in header:
+            del header[key]
+    header_bytes = header.tostring().encode('ascii')
+    offset = len(header_bytes)
+    # fits files are made of 2880 byte blocks
+    size = offset + 4 * int(np.prod(shape))
+    size += -size % 2880
+    with open(file_name, 'wb') as f:
+        f.write(header_bytes)
+        f.truncate(size)
+    return offset
+
+
+def open_fits_output(output, shape, mode='r+', plane=0):
+    """
+    Memory map the image data of a fits file that was created by :func:`init_fits_output`.
+
+    Parameters
+    ----------
+    output : (str, int)
+        The file name and the offset of the image data.
+
+    shape : (int, int)
+        The shape of one plane of the image.
+
+    mode : str
+        The mode with which to open the file. Default = 'r+'.
+
+    plane : int
+        The plane to map. Default = 0.
+
+    Returns
+    -------
+    data : numpy.memmap
+        The image data.
+    """
+    file_name, offset = output
+    offset += 4 * plane * shape[0] * shape[1]
+    return np.memmap(file_name, dtype='>f4', mode=mode, offset=offset, shape=tuple(shape))
+
+
+def compressed_shape(shape, factor):
+    """
+    The shape of an image after compression, as described by :func:`AegeanTools.fits_interp.compress_header`.
+
+    Parameters
+    ----------
+    shape : (int, int)
+        The shape of the original image.
+
+    factor : int
+        The compression factor, or None for no compression.
+
+    Returns
+    -------
+    shape : (int, int)
+        The shape of the compressed image.
+    """
+    if factor is None:
+        return tuple(shape)
+    return tuple(-(-n // factor) + 1 for n in shape)
+
+
+def sample_pixels(start, stop, size, factor):
+    """
+    Find the pixels along one axis of an image that are kept when the image is compressed, as described by
+    :func:`AegeanTools.fits_interp.compress_header`.
+
+    Parameters
+    ----------
+    start, stop : int
+        The range of pixels [start, stop) to consider.
+
+    size : int
+        The length of the axis.
+
+    factor : int
+        The compression factor, or None for no compression (all pixels are kept).
+
+    Returns
+    -------
+    pix : 1d-array
+        The pixels within [start, stop) that are kept.
+
+    first : int
+        The location of pix[0] within the compressed axis. The rest follow consecutively.
+    """
+    if factor is None:
+        return np.arange(start, stop), start
+    first = -(-start // factor)
+    pix = list(range(first * factor, stop, factor))
+    # the last pixel is always kept
+    if start <= size - 1 < stop:
+        pix.append(size - 1)
+    return np.array(pix, dtype=int), first
+
+
+def read_background(bkg_in, shape, rmin, rmax, cmin, cmax, plane=0, factor=None):
+    """
+    Read part of one plane of a background image that was created by :func:`init_fits_output`.
+    A compressed background image is expanded using bilinear interpolation.
+
+    Parameters
+    ----------
+    bkg_in : (str, int)
+        The file name and the offset of the image data.
+
+    shape : (int, int)
+        The shape of one plane of the (uncompressed) image.
+
+    rmin, rmax, cmin, cmax : int
+        The rows and columns to read.
+
+    plane : int
+        The plane to read. Default = 0.
+
+    factor : int
+        The compression factor of the background image, or None if it is not compressed. Default = None.
+
+    Returns
+    -------
+    data : 2d-array
+        The background.
+    """
+    if factor is None:
+        return open_fits_output(bkg_in, shape, mode='r', plane=plane)[rmin:rmax, cmin:cmax]
+    grid = np.array(open_fits_output(bkg_in, compressed_shape(shape, factor), mode='r', plane=plane))
+    xgrid = sample_pixels(0, shape[0], shape[0], factor)[0]
+    ygrid = sample_pixels(0, shape[1], shape[1], factor)[0]
+    # the last pixel may also have been one of the decimated pixels
+    if xgrid[-1] == xgrid[-2]:
+        xgrid, grid = xgrid[:-1], grid[:-1]
+    if ygrid[-1] == ygrid[-2]:
+        ygrid, grid = ygrid[:-1], grid[:, :-1]
+    data = np.empty((rmax - rmin, cmax - cmin), dtype=np.float32)
+    for start, band in interpolate_grid(grid, xgrid, ygrid, np.arange(rmin, rmax), np.arange(cmin, cmax)):
+        data[start:start + band.shape[0]] = band
+    return data
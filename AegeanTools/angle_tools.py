@@ -125,13 +125,13 @@ def gcd(ra1, dec1, ra2, dec2):
 
     Parameters
     ----------
-    ra1, dec1, ra2, dec2 : float
+    ra1, dec1, ra2, dec2 : float or array-like
         The coordinates of the two points of interest.
-        Units are in degrees.
+        Units are in degrees. Arrays are broadcast against each other.
 
     Returns
     -------
-    dist : float
+    dist : float or array-like
         The distance between the two points in degrees.
 
     Notes
@@ -145,7 +145,7 @@ def gcd(ra1, dec1, ra2, dec2):
     dlat = dec2 - dec1
     a = np.sin(np.radians(dlat) / 2) ** 2
     a += np.cos(np.radians(dec1)) * np.cos(np.radians(dec2)) * np.sin(np.radians(dlon) / 2) ** 2
-    sep = np.degrees(2 * np.arcsin(min(1, np.sqrt(a))))
+    sep = np.degrees(2 * np.arcsin(np.minimum(1, np.sqrt(a))))
     return sep
 
 
@@ -156,12 +156,12 @@ def bear(ra1, dec1, ra2, dec2):
 
     Parameters
     ----------
-    ra1, dec1, ra2, dec2 : float
-        The sky coordinates (degrees) of the two points.
+    ra1, dec1, ra2, dec2 : float or array-like
+        The sky coordinates (degrees) of the two points. Arrays are broadcast against each other.
 
     Returns
     -------
-    bear : float
+    bear : float or array-like
         The bearing of point 2 from point 1 (degrees).
     """
     rdec1 = np.radians(dec1)
@@ -180,14 +180,15 @@ def translate(ra, dec, r, theta):
 
     Parameters
     ----------
-    ra, dec : float
+    ra, dec : float or array-like
         The initial point of interest (degrees).
-    r, theta : float
+    r, theta : float or array-like
         The distance and initial direction to translate (degrees).
+        Arrays are broadcast against each other.
 
     Returns
     -------
-    ra, dec : float
+    ra, dec : float or array-like
         The translated position (degrees).
     """
     factor = np.sin(np.radians(dec)) * np.cos(np.radians(r))
@@ -207,12 +208,12 @@ def dist_rhumb(ra1, dec1, ra2, dec2):
 
     Parameters
     ----------
-    ra1, dec1, ra2, dec2 : float
-        The position of the two points (degrees).
+    ra1, dec1, ra2, dec2 : float or array-like
+        The position of the two points (degrees). Arrays are broadcast against each other.
 
     Returns
     -------
-    dist : float
+    dist : float or array-like
         The distance between the two points along a line of constant bearing.
 
     Notes
@@ -226,13 +227,11 @@ def dist_rhumb(ra1, dec1, ra2, dec2):
     lambda1 = np.radians(ra1)
     lambda2 = np.radians(ra2)
     dpsi = np.log(np.tan(np.pi / 4 + phi2 / 2) / np.tan(np.pi / 4 + phi1 / 2))
-    if dpsi < 1e-12:
-        q = np.cos(phi1)
-    else:
-        q = dpsi / dphi
+    # dpsi/dphi is not used where dphi is zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(dpsi < 1e-12, np.cos(phi1), dpsi / dphi)
     dlambda = lambda2 - lambda1
-    if dlambda > np.pi:
-        dlambda -= 2 * np.pi
+    dlambda = np.where(dlambda > np.pi, dlambda - 2 * np.pi, dlambda)
     dist = np.hypot(dphi, q * dlambda)
     return np.degrees(dist)
 
@@ -244,12 +243,12 @@ def bear_rhumb(ra1, dec1, ra2, dec2):
 
     Parameters
     ----------
-    ra1, dec1, ra2, dec2 : float
-        The sky coordinates (degrees) of the two points.
+    ra1, dec1, ra2, dec2 : float or array-like
+        The sky coordinates (degrees) of the two points. Arrays are broadcast against each other.
 
     Returns
     -------
-    dist : float
+    dist : float or array-like
         The bearing of point 2 from point 1 along a Rhumb line (degrees).
     """
     # verified against website to give correct results
@@ -271,14 +270,15 @@ def translate_rhumb(ra, dec, r, theta):
 
     Parameters
     ----------
-    ra, dec : float
+    ra, dec : float or array-like
         The initial point of interest (degrees).
-    r, theta : float
+    r, theta : float or array-like
         The distance and initial direction to translate (degrees).
+        Arrays are broadcast against each other.
 
     Returns
     -------
-    ra, dec : float
+    ra, dec : float or array-like
         The translated position (degrees).
     """
     # verified against website to give correct results
@@ -288,11 +288,10 @@ def translate_rhumb(ra, dec, r, theta):
     phi2 = phi1 + delta * np.cos(np.radians(theta))
     dphi = phi2 - phi1
 
-    if abs(dphi) < 1e-9:
-        q = np.cos(phi1)
-    else:
+    # dphi/dpsi is not used where dpsi is zero
+    with np.errstate(divide='ignore', invalid='ignore'):
         dpsi = np.log(np.tan(np.pi / 4 + phi2 / 2) / np.tan(np.pi / 4 + phi1 / 2))
-        q = dphi / dpsi
+        q = np.where(abs(dphi) < 1e-9, np.cos(phi1), dphi / dpsi)
 
     lambda1 = np.radians(ra)
     dlambda = delta * np.sin(np.radians(theta)) / q
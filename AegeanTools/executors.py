@@ -0,0 +1,414 @@
+#! /usr/bin/env python
+"""
+Executors that run the independent parts of a BANE or Aegean job (tiles or groups of islands).
+
+:class:`LocalExecutor` uses a pool of processes on this host.
+:class:`FileQueueExecutor` uses a work queue within a directory that is shared between hosts, and
+:func:`run_worker` takes tasks from that queue.
+"""
+from __future__ import print_function
+
+__author__ = 'Paul Hancock'
+
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import time
+import traceback
+
+try:
+    import cPickle
+except ImportError:
+    import _pickle as cPickle
+
+log = logging.getLogger('Aegean')
+
+# the job that this process was last initialised for, and the function that it runs
+_current_job = (None, None)
+
+
+class LocalExecutor(object):
+    """
+    Run tasks using a pool of processes on this host.
+
+    Attributes
+    ----------
+    cores : int
+        The number of processes to use. If cores is 1 then the tasks are run within this process.
+
+    local : bool
+        True, since the workers share memory maps and files with this process.
+    """
+    local = True
+
+    def __init__(self, cores=None):
+        """
+        Parameters
+        ----------
+        cores : int
+            The number of processes to use. Default = None, which means use all available cores.
+        """
+        if cores is None:
+            cores = multiprocessing.cpu_count()
+        self.cores = cores
+
+    def scratch_dir(self, prefix='tmp'):
+        """
+        Create a directory for files that the workers need to read.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix for the directory name.
+
+        Returns
+        -------
+        dirname : str
+            The directory. The caller is responsible for removing it.
+        """
+        return tempfile.mkdtemp(prefix=prefix)
+
+    def map(self, func, iterable, initializer=None, initargs=(), ordered=True):
+        """
+        Generator function.
+        Run a function on each item of an iterable.
+
+        Parameters
+        ----------
+        func : function
+            A function that takes one argument. It must be defined at the top level of a module.
+
+        iterable : iterable
+            The arguments for each call of `func`. The iterable is consumed lazily, so it may be a generator.
+
+        initializer : function
+            A function that is called by each worker before it runs any tasks. Default = None.
+
+        initargs : tuple
+            The arguments for `initializer`.
+
+        ordered : bool
+            If True (default) then the results are in the same order as the iterable.
+            Otherwise they are yielded as soon as they are ready.
+
+        Yields
+        ------
+        result : object
+            The return value of each call of `func`.
+        """
+        if self.cores == 1:
+            if initializer is not None:
+                initializer(*initargs)
+            for item in iterable:
+                yield func(item)
+            return
+
+        pool = multiprocessing.Pool(processes=self.cores, initializer=initializer, initargs=initargs)
+        try:
+            if ordered:
+                results = pool.imap(func, iterable)
+            else:
+                results = pool.imap_unordered(func, iterable)
+            for result in results:
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class FileQueueExecutor(object):
+    """
+    Run tasks using a work queue within a directory that is shared between hosts (eg. on a network file system).
+    Workers on each host take tasks from the queue via :func:`run_worker`, and return the results via the same
+    directory. This process also runs tasks while it waits for the results, so a local directory with no other
+    workers will also work.
+
+    Each call to :meth:`map` creates a job directory within the queue directory.
+    The job directory holds the function and initializer (`init.pkl`), the tasks that are waiting (`todo/`),
+    the tasks that are being run (`claimed/`), and the results (`done/`).
+    A worker claims a task by moving it from `todo/` to `claimed/`, which only one worker can do.
+    Each claim is named after the task and the worker (`<task>@<host>_<pid>`), so that a task that has timed out
+    and been claimed again is not confused with the original claim.
+
+    Attributes
+    ----------
+    queue_dir : str
+        The shared directory.
+
+    poll : float
+        Seconds to wait between checks of the queue.
+
+    timeout : float
+        Tasks that have been claimed for longer than this many seconds are assumed to be lost (eg. because the
+        worker died), and are put back in the queue. None means wait forever.
+
+    work : bool
+        If True then this process also runs tasks while it waits for the results.
+
+    max_queued : int
+        The maximum number of tasks that are queued but whose results have not been collected. The iterable that
+        is passed to :meth:`map` is only consumed as results are collected.
+
+    local : bool
+        False, since the workers may be on other hosts and so cannot share memory maps with this process.
+    """
+    local = False
+
+    def __init__(self, queue_dir, poll=0.5, timeout=None, work=True, max_queued=1000):
+        """
+        Parameters
+        ----------
+        queue_dir : str
+            The shared directory. It is created if it does not exist.
+
+        poll : float
+            Seconds to wait between checks of the queue. Default = 0.5.
+
+        timeout : float
+            Seconds after which a claimed task is put back in the queue. Default = None (never).
+
+        work : bool
+            Run tasks in this process while waiting for results. Default = True.
+
+        max_queued : int
+            The maximum number of tasks that are queued but not yet collected. Default = 1000.
+        """
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        self.queue_dir = queue_dir
+        self.poll = poll
+        self.timeout = timeout
+        self.work = work
+        self.max_queued = max_queued
+
+    def scratch_dir(self, prefix='tmp'):
+        """
+        Create a directory, within the shared directory, for files that the workers need to read.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix for the directory name.
+
+        Returns
+        -------
+        dirname : str
+            The directory. The caller is responsible for removing it.
+        """
+        return tempfile.mkdtemp(prefix=prefix, dir=self.queue_dir)
+
+    def map(self, func, iterable, initializer=None, initargs=(), ordered=True):
+        """
+        Generator function.
+        Run a function on each item of an iterable.
+
+        Parameters
+        ----------
+        func : function
+            A function that takes one argument. It must be defined at the top level of a module.
+
+        iterable : iterable
+            The arguments for each call of `func`. The iterable is consumed lazily, so it may be a generator.
+            At most `max_queued` tasks are in the queue at once.
+
+        initializer : function
+            A function that is called by each worker before it runs any tasks for this job. Default = None.
+
+        initargs : tuple
+            The arguments for `initializer`.
+
+        ordered : bool
+            If True (default) then the results are in the same order as the iterable.
+            Otherwise they are yielded as soon as they are ready.
+
+        Yields
+        ------
+        result : object
+            The return value of each call of `func`.
+        """
+        # job directories are only used by the workers once init.pkl exists
+        job_dir = tempfile.mkdtemp(prefix='job_', dir=self.queue_dir)
+        try:
+            for sub in ['todo', 'claimed', 'done']:
+                os.mkdir(os.path.join(job_dir, sub))
+            _write_pickle(job_dir, 'init.pkl', (func, initializer, initargs))
+            tasks = iter(iterable)
+            ntasks = 0
+            remaining = []
+            exhausted = False
+            while True:
+                # top up the queue as results are collected, rather than queueing everything at once
+                while not exhausted and len(remaining) < self.max_queued:
+                    try:
+                        item = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        log.debug("Queued {0} tasks in {1}".format(ntasks, job_dir))
+                        break
+                    _write_pickle(job_dir, os.path.join('todo', _task_name(ntasks)), item)
+                    remaining.append(ntasks)
+                    ntasks += 1
+                if not remaining:
+                    break
+                if ordered:
+                    ready = [remaining[0]] if self._is_done(job_dir, remaining[0]) else []
+                else:
+                    done = set(os.listdir(os.path.join(job_dir, 'done')))
+                    ready = [n for n in remaining if _task_name(n) in done]
+                if not ready:
+                    self._wait(job_dir)
+                    continue
+                for n in ready:
+                    remaining.remove(n)
+                    done_file = os.path.join(job_dir, 'done', _task_name(n))
+                    ok, result = _read_pickle(done_file)
+                    os.remove(done_file)
+                    if not ok:
+                        raise RuntimeError("Task {0} of {1} failed:\n{2}".format(n, job_dir, result))
+                    yield result
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def _is_done(self, job_dir, n):
+        return os.path.exists(os.path.join(job_dir, 'done', _task_name(n)))
+
+    def _wait(self, job_dir):
+        """
+        Do something useful while waiting for results: run a task, requeue lost tasks, or sleep.
+        """
+        if self.work and _run_one(job_dir):
+            return
+        if self.timeout is not None:
+            claimed = os.path.join(job_dir, 'claimed')
+            for name in os.listdir(claimed):
+                try:
+                    if time.time() - os.path.getmtime(os.path.join(claimed, name)) > self.timeout:
+                        task = name.split('@')[0]
+                        log.warning("Task {0} of {1} has timed out, putting it back in the queue".format(
+                            task, job_dir))
+                        os.rename(os.path.join(claimed, name), os.path.join(job_dir, 'todo', task))
+                except OSError:
+                    # the task finished, or was requeued by someone else
+                    pass
+        time.sleep(self.poll)
+
+
+def run_worker(queue_dir, poll=0.5, idle_timeout=None):
+    """
+    Run tasks from the queue of a :class:`AegeanTools.executors.FileQueueExecutor`.
+
+    Parameters
+    ----------
+    queue_dir : str
+        The shared directory.
+
+    poll : float
+        Seconds to wait between checks of the queue. Default = 0.5.
+
+    idle_timeout : float
+        Stop after this many seconds without finding any tasks. Default = None, which means run forever.
+
+    Returns
+    -------
+    ntasks : int
+        The number of tasks that were run.
+    """
+    ntasks = 0
+    idle_since = time.time()
+    while True:
+        ran = False
+        if os.path.isdir(queue_dir):
+            for job in sorted(os.listdir(queue_dir)):
+                job_dir = os.path.join(queue_dir, job)
+                if not (job.startswith('job_') and os.path.exists(os.path.join(job_dir, 'init.pkl'))):
+                    continue
+                try:
+                    ran = _run_one(job_dir)
+                except (IOError, OSError):
+                    # the job was finished and removed while we were looking at it
+                    ran = False
+                if ran:
+                    break
+        if ran:
+            ntasks += 1
+            idle_since = time.time()
+            continue
+        if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+            return ntasks
+        time.sleep(poll)
+
+
+def _run_one(job_dir):
+    """
+    Claim one task from a job and run it.
+
+    Parameters
+    ----------
+    job_dir : str
+        The job directory.
+
+    Returns
+    -------
+    ran : bool
+        True if a task was run, False if there were no tasks waiting.
+    """
+    global _current_job
+    todo = os.path.join(job_dir, 'todo')
+    for name in sorted(os.listdir(todo)):
+        task = os.path.join(todo, name)
+        claimed = os.path.join(job_dir, 'claimed', "{0}@{1}".format(name, _worker_name()))
+        try:
+            # the timeout is measured from when the task is claimed, so the time is set before it is moved
+            os.utime(task, None)
+            os.rename(task, claimed)
+        except OSError:
+            # another worker got there first
+            continue
+        try:
+            item = _read_pickle(claimed)
+        except (IOError, OSError):
+            # the claim timed out and the task was put back in the queue, so it is no longer ours to run
+            continue
+        try:
+            if _current_job[0] != job_dir:
+                func, initializer, initargs = _read_pickle(os.path.join(job_dir, 'init.pkl'))
+                if initializer is not None:
+                    initializer(*initargs)
+                _current_job = (job_dir, func)
+            result = (True, _current_job[1](item))
+        except Exception:
+            result = (False, "{0}:{1}\n{2}".format(socket.gethostname(), os.getpid(), traceback.format_exc()))
+        _write_pickle(job_dir, os.path.join('done', name), result)
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+        return True
+    return False
+
+
+def _task_name(n):
+    return "{0:08d}.pkl".format(n)
+
+
+def _worker_name():
+    return "{0}_{1}".format(socket.gethostname(), os.getpid())
+
+
+def _read_pickle(filename):
+    with open(filename, 'rb') as f:
+        return cPickle.load(f)
+
+
+def _write_pickle(job_dir, name, obj):
+    """
+    Write a pickle within a job directory, such that it appears all at once.
+    """
+    tmp = os.path.join(job_dir, "tmp_" + _worker_name())
+    with open(tmp, 'wb') as f:
+        cPickle.dump(obj, f, protocol=2)
+    os.rename(tmp, os.path.join(job_dir, name))
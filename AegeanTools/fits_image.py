@@ -141,12 +141,79 @@ def fix_aips_header(header):
     return header
 
 
+class LazyImage(object):
+    """
+    A 2d image that is only read when it is indexed, so that memory mapped data are not loaded all at once.
+    Each time the image is indexed the pixels are copied, +/- inf are converted to nan,
+    and the background (if any) is subtracted.
+
+    Attributes
+    ----------
+    pixels : numpy.ndarray
+        The image data, usually a memory mapped array.
+
+    bkg : numpy.ndarray or :class:`AegeanTools.fits_image.LazyImage`
+        The background that is subtracted from the pixels, or None.
+
+    shape : tuple
+        The shape of the image.
+
+    dtype : numpy.dtype
+        The data type of the pixels that are returned.
+    """
+
+    def __init__(self, pixels, bkg=None):
+        """
+        Parameters
+        ----------
+        pixels : numpy.ndarray or :class:`AegeanTools.fits_image.LazyImage`
+            The image data.
+
+        bkg : numpy.ndarray or :class:`AegeanTools.fits_image.LazyImage`
+            A background image that has the same shape as `pixels`. Default = None.
+        """
+        if bkg is not None and bkg.shape != pixels.shape:
+            raise AssertionError("Shape mismatch between pixels {0} and background {1}".format(pixels.shape,
+                                                                                            bkg.shape))
+        self.pixels = pixels
+        self.bkg = bkg
+        self.shape = pixels.shape
+        self.ndim = len(self.shape)
+        dtypes = [pixels.dtype] if bkg is None else [pixels.dtype, bkg.dtype]
+        # native byte order, since fits data are big endian
+        self.dtype = numpy.dtype(numpy.result_type(*dtypes).type)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        box = numpy.array(self.pixels[key], dtype=self.dtype)
+        box[numpy.isinf(box)] = numpy.nan
+        if self.bkg is not None:
+            box -= self.bkg[key]
+        if box.ndim == 0:
+            return box[()]
+        return box
+
+    def __setitem__(self, key, value):
+        # the background is added so that the value is returned when the pixels are next read
+        if self.bkg is not None:
+            value = value + self.bkg[key]
+        self.pixels[key] = value
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
 class FitsImage(object):
     """
     An object that handles the loading and manipulation of a fits file.
     """
 
-    def __init__(self, filename=None, hdu_index=0, beam=None, slice=None):
+    def __init__(self, filename=None, hdu_index=0, beam=None, slice=None, lazy=False):
         """
         Parameters
         ----------
@@ -165,6 +232,11 @@ class FitsImage(object):
             If the input data has 3 dimensions then this will specify the index into the 3rd dimension
             which will be extracted as the image.
             Default = None.
+
+        lazy : bool
+            If True then the pixels are left in the (memory mapped) fits data, and are returned by
+            :func:`get_pixels` as a :class:`AegeanTools.fits_image.LazyImage`. Otherwise they are
+            loaded into memory. Default = False.
         """
 
         self.hdu = expand(filename)[hdu_index] # auto detects if the file needs expanding
@@ -212,8 +284,12 @@ class FitsImage(object):
         elif len(self._pixels.shape) > 3:
             log.critical("Image has >3 axes.")
             raise Exception("Images with >3 axes not supported.")
-        # convert +/- inf to nan
-        self._pixels[numpy.where(numpy.isinf(self._pixels))] = numpy.nan
+        if lazy:
+            # +/- inf are converted to nan as the pixels are read
+            self._pixels = LazyImage(self._pixels)
+        else:
+            # convert +/- inf to nan
+            self._pixels[numpy.where(numpy.isinf(self._pixels))] = numpy.nan
         # del self.hdu
         log.debug("Using axes {0} and {1}".format(self._header['CTYPE1'], self._header['CTYPE2']))
 
@@ -223,7 +299,7 @@ class FitsImage(object):
 
         Returns
         -------
-        pixels : numpy.ndarray
+        pixels : numpy.ndarray or :class:`AegeanTools.fits_image.LazyImage`
             2d Array of image pixels.
         """
         return self._pixels
@@ -78,6 +78,9 @@ def compress(datafile, factor, outfile=None):
         nx += 1
     if lcy > 0:
         ny += 1
+    if compress_header(header, factor) is None:
+        return None
+
     # decimate the data
     new_data = np.empty((nx + 1, ny + 1))
     new_data[:nx, :ny] = data[::factor, ::factor]
@@ -86,6 +89,42 @@ def compress(datafile, factor, outfile=None):
     new_data[:nx, -1] = data[::factor, -1]
     new_data[-1, -1] = data[-1, -1]
 
+    # save the changes
+    hdulist[0].data = np.array(new_data, dtype=np.float32)
+    hdulist[0].header = header
+    if outfile is not None:
+        hdulist.writeto(outfile, clobber=True)
+        logging.info("Wrote: {0}".format(outfile))
+    return hdulist
+
+
+def compress_header(header, factor):
+    """
+    Update a fits header to describe an image that has been compressed by decimation.
+    The image that is described has (NAXIS2//factor + 1) x (NAXIS1//factor + 1) pixels (rounding up),
+    which are the pixels at 0, factor, 2*factor, ... along each axis of the original image,
+    followed by the last pixel.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        The header of the original image. This header is modified.
+
+    factor : int
+        Decimation factor.
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+        The updated header, or None if the pixel scale cannot be determined.
+
+    See Also
+    --------
+    :func:`AegeanTools.fits_interp.compress`
+    """
+    lcx = header['NAXIS2'] % factor
+    lcy = header['NAXIS1'] % factor
+
     # TODO: Figure out what to do when CD2_1 and CD1_2 are non-zero
     if 'CDELT1' in header:
         header['CDELT1'] *= factor
@@ -112,14 +151,7 @@ def compress(datafile, factor, outfile=None):
     header['BN_RPX1'] = (lcx, 'Residual on axis 1')
     header['BN_RPX2'] = (lcy, 'Residual on axis 2')
     header['HISTORY'] = "Compressed by a factor of {0}".format(factor)
-
-    # save the changes
-    hdulist[0].data = np.array(new_data, dtype=np.float32)
-    hdulist[0].header = header
-    if outfile is not None:
-        hdulist.writeto(outfile, clobber=True)
-        logging.info("Wrote: {0}".format(outfile))
-    return hdulist
+    return header
 
 
 def expand(datafile, outfile=None, method='linear'):
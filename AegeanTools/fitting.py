@@ -9,8 +9,10 @@ __author__ = "Paul Hancock"
 
 import copy
 import math
+from collections import OrderedDict
 import numpy as np
-from scipy.linalg import eigh, inv
+from scipy.linalg import eigh, inv, cholesky, cho_factor, cho_solve, solve_triangular
+from scipy.optimize import leastsq
 import lmfit
 from .angle_tools import gcd, bear
 
@@ -23,6 +25,17 @@ import logging
 
 log = logging.getLogger('Aegean')
 
+# Islands with more pixels than this have their correlation matrix approximated by independent blocks
+MAX_CORRELATED_PIX = 512
+# The (C, B) matrices of recent islands, the memory (bytes) that they use, and a limit on that memory
+_cb_cache = OrderedDict()
+_cb_cache_nbytes = 0
+_cb_cache_limit = 2 ** 26
+# The pixel beam of the correlation matrices is rounded to this fraction of the axes, and to this many degrees,
+# so that islands in different parts of a projected image can share the matrices
+CB_BEAM_TOL = 0.01
+CB_PA_TOL = 1.
+
 
 # Modelling and fitting functions
 def elliptical_gaussian(x, y, amp, xo, yo, sx, sy, theta):
@@ -81,7 +94,20 @@ def Cmatrix(x, y, sx, sy, theta):
     data : array-like
         The C-matrix.
     """
-    C = np.vstack([elliptical_gaussian(x, y, 1, i, j, sx, sy, theta) for i, j in zip(x, y)])
+    try:
+        sint, cost = math.sin(np.radians(theta)), math.cos(np.radians(theta))
+    except ValueError as e:
+        if 'math domain error' in e.args:
+            sint, cost = np.nan, np.nan
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # C[i, j] is a gaussian centered on pixel i, evaluated at pixel j
+    xxo = x[np.newaxis, :] - x[:, np.newaxis]
+    yyo = y[np.newaxis, :] - y[:, np.newaxis]
+    exp = (xxo * cost + yyo * sint) ** 2 / sx ** 2 \
+          + (xxo * sint - yyo * cost) ** 2 / sy ** 2
+    exp *= -1. / 2
+    C = np.exp(exp)
     return C
 
 
@@ -111,6 +137,98 @@ def Bmatrix(C):
     return B
 
 
+def Binverse_dot(r, B):
+    """
+    Calculate r.dot(inv(B)) for a B matrix that was made by :func:`AegeanTools.fitting.Bmatrix`,
+    without inverting B.
+
+    B = Q.S where Q is orthogonal and S is diagonal, so inv(B) = S^-2.B' and S^2 = diag(B'.B).
+
+    Parameters
+    ----------
+    r : array-like
+        A vector (or matrix) whose last axis has the same length as B.
+
+    B : 2d-array
+        A B matrix.
+
+    Returns
+    -------
+    rb : array-like
+        r.dot(inv(B))
+    """
+    return (r / np.sum(B ** 2, axis=0)).dot(B.T)
+
+
+def CBmatrix(x, y, sx, sy, theta):
+    """
+    Construct the correlation matrix (see :func:`AegeanTools.fitting.Cmatrix`) and its B matrix
+    (see :func:`AegeanTools.fitting.Bmatrix`) for a set of pixels.
+
+    The matrices depend only on the pattern of the pixels and not on their location, so they are cached
+    and reused for islands that have the same pattern and beam.
+    The beam is rounded to a relative precision of `CB_BEAM_TOL` in the axes, and `CB_PA_TOL` degrees in the
+    position angle, before the matrices are made.
+    When there are more than `MAX_CORRELATED_PIX` pixels, the pixels are split into bands of rows, and the
+    correlation between bands is ignored. Both matrices are then block diagonal, which avoids the cubic cost of
+    decomposing the full matrix.
+
+    Parameters
+    ----------
+    x, y : array-like
+        Locations of the pixels.
+
+    sx, sy : float
+        major/minor axes of the gaussian correlation function (sigmas)
+
+    theta : float
+        position angle of the gaussian correlation function (degrees)
+
+    Returns
+    -------
+    C, B : 2d-array
+        The C and B matrices. These may be shared with other islands, and so should not be modified.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    if len(x) == 0:
+        return Cmatrix(x, y, sx, sy, theta), np.zeros((0, 0))
+    x = x - x.min()
+    y = y - y.min()
+    # the pixel beam changes slightly over a projected image, so round it to allow the matrices to be reused
+    sx = np.exp(round(np.log(sx) / CB_BEAM_TOL) * CB_BEAM_TOL)
+    sy = np.exp(round(np.log(sy) / CB_BEAM_TOL) * CB_BEAM_TOL)
+    theta = round(theta / CB_PA_TOL) * CB_PA_TOL
+    key = (x.tobytes(), y.tobytes(), sx, sy, theta)
+    if key in _cb_cache:
+        # move to the end, so that the least recently used are removed first
+        C, B = _cb_cache[key] = _cb_cache.pop(key)
+        return C, B
+
+    npix = len(x)
+    if npix <= MAX_CORRELATED_PIX:
+        C = Cmatrix(x, y, sx, sy, theta)
+        B = Bmatrix(C)
+    else:
+        C = np.zeros((npix, npix))
+        B = np.zeros((npix, npix))
+        # the pixels are in row order, so consecutive pixels make a band of rows
+        for start in range(0, npix, MAX_CORRELATED_PIX):
+            block = slice(start, min(start + MAX_CORRELATED_PIX, npix))
+            C[block, block] = Cmatrix(x[block], y[block], sx, sy, theta)
+            B[block, block] = Bmatrix(C[block, block])
+    C.flags.writeable = False
+    B.flags.writeable = False
+
+    global _cb_cache_nbytes
+    _cb_cache[key] = (C, B)
+    _cb_cache_nbytes += C.nbytes + B.nbytes
+    while _cb_cache_nbytes > _cb_cache_limit and len(_cb_cache) > 1:
+        _, (c, b) = _cb_cache.popitem(last=False)
+        _cb_cache_nbytes -= c.nbytes + b.nbytes
+    return C, B
+
+
 def jacobian(pars, x, y):
     """
     Analytical calculation of the Jacobian for an elliptical gaussian
@@ -134,56 +252,10 @@ def jacobian(pars, x, y):
     :func:`AegeanTools.fitting.emp_jacobian`
     """
 
-    matrix = []
-
-    for i in range(pars['components'].value):
-        prefix = "c{0}_".format(i)
-        amp = pars[prefix + 'amp'].value
-        xo = pars[prefix + 'xo'].value
-        yo = pars[prefix + 'yo'].value
-        sx = pars[prefix + 'sx'].value
-        sy = pars[prefix + 'sy'].value
-        theta = pars[prefix + 'theta'].value
-
-        # The derivative with respect to component i doesn't depend on any other components
-        # thus the model should not contain the other components
-        model = elliptical_gaussian(x, y, amp, xo, yo, sx, sy, theta)
-
-        # precompute for speed
-        sint = np.sin(np.radians(theta))
-        cost = np.cos(np.radians(theta))
-        xxo = x - xo
-        yyo = y - yo
-        xcos, ycos = xxo * cost, yyo * cost
-        xsin, ysin = xxo * sint, yyo * sint
-
-        if pars[prefix + 'amp'].vary:
-            dmds = model / amp
-            matrix.append(dmds)
-
-        if pars[prefix + 'xo'].vary:
-            dmdxo = cost * (xcos + ysin) / sx ** 2 + sint * (xsin - ycos) / sy ** 2
-            dmdxo *= model
-            matrix.append(dmdxo)
-
-        if pars[prefix + 'yo'].vary:
-            dmdyo = sint * (xcos + ysin) / sx ** 2 - cost * (xsin - ycos) / sy ** 2
-            dmdyo *= model
-            matrix.append(dmdyo)
-
-        if pars[prefix + 'sx'].vary:
-            dmdsx = model / sx ** 3 * (xcos + ysin) ** 2
-            matrix.append(dmdsx)
-
-        if pars[prefix + 'sy'].vary:
-            dmdsy = model / sy ** 3 * (xsin - ycos) ** 2
-            matrix.append(dmdsy)
-
-        if pars[prefix + 'theta'].vary:
-            dmdtheta = model * (sy ** 2 - sx ** 2) * (xsin - ycos) * (xcos + ysin) / sx ** 2 / sy ** 2
-            matrix.append(dmdtheta)
-
-    return np.array(matrix)
+    values, vary, _, _ = params_to_arrays(pars)
+    x, y = np.asarray(x), np.asarray(y)
+    _, jac = model_jacobian(values, x.ravel(), y.ravel())
+    return jac[vary].reshape((-1,) + x.shape)
 
 
 def emp_jacobian(pars, x, y):
@@ -215,16 +287,18 @@ def emp_jacobian(pars, x, y):
     :return:
     """
     eps = 1e-5
+    values, vary, _, _ = params_to_arrays(pars)
+    x, y = np.asarray(x), np.asarray(y)
+    comps, _ = _component_jacobian(values.reshape(-1, 6), x.ravel(), y.ravel())
     matrix = []
-    model = ntwodgaussian_lmfit(pars)(x, y)
-    for i in range(pars['components'].value):
-        prefix = "c{0}_".format(i)
-        for p in ['amp', 'xo', 'yo', 'sx', 'sy', 'theta']:
-            if pars[prefix + p].vary:
-                pars[prefix + p].value += eps
-                dmdp = ntwodgaussian_lmfit(pars)(x, y) - model
-                matrix.append(dmdp / eps)
-                pars[prefix + p].value -= eps
+    for k in np.where(vary)[0]:
+        # only the component that contains this parameter changes
+        i = k // 6
+        perturbed = values[6 * i:6 * i + 6].copy()
+        perturbed[k % 6] += eps
+        comp, _ = _component_jacobian(perturbed[np.newaxis, :], x.ravel(), y.ravel())
+        dmdp = comp[0] - comps[i]
+        matrix.append((dmdp / eps).reshape(x.shape))
     matrix = np.array(matrix)
     return matrix
 
@@ -573,7 +647,11 @@ def hessian(pars, x, y):
         # save the number of variables for the next iteration
         # as we need to start our indexing at this number
         npvar = k
-    return np.array(hmat)
+    # theta is in degrees, but the derivatives above are per radian
+    scale = np.array([np.pi / 180 if p == 'theta' else 1. for i in range(pars['components'].value)
+                      for p in COMPONENT_PARAMS if pars["c{0}_{1}".format(i, p)].vary])
+    hmat *= (scale[:, np.newaxis] * scale[np.newaxis, :])[:, :, np.newaxis, np.newaxis]
+    return hmat
 
 
 def emp_hessian(pars, x, y):
@@ -947,7 +1025,27 @@ def errors(source, model, wcshelper):
 
     log.debug("Pix errs: {0}".format(pix_errs))
 
-    ref = wcshelper.pix2sky([xo, yo])
+    fit_pos = model[prefix + 'xo'].vary and model[prefix + 'yo'].vary and all(np.isfinite([err_xo, err_yo]))
+    fit_pa = model[prefix + 'theta'].vary and np.isfinite(err_theta)
+    fit_shape = model[prefix + 'sx'].vary and model[prefix + 'sy'].vary and all(np.isfinite([err_sx, err_sy]))
+
+    # collect all the pixel positions that are needed so they can be converted with a single WCS call
+    pixels = [[xo, yo]]
+    if fit_pos:
+        pixels.append([xo + err_xo, yo + err_yo])
+    if fit_pa:
+        pixels.append([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
+        pixels.append([xo + sx * np.cos(np.radians(theta + err_theta)),
+                       yo + sy * np.sin(np.radians(theta + err_theta))])
+    if fit_shape:
+        pixels.append([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
+        pixels.append([xo + (sx + err_sx) * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
+        pixels.append([xo + sx * np.cos(np.radians(theta + 90)), yo + sy * np.sin(np.radians(theta + 90))])
+        pixels.append([xo + sx * np.cos(np.radians(theta + 90)), yo + (sy + err_sy) * np.sin(np.radians(theta + 90))])
+    pixels = np.array(pixels)
+    sky = iter(np.column_stack(wcshelper.pix2sky_array(pixels[:, 0], pixels[:, 1])))
+
+    ref = next(sky)
     # check to see if the reference position has a valid WCS coordinate
     # It is possible for this to fail, even if the ra/dec conversion works elsewhere
     if not all(np.isfinite(ref)):
@@ -957,35 +1055,30 @@ def errors(source, model, wcshelper):
         return source
 
     # position errors
-    if model[prefix + 'xo'].vary and model[prefix + 'yo'].vary \
-            and all(np.isfinite([err_xo, err_yo])):
-        offset = wcshelper.pix2sky([xo + err_xo, yo + err_yo])
+    if fit_pos:
+        offset = next(sky)
         source.err_ra = gcd(ref[0], ref[1], offset[0], ref[1])
         source.err_dec = gcd(ref[0], ref[1], ref[0], offset[1])
     else:
         source.err_ra = source.err_dec = -1
 
-    if model[prefix + 'theta'].vary and np.isfinite(err_theta):
+    if fit_pa:
         # pa error
-        off1 = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        off2 = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + err_theta)), yo + sy * np.sin(np.radians(theta + err_theta))])
+        off1 = next(sky)
+        off2 = next(sky)
         source.err_pa = abs(bear(ref[0], ref[1], off1[0], off1[1]) - bear(ref[0], ref[1], off2[0], off2[1]))
     else:
         source.err_pa = -1
 
-    if model[prefix + 'sx'].vary and model[prefix + 'sy'].vary \
-            and all(np.isfinite([err_sx, err_sy])):
+    if fit_shape:
         # major axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        offset = wcshelper.pix2sky(
-            [xo + (sx + err_sx) * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
+        ref = next(sky)
+        offset = next(sky)
         source.err_a = gcd(ref[0], ref[1], offset[0], offset[1]) * 3600
 
         # minor axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta + 90)), yo + sy * np.sin(np.radians(theta + 90))])
-        offset = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + 90)), yo + (sy + err_sy) * np.sin(np.radians(theta + 90))])
+        ref = next(sky)
+        offset = next(sky)
         source.err_b = gcd(ref[0], ref[1], offset[0], offset[1]) * 3600
     else:
         source.err_a = source.err_b = -1
@@ -1188,6 +1281,13 @@ def do_lmfit(data, params, B=None, errs=None, dojac=True):
     params : lmfit.Params
         Fitted model.
 
+    Notes
+    -----
+    Earlier versions gave lmfit a derivative with respect to theta that was per radian rather than per degree,
+    which stopped many fits before they had converged. Catalogues made since this was corrected can differ in
+    the shape (and so the peak flux) of sources, and some fits now converge to a singular covariance and are
+    flagged with FITERR. The theta errors from :func:`AegeanTools.fitting.covar_errors` are now in degrees.
+
     See Also
     --------
     :func:`AegeanTools.fitting.lmfit_jacobian`
@@ -1198,26 +1298,503 @@ def do_lmfit(data, params, B=None, errs=None, dojac=True):
     params = copy.deepcopy(params)
     data = np.array(data)
     mask = np.where(np.isfinite(data))
+    dmask = data[mask]
+
+    # lmfit evaluates the jacobian at the same parameters as the residual, so the model and jacobian are
+    # computed together and kept until the parameters change. The jacobian buffer is reused for each evaluation.
+    last = {'values': None, 'jac': None}
+
+    def evaluate(params):
+        values, vary, _, _ = params_to_arrays(params)
+        if last['values'] is None or not np.array_equal(values, last['values']):
+            last['model'], last['jac'] = model_jacobian(values, mask[0], mask[1], out=last['jac'])
+            last['values'] = values
+        return last['model'], last['jac'][vary]
 
     def residual(params, **kwargs):
-        f = ntwodgaussian_lmfit(params)  # A function describing the model
-        model = f(*mask)  # The actual model
+        model, _ = evaluate(params)
         if B is None:
-            return model - data[mask]
+            return model - dmask
         else:
-            return (model - data[mask]).dot(B)
+            return (model - dmask).dot(B)
+
+    def dfun(params, **kwargs):
+        _, matrix = evaluate(params)
+        # as for lmfit_jacobian
+        if errs is not None:
+            matrix = matrix / errs
+        if B is not None:
+            matrix = matrix.dot(B)
+        return np.transpose(matrix)
 
     if dojac:
-        result = lmfit.minimize(residual, params, kws={'x': mask[0], 'y': mask[1], 'B': B, 'errs': errs}, Dfun=lmfit_jacobian)
+        result = lmfit.minimize(residual, params, kws={'x': mask[0], 'y': mask[1], 'B': B, 'errs': errs}, Dfun=dfun)
     else:
         result = lmfit.minimize(residual, params, kws={'x': mask[0], 'y': mask[1], 'B': B, 'errs': errs})
 
     # Remake the residual so that it is once again (model - data)
     if B is not None:
-        result.residual = result.residual.dot(inv(B))
+        result.residual = Binverse_dot(result.residual, B)
     return result, params
 
 
+# The parameters of each component, in the order that they are stored in flat parameter arrays
+COMPONENT_PARAMS = ['amp', 'xo', 'yo', 'sx', 'sy', 'theta']
+
+
+def params_to_arrays(params):
+    """
+    Convert an lmfit.Parameters object into flat arrays of parameter values, vary flags and bounds.
+
+    Parameters
+    ----------
+    params : lmfit.Parameters
+        Model parameters, can have multiple components.
+
+    Returns
+    -------
+    values : 1d-array
+        The parameter values, 6 per component, in the order of `COMPONENT_PARAMS`.
+
+    vary : 1d-array
+        A boolean array that is True for the parameters that vary.
+
+    lower, upper : 1d-array
+        The bounds of each parameter. Missing bounds are -inf/+inf.
+    """
+    names = ["c{0}_{1}".format(i, p) for i in range(params['components'].value) for p in COMPONENT_PARAMS]
+    values = np.array([params[n].value for n in names], dtype=np.float64)
+    vary = np.array([params[n].vary for n in names], dtype=bool)
+    lower = np.array([-np.inf if params[n].min is None else params[n].min for n in names], dtype=np.float64)
+    upper = np.array([np.inf if params[n].max is None else params[n].max for n in names], dtype=np.float64)
+    return values, vary, lower, upper
+
+
+def model_jacobian(values, x, y, out=None):
+    """
+    Evaluate a multi-component elliptical Gaussian model, and its partial derivatives, in a single pass.
+
+    Parameters
+    ----------
+    values : 1d-array
+        The parameter values, 6 per component (see :func:`AegeanTools.fitting.params_to_arrays`).
+
+    x, y : 1d-array
+        Locations at which the model is evaluated.
+
+    out : 2d-array
+        A buffer for the jacobian, from a previous call with the same number of components and locations.
+        It is overwritten and returned as `jac`. Default = None, which means allocate a new array.
+
+    Returns
+    -------
+    model : 1d-array
+        The model at each location.
+
+    jac : 2d-array
+        The partial derivative of the model with respect to each parameter (rows) at each location (columns).
+        As for :func:`AegeanTools.fitting.jacobian`, the derivative with respect to theta is per degree.
+    """
+    if out is not None:
+        out = out.reshape(-1, 6, len(x))
+    comp, jac = _component_jacobian(values.reshape(-1, 6), x, y, out=out)
+    return comp.sum(axis=0), jac.reshape(-1, len(x))
+
+
+def _component_jacobian(values, x, y, out=None):
+    """
+    Evaluate a set of elliptical Gaussian components, and their partial derivatives.
+
+    Parameters
+    ----------
+    values : 2d-array
+        The parameters of each component, shape (ncomp, 6).
+
+    x, y : array-like
+        Locations at which the components are evaluated, shape (npix,) or (ncomp, npix).
+
+    out : 3d-array
+        A buffer for `jac`, which is used if it has the right shape. Default = None.
+
+    Returns
+    -------
+    comp : 2d-array
+        Each component at each location, shape (ncomp, npix).
+
+    jac : 3d-array
+        The partial derivatives, shape (ncomp, 6, npix).
+    """
+    amp, xo, yo, sx, sy, theta = [values[:, k, np.newaxis] for k in range(6)]
+    amp = np.nan_to_num(amp)
+    sint, cost = np.sin(np.radians(theta)), np.cos(np.radians(theta))
+    xxo = x - xo
+    yyo = y - yo
+    # the offsets along the major (u) and minor (v) axes
+    u = xxo * cost + yyo * sint
+    v = xxo * sint - yyo * cost
+    u_sx2 = u / sx ** 2
+    v_sy2 = v / sy ** 2
+    # the exponent terms are shared by the model and all of the derivatives, so there is only one exp
+    gauss = np.exp(-0.5 * (u * u_sx2 + v * v_sy2))
+    comp = amp * gauss
+
+    shape = comp.shape[:1] + (6,) + comp.shape[1:]
+    jac = out if out is not None and out.shape == shape else np.empty(shape)
+    jac[:, 0] = gauss
+    np.multiply(comp, cost * u_sx2 + sint * v_sy2, out=jac[:, 1])
+    np.multiply(comp, sint * u_sx2 - cost * v_sy2, out=jac[:, 2])
+    np.multiply(comp * u_sx2, u / sx, out=jac[:, 3])
+    np.multiply(comp * v_sy2, v / sy, out=jac[:, 4])
+    # theta is in degrees
+    np.multiply(comp * u, v * (np.pi / 180 * (1 / sx ** 2 - 1 / sy ** 2)), out=jac[:, 5])
+    return comp, jac
+
+
+class ArrayFitResult(object):
+    """
+    The result of :func:`AegeanTools.fitting.do_arrayfit`, with the same attributes as the lmfit.MinimizerResult
+    that is used by Aegean.
+
+    Attributes
+    ----------
+    params : lmfit.Parameters
+        The fitted model.
+
+    residual : 1d-array
+        The residual of the fit.
+
+    success : bool
+        True if the fit converged.
+
+    errorbars : bool
+        True if the parameter covariance could be estimated.
+
+    covar : 2d-array
+        The covariance of the parameters that vary, or None.
+
+    nfev : int
+        The number of model evaluations.
+    """
+
+    def __init__(self, params, residual, success, covar, nfev):
+        self.params = params
+        self.residual = residual
+        self.success = success
+        self.covar = covar
+        self.errorbars = covar is not None
+        self.nfev = nfev
+
+
+def _to_internal(values, lower, upper):
+    """
+    Convert bounded parameter values into the unbounded internal values that are used by the fitter.
+    This is the MINUIT style transformation that lmfit uses, so that both fitters see the same problem.
+
+    Parameters
+    ----------
+    values, lower, upper : array-like
+        The parameter values and their bounds. Missing bounds are -inf/+inf.
+
+    Returns
+    -------
+    internal : array-like
+        The internal parameter values.
+
+    See Also
+    --------
+    :func:`AegeanTools.fitting._from_internal`
+    """
+    internal = values.copy()
+    lo, hi = np.isfinite(lower), np.isfinite(upper)
+    both = lo & hi
+    internal[both] = np.arcsin(np.clip(2 * (values[both] - lower[both]) / (upper[both] - lower[both]) - 1, -1, 1))
+    m = lo & ~hi
+    internal[m] = np.sqrt(np.maximum((values[m] - lower[m] + 1) ** 2 - 1, 0))
+    m = hi & ~lo
+    internal[m] = np.sqrt(np.maximum((upper[m] - values[m] + 1) ** 2 - 1, 0))
+    return internal
+
+
+def _from_internal(internal, lower, upper):
+    """
+    Convert internal parameter values back into bounded values.
+
+    Parameters
+    ----------
+    internal, lower, upper : array-like
+        The internal parameter values, and the bounds of the parameters.
+
+    Returns
+    -------
+    values : array-like
+        The bounded parameter values.
+
+    grad : array-like
+        The derivative of each value with respect to its internal value.
+
+    See Also
+    --------
+    :func:`AegeanTools.fitting._to_internal`
+    """
+    values = internal.copy()
+    grad = np.ones(internal.shape)
+    lo, hi = np.isfinite(lower), np.isfinite(upper)
+    both = lo & hi
+    half_range = (upper[both] - lower[both]) / 2.
+    values[both] = lower[both] + (np.sin(internal[both]) + 1) * half_range
+    grad[both] = np.cos(internal[both]) * half_range
+    m = lo & ~hi
+    root = np.sqrt(internal[m] ** 2 + 1)
+    values[m] = lower[m] - 1 + root
+    grad[m] = internal[m] / root
+    m = hi & ~lo
+    root = np.sqrt(internal[m] ** 2 + 1)
+    values[m] = upper[m] + 1 - root
+    grad[m] = -internal[m] / root
+    return values, grad
+
+
+def do_arrayfit(data, params, B=None, errs=None, maxfev=None, ftol=1.5e-8, xtol=1.5e-8):
+    """
+    Fit the model to the data with a Levenberg-Marquardt algorithm that works directly on parameter arrays.
+    The fit is the same as that of :func:`AegeanTools.fitting.do_lmfit` (the MINPACK algorithm, with the same
+    treatment of parameter bounds and tolerances), but avoids the overhead of evaluating the model via
+    lmfit.Parameters.
+    data may contain 'flagged' or 'masked' data with the value of np.NaN
+
+    Parameters
+    ----------
+    data : 2d-array
+        Image data
+
+    params : lmfit.Parameters
+        Initial model guess.
+
+    B : 2d-array
+        B matrix to be used in residual calculations.
+        Default = None.
+
+    errs : 1d-array
+        Ignored, for compatibility with :func:`AegeanTools.fitting.do_lmfit`.
+
+    maxfev : int
+        Maximum number of model evaluations. Default = None, which means 2000 * (number of free parameters + 1).
+
+    ftol, xtol : float
+        Relative tolerance on the sum of squares and the parameters.
+
+    Returns
+    -------
+    result : :class:`AegeanTools.fitting.ArrayFitResult`
+        The fitting result.
+
+    params : lmfit.Params
+        Fitted model.
+    """
+    params = copy.deepcopy(params)
+    data = np.array(data)
+    x, y = np.where(np.isfinite(data))
+    dmask = data[x, y]
+    values, vary, lower, upper = params_to_arrays(params)
+    lower, upper = lower[vary], upper[vary]
+    nvar = int(np.sum(vary))
+    if maxfev is None:
+        maxfev = 2000 * (nvar + 1)
+
+    # MINPACK evaluates the jacobian at the same parameters as the residual, so they are computed together
+    # and kept until the parameters change. The jacobian buffer is reused for each evaluation.
+    buf = np.empty((len(values), len(x)))
+    last = {'internal': None}
+
+    def evaluate(internal):
+        if last['internal'] is None or not np.array_equal(internal, last['internal']):
+            vals = values.copy()
+            vals[vary], grad = _from_internal(internal, lower, upper)
+            model, jac = model_jacobian(vals, x, y, out=buf)
+            resid = model - dmask
+            # chain rule through the internal/external transformation
+            jac = jac[vary] * grad[:, np.newaxis]
+            if B is not None:
+                resid = resid.dot(B)
+                jac = jac.dot(B)
+            last.update(internal=internal.copy(), resid=resid, jac=jac)
+        return last['resid'], last['jac']
+
+    with np.errstate(all='ignore'):
+        best, cov_int, info, _, ier = leastsq(lambda p: evaluate(p)[0], _to_internal(values[vary], lower, upper),
+                                           Dfun=lambda p: evaluate(p)[1], col_deriv=1, full_output=1, ftol=ftol,
+                                           xtol=xtol, gtol=0., maxfev=maxfev, factor=100)
+        resid, _ = evaluate(best)
+    values[vary], grad = _from_internal(best, lower, upper)
+    success = ier in [1, 2, 3, 4]
+    cost = resid.dot(resid)
+
+    # the covariance of the (external) varying parameters, scaled by the reduced chi-squared as for lmfit
+    covar = None
+    if cov_int is not None and len(resid) > nvar:
+        covar = cov_int * np.outer(grad, grad) * cost / (len(resid) - nvar)
+        if not np.all(np.diag(covar) > 0):
+            covar = None
+
+    names = ["c{0}_{1}".format(i, p) for i in range(len(values) // 6) for p in COMPONENT_PARAMS]
+    stderr = np.sqrt(np.diag(covar)) if covar is not None else [None] * nvar
+    j = 0
+    for n, v, var in zip(names, values, vary):
+        params[n].value = v
+        if var:
+            params[n].stderr = stderr[j]
+            j += 1
+
+    # Remake the residual so that it is once again (model - data)
+    if B is not None:
+        resid = Binverse_dot(resid, B)
+    return ArrayFitResult(params, resid, success, covar, info['nfev']), params
+
+
+def do_batchfit(datas, params_list, Bs=None, maxfev=200, ftol=1.5e-8, xtol=1.5e-8):
+    """
+    Fit many single component islands at once, with a Levenberg-Marquardt algorithm that updates all of the
+    islands together. The islands are padded to the same number of pixels.
+    Parameter bounds are handled with the same transformation as :func:`AegeanTools.fitting.do_arrayfit`.
+
+    An island has converged when the Gauss-Newton step from its current parameters would reduce the sum of
+    squares by no more than `ftol` (relative), or would change none of the parameters by more than `xtol`
+    (relative). Islands that do not get there within `maxfev` evaluations, or that get stuck, are not
+    converged.
+
+    Parameters
+    ----------
+    datas : list of 2d-array
+        The data for each island, with pixels that are not to be fit set to nan.
+
+    params_list : list of lmfit.Parameters
+        The initial single component model for each island.
+
+    Bs : list of 2d-array
+        The B matrix for each island. Default = None.
+
+    maxfev : int
+        Maximum number of model evaluations per island.
+
+    ftol, xtol : float
+        Relative tolerance on the sum of squares and the parameters.
+
+    Returns
+    -------
+    results : list
+        A :class:`AegeanTools.fitting.ArrayFitResult` for each island, or None if the fit did not converge,
+        in which case the island should be fit with :func:`AegeanTools.fitting.do_lmfit` instead.
+    """
+    nisl = len(datas)
+    if nisl == 0:
+        return []
+    pixels = [np.where(np.isfinite(d)) for d in datas]
+    npix = np.array([len(px[0]) for px in pixels])
+    width = npix.max()
+    x = np.zeros((nisl, width))
+    y = np.zeros((nisl, width))
+    data = np.zeros((nisl, width))
+    weight = np.zeros((nisl, width))
+    for n, (d, (px, py)) in enumerate(zip(datas, pixels)):
+        x[n, :npix[n]], y[n, :npix[n]] = px, py
+        data[n, :npix[n]] = d[px, py]
+        weight[n, :npix[n]] = 1
+    B = None
+    if Bs is not None:
+        B = np.zeros((nisl, width, width))
+        for n, b in enumerate(Bs):
+            B[n, :npix[n], :npix[n]] = b
+
+    arrays = [params_to_arrays(p) for p in params_list]
+    values = np.array([a[0] for a in arrays])
+    vary = np.array([a[1] for a in arrays])
+    # fixed parameters are not transformed, so that they keep their exact values
+    lower = np.where(vary, np.array([a[2] for a in arrays]), -np.inf)
+    upper = np.where(vary, np.array([a[3] for a in arrays]), np.inf)
+    internal = _to_internal(values, lower, upper)
+    # fixed parameters get a unit diagonal in the normal matrix, and so a step of zero
+    fixed = np.einsum('nk,kj->nkj', ~vary * 1., np.eye(6))
+
+    def evaluate(idx, pint):
+        vals, grad = _from_internal(pint, lower[idx], upper[idx])
+        comp, jac = _component_jacobian(vals, x[idx], y[idx])
+        resid = (comp - data[idx]) * weight[idx]
+        jac *= (vary[idx] * grad)[:, :, np.newaxis] * weight[idx][:, np.newaxis, :]
+        if B is not None:
+            resid = np.einsum('np,npq->nq', resid, B[idx])
+            jac = np.einsum('nkp,npq->nkq', jac, B[idx])
+        return resid, jac, np.sum(resid ** 2, axis=1)
+
+    everyone = np.arange(nisl)
+    resid, jac, cost = evaluate(everyone, internal)
+    lam = np.full(nisl, 1e-3)
+    success = np.zeros(nisl, dtype=bool)
+    active = np.isfinite(cost)
+    nfev = 1
+    while nfev < maxfev and np.any(active):
+        idx = everyone[active]
+        alpha = np.einsum('nkp,njp->nkj', jac[idx], jac[idx])
+        beta = np.einsum('nkp,np->nk', jac[idx], resid[idx])
+
+        # convergence is judged from the undamped (Gauss-Newton) step, so a large damping can't fake it
+        newton = -np.einsum('nkj,nj->nk', np.linalg.pinv(alpha + fixed[idx]), beta)
+        decrement = -np.einsum('nk,nk->n', newton, beta)
+        converged = (decrement <= ftol * cost[idx]) | \
+            np.all(np.abs(newton) <= xtol * (np.abs(internal[idx]) + xtol), axis=1)
+        success[idx[converged]] = True
+        active[idx[converged]] = False
+        keep = ~converged
+        idx, alpha, beta = idx[keep], alpha[keep], beta[keep]
+        if len(idx) == 0:
+            break
+
+        damped = alpha + lam[idx, np.newaxis, np.newaxis] * alpha * np.eye(6) + fixed[idx]
+        trial = internal[idx] - np.einsum('nkj,nj->nk', np.linalg.pinv(damped), beta)
+        new_resid, new_jac, new_cost = evaluate(idx, trial)
+        nfev += 1
+
+        better = np.isfinite(new_cost) & (new_cost <= cost[idx])
+        take = idx[better]
+        internal[take], resid[take], jac[take], cost[take] = trial[better], new_resid[better], new_jac[better], \
+            new_cost[better]
+        lam[take] = np.maximum(lam[take] / 10, 1e-12)
+        lam[idx[~better]] *= 10
+        # no step reduces the residual, but the Gauss-Newton step says that this isn't a minimum
+        active[idx[~better][lam[idx[~better]] > 1e12]] = False
+
+    values, grad = _from_internal(internal, lower, upper)
+    results = []
+    for n in range(nisl):
+        if not success[n]:
+            results.append(None)
+            continue
+        nvar = int(np.sum(vary[n]))
+        covar = None
+        if npix[n] > nvar:
+            try:
+                jn = jac[n][vary[n]]
+                # the covariance of the internal parameters, transformed to parameter units
+                covar = inv(jn.dot(jn.T)) * np.outer(grad[n][vary[n]], grad[n][vary[n]]) * cost[n] / (npix[n] - nvar)
+                if not np.all(np.diag(covar) > 0):
+                    covar = None
+            except np.linalg.LinAlgError:
+                covar = None
+        params = copy.deepcopy(params_list[n])
+        stderr = np.sqrt(np.diag(covar)) if covar is not None else [None] * nvar
+        j = 0
+        for p, v, var in zip(COMPONENT_PARAMS, values[n], vary[n]):
+            params["c0_" + p].value = v
+            if var:
+                params["c0_" + p].stderr = stderr[j]
+                j += 1
+        # Remake the residual so that it is once again (model - data)
+        rn = resid[n, :npix[n]]
+        if Bs is not None:
+            rn = Binverse_dot(rn, Bs[n])
+        results.append(ArrayFitResult(params, rn, True, covar, nfev))
+    return results
+
+
 def covar_errors(params, data, errs, B, C=None):
     """
     Take a set of parameters that were fit with lmfit, and replace the errors
@@ -1239,7 +1816,7 @@ def covar_errors(params, data, errs, B, C=None):
         B matrix.
 
     C : 2d-array
-        C matrix. Optional. If supplied then Bmatrix will not be used.
+        C matrix. Optional. Only used if B is None, since the B matrix already describes the correlation.
 
     Returns
     -------
@@ -1250,19 +1827,21 @@ def covar_errors(params, data, errs, B, C=None):
     mask = np.where(np.isfinite(data))
 
     # calculate the proper parameter errors and copy them across.
-    if C is not None:
+    # B.B' = inv(C) (see Bmatrix), so when B is given J'.inv(C).J = (J.B)'.(J.B) and C is not inverted.
+    if C is not None and B is None:
         try:
             J = lmfit_jacobian(params, mask[0], mask[1], errs=errs)
-            covar = np.transpose(J).dot(inv(C)).dot(J)
-            onesigma = np.sqrt(np.diag(inv(covar)))
+            W = solve_triangular(cholesky(C, lower=True), J, lower=True)
+            covar = np.transpose(W).dot(W)
+            onesigma = np.sqrt(np.diag(cho_solve(cho_factor(covar), np.eye(len(covar)))))
         except (np.linalg.linalg.LinAlgError, ValueError) as _:
             C = None
 
-    if C is None:
+    if C is None or B is not None:
         try:
             J = lmfit_jacobian(params, mask[0], mask[1], B=B, errs=errs)
             covar = np.transpose(J).dot(J)
-            onesigma = np.sqrt(np.diag(inv(covar)))
+            onesigma = np.sqrt(np.diag(cho_solve(cho_factor(covar), np.eye(len(covar)))))
         except (np.linalg.linalg.LinAlgError, ValueError) as _:
             onesigma = [-2] * len(mask[0])
 
@@ -8,8 +8,12 @@ Different types of sources that Aegean is able to fit
 
 __author__ = "Paul Hancock"
 
+import copy
+import mmap
+import os
 import numpy as np
 import uuid
+from .fits_image import LazyImage
 
 class SimpleSource(object):
     """
@@ -420,8 +424,9 @@ class GlobalFittingData(object):
 
     dcurve : 2d-array
         Image of +1,0,-1 representing the curvature of the input image.
+        If None then the curvature is computed for each island as it is needed.
 
-    rmsimg, bkgimg : 2d-array
+    rmsimg, bkgimg : 2d-array or :class:`AegeanTools.fits_image.LazyImage`
         The noise and background of the input image.
 
     hdu_header : HDUHeader
@@ -430,7 +435,7 @@ class GlobalFittingData(object):
     beam : :class:`AegeanTools.fits_image.Beam`
         The synthesized beam of the input image.
 
-    data_pix : 2d-array
+    data_pix : 2d-array or :class:`AegeanTools.fits_image.LazyImage`
         A link to the data array that is contained within the `img`.
 
     dtype : {np.float32, np.float64}
@@ -439,6 +444,9 @@ class GlobalFittingData(object):
     region : :class:`AegeanTools.regions.Region`
         The region that will be used to limit the source finding of Aegean.
 
+    regionmask : 2d-array
+        The `region` rasterised onto the pixels of the input image (True within the region).
+
     wcshelper : :class:`AegeanTools.wcs_helpers.WCSHelper`
         A helper object for WCS operations, created from `hdu_header`.
 
@@ -449,8 +457,15 @@ class GlobalFittingData(object):
         If true, then the input image will be blanked at the location of each of
         the measured islands.
 
+    Notes
+    -----
+    Image planes that are stored as read-only memory mapped files (see :func:`memmap_planes`) are pickled
+    as a reference to their file, so that subprocesses can attach to them rather than receiving a copy.
     """
 
+    # the full-size images that are shared with the fitting subprocesses
+    planes = ('data_pix', 'bkgimg', 'rmsimg', 'dcurve')
+
     def __init__(self):
         self.img = None
         self.dcurve = None
@@ -461,11 +476,128 @@ class GlobalFittingData(object):
         self.data_pix = None
         self.dtype = None
         self.region = None
+        self.regionmask = None
         self.wcshelper = None
         self.psfhelper = None
         self.blank = False
         return
 
+    def memmap_planes(self, dirname):
+        """
+        Create a copy of this object in which the image planes are stored in read-only memory mapped files.
+
+        Parameters
+        ----------
+        dirname : str
+            The directory in which the files will be created.
+            The files are not removed, so this should be a temporary directory that the caller cleans up.
+
+        Returns
+        -------
+        shared : :class:`AegeanTools.models.GlobalFittingData`
+            A shallow copy of this object with the planes replaced by :class:`numpy.memmap` arrays.
+            If `data_pix` has the background subtracted as it is read, then the unsubtracted pixels are stored,
+            and the background is still subtracted as they are read.
+            The `img` is not included since the pixel data are already available as `data_pix`,
+            and the `regionmask` is not included since it is only used when finding islands.
+        """
+        shared = copy.copy(self)
+        shared.img = None
+        shared.regionmask = None
+        unsubtracted = []
+        for name in self.planes:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            # an image that has the background subtracted as it is read is shared before the subtraction
+            if isinstance(arr, LazyImage) and arr.bkg is not None and arr.bkg is self.bkgimg:
+                arr = arr.pixels
+                unsubtracted.append(name)
+            fname = os.path.join(dirname, name + '.dat')
+            mm = np.memmap(fname, dtype=arr.dtype, mode='w+', shape=arr.shape)
+            # copy a few rows at a time so that lazily loaded images are never read all at once
+            step = max(1, 2 ** 20 // max(1, int(np.prod(arr.shape[1:]))))
+            for start in range(0, arr.shape[0], step):
+                mm[start:start + step] = arr[start:start + step]
+            mm.flush()
+            del mm
+            setattr(shared, name, np.memmap(fname, dtype=arr.dtype, mode='r', shape=arr.shape))
+        for name in unsubtracted:
+            setattr(shared, name, LazyImage(getattr(shared, name), bkg=shared.bkgimg))
+        return shared
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.planes:
+            arr = state.get(name)
+            if isinstance(arr, LazyImage) and arr.bkg is self.bkgimg and _is_plane(arr.pixels):
+                # the background is attached again when unpickled
+                state[name] = LazyImage(_plane_ref(arr.pixels))
+            elif _is_plane(arr):
+                state[name] = _plane_ref(arr)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.planes:
+            if isinstance(state.get(name), MemmapPlane):
+                state[name] = state[name].attach()
+        for name in self.planes:
+            arr = state.get(name)
+            if isinstance(arr, LazyImage) and isinstance(arr.pixels, MemmapPlane):
+                state[name] = LazyImage(arr.pixels.attach(), bkg=state.get('bkgimg'))
+        self.__dict__.update(state)
+
+
+def _is_plane(arr):
+    """
+    Test if an array is a whole memory mapped file, rather than a view that will not start at the recorded offset.
+    """
+    return isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap)
+
+
+def _plane_ref(arr):
+    """
+    Make a :class:`AegeanTools.models.MemmapPlane` that refers to a memory mapped array.
+    """
+    return MemmapPlane(arr.filename, arr.dtype, arr.shape, arr.offset)
+
+
+class MemmapPlane(object):
+    """
+    A picklable reference to an image plane that is stored in a memory mapped file.
+
+    Attributes
+    ----------
+    filename : str
+        The file that contains the data.
+
+    dtype : numpy.dtype
+        The data type.
+
+    shape : tuple
+        The shape of the array.
+
+    offset : int
+        The offset of the data within the file, in bytes.
+    """
+
+    def __init__(self, filename, dtype, shape, offset=0):
+        self.filename = filename
+        self.dtype = dtype
+        self.shape = shape
+        self.offset = offset
+
+    def attach(self):
+        """
+        Open the file as a read-only memory mapped array.
+
+        Returns
+        -------
+        arr : :class:`numpy.memmap`
+            The image plane.
+        """
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset)
+
 
 class IslandFittingData(object):
     """
@@ -478,7 +610,7 @@ class IslandFittingData(object):
         island number
 
     i : 2d-array
-        a 2D numpy array of pixel values
+        a 2D numpy array of pixel values, or None (see `seed`)
 
     scalars : (innerclip, outerclip, max_summits)
         Inner and outer clipping limits (sigma), and the maximum number of components that should be fit.
@@ -489,14 +621,19 @@ class IslandFittingData(object):
 
     doislandflux : boolean
         If true then also measure properties of the island.
+
+    seed : (int, int)
+        The location of one pixel within the island, relative to the offsets.
+        When `i` is None the island is reconstructed from the image data by flooding from this pixel.
     """
 
-    def __init__(self, isle_num=0, i=None, scalars=None, offsets=(0,0,1,1), doislandflux=False):
+    def __init__(self, isle_num=0, i=None, scalars=None, offsets=(0,0,1,1), doislandflux=False, seed=None):
         self.isle_num = isle_num
         self.i = i
         self.scalars = scalars
         self.offsets = offsets
         self.doislandflux = doislandflux
+        self.seed = seed
 
 
 class DummyLM(object):
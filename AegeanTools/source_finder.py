@@ -12,19 +12,22 @@ import os
 import numpy as np
 import math
 import copy
+import shutil
+import hashlib
 import logging
 import logging.config
 import lmfit
 
-import scipy
 from scipy.special import erf
-from scipy.ndimage import label, find_objects
+from scipy.ndimage import label, find_objects, maximum, maximum_filter, minimum_filter
 
 # AegeanTools
-from .fitting import do_lmfit, Cmatrix, Bmatrix, errors, covar_errors, ntwodgaussian_lmfit, \
+from .fitting import do_lmfit, do_arrayfit, do_batchfit, CBmatrix, errors, covar_errors, ntwodgaussian_lmfit, \
                      bias_correct, elliptical_gaussian
 from .wcs_helpers import WCSHelper, PSFHelper
-from .fits_image import FitsImage, Beam
+from .fits_image import FitsImage, Beam, LazyImage
+from .BANE import filter_image
+from .executors import LocalExecutor
 from .msq2 import MarchingSquares
 from .angle_tools import dec2hms, dec2dms, gcd, bear
 from .catalogs import load_table, table_to_source_list
@@ -41,7 +44,6 @@ else:
     import _pickle as cPickle
 
 # multiple cores support
-import pprocess
 import multiprocessing
 
 from .__init__ import __version__, __date__
@@ -52,6 +54,158 @@ header = """#Aegean version {0}
 # constants
 CC2FHWM = (2 * math.sqrt(2 * math.log(2)))
 FWHM2CC = 1 / CC2FHWM
+# single component islands with up to this many pixels can be fit together (see SourceFinder.batch_fit)
+BATCH_MAX_PIX = 64
+# islands are scheduled for fitting within windows of this many islands per worker (see _schedule_windows)
+SCHEDULE_WINDOW = 64
+
+# The SourceFinder used by the worker processes of a multiprocessing pool.
+# It is set once per worker by _init_worker, rather than being pickled along with every task.
+_worker_sf = None
+
+
+def _init_worker(sf):
+    """
+    Initialise a worker process by storing the SourceFinder (and hence the global data) that it will use.
+
+    Parameters
+    ----------
+    sf : :class:`AegeanTools.source_finder.SourceFinder`
+        The source finder that holds the global data.
+    """
+    global _worker_sf
+    # loggers can't be pickled, so the worker joins the Aegean logger
+    if sf.log is None:
+        sf.log = logging.getLogger('Aegean')
+    _worker_sf = sf
+
+
+def _sf_worker(args):
+    """
+    A shallow wrapper that runs a SourceFinder method within a worker process.
+
+    Parameters
+    ----------
+    args : (str, tuple)
+        The name of the SourceFinder method, and a tuple of arguments for that method.
+
+    Returns
+    -------
+    result : object
+        Whatever the method returns.
+    """
+    method, margs = args
+    return getattr(_worker_sf, method)(*margs)
+
+
+def _island_cost(island, rms, innerclip, max_summits=None):
+    """
+    Estimate the relative cost of fitting an island, from the number of pixels and the number of summits.
+
+    Parameters
+    ----------
+    island : 2d-array
+        The island pixels, with pixels that are not part of the island set to nan.
+
+    rms : 2d-array
+        The noise for the same pixels.
+
+    innerclip : float
+        The seed clipping level. Only summits above this level are counted.
+
+    max_summits : int
+        The maximum number of summits that will be fit. Default = None (no limit).
+
+    Returns
+    -------
+    cost : float
+        The estimated cost, in arbitrary units.
+    """
+    snr = abs(island) / rms
+    snr[~np.isfinite(snr)] = -np.inf
+    npix = np.sum(np.isfinite(island))
+    # summits are local maxima in the snr, which is close to what estimate_lmfit_parinfo finds
+    nsummits = max(1, np.sum((snr == maximum_filter(snr, size=3)) & (snr > innerclip)))
+    if max_summits is not None:
+        nsummits = min(nsummits, max_summits)
+    # each iteration of the fit evaluates the model and jacobian for all pixels, and the number of
+    # iterations grows with the number of parameters
+    return float(npix * nsummits ** 2)
+
+
+def _schedule_islands(islands, costs, workers):
+    """
+    Group islands for fitting such that the work is spread evenly over the workers.
+    The islands are dispatched largest first, and each group takes a share of the remaining work that
+    shrinks as the work runs out (guided scheduling). The last groups are single small islands, which
+    keep the workers busy until the end.
+
+    Parameters
+    ----------
+    islands : list of :class:`AegeanTools.models.IslandFittingData`
+        The islands to be fit.
+
+    costs : list of float
+        The estimated cost of fitting each island (see :func:`_island_cost`).
+
+    workers : int
+        The number of workers that will fit the islands.
+
+    Returns
+    -------
+    groups : list of lists
+        Groups of islands, in the order in which they should be dispatched.
+    """
+    order = sorted(range(len(islands)), key=lambda n: -costs[n])
+    remaining = float(sum(costs))
+    groups = []
+    group, group_cost = [], 0
+    for n in order:
+        group.append(islands[n])
+        group_cost += costs[n]
+        if group_cost >= remaining / (2 * workers):
+            groups.append(group)
+            remaining -= group_cost
+            group, group_cost = [], 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _schedule_windows(island_costs, workers, window=None):
+    """
+    Generator function.
+    Group islands for fitting (see :func:`_schedule_islands`) within consecutive windows of islands, so that
+    fitting can start before all of the islands have been found, and only one window of islands is held at once.
+
+    Parameters
+    ----------
+    island_costs : iterable
+        The islands to be fit, as (island, cost) tuples. It is consumed lazily.
+
+    workers : int
+        The number of workers that will fit the islands.
+
+    window : int
+        The number of islands in each window. Default = None, which means `SCHEDULE_WINDOW` * `workers`.
+
+    Yields
+    ------
+    group : list
+        A group of islands.
+    """
+    if window is None:
+        window = SCHEDULE_WINDOW * workers
+    islands, costs = [], []
+    for island, cost in island_costs:
+        islands.append(island)
+        costs.append(cost)
+        if len(islands) >= window:
+            for group in _schedule_islands(islands, costs, workers):
+                yield group
+            islands, costs = [], []
+    for group in _schedule_islands(islands, costs, workers):
+        yield group
 
 
 class SourceFinder(object):
@@ -66,6 +220,17 @@ class SourceFinder(object):
     sources : list
         List of sources that have been found/measured.
 
+    executor : :class:`AegeanTools.executors.LocalExecutor` or :class:`AegeanTools.executors.FileQueueExecutor`
+        The executor that is used for parallel work. Default = None, which means use the local cores.
+
+    fitter : str
+        The fitting engine, either 'lmfit' (:func:`AegeanTools.fitting.do_lmfit`) or 'array'
+        (:func:`AegeanTools.fitting.do_arrayfit`). Default = 'lmfit'.
+
+    batch_fit : bool
+        If True then small single component islands are fit together (see :func:`AegeanTools.fitting.do_batchfit`).
+        Islands that don't converge are then fit with the `fitter`. Default = False.
+
     log : logging.log
         Logger to use.
         Default = None
@@ -75,6 +240,9 @@ class SourceFinder(object):
         self.global_data = GlobalFittingData()
         self.sources = []
         self.log = None
+        self.executor = None
+        self.fitter = 'lmfit'
+        self.batch_fit = False
 
         for k in kwargs:
             if hasattr(self, k):
@@ -83,7 +251,7 @@ class SourceFinder(object):
                 print("{0} supplied but ignored".format(k))
         return
 
-    def _gen_flood_wrap(self, data, rmsimg, innerclip, outerclip=None, domask=False):
+    def _gen_flood_wrap(self, data, rmsimg, innerclip, outerclip=None, domask=False, rows=None):
         """
         Generator function.
         Segment an image into islands and return one island at a time.
@@ -105,6 +273,11 @@ class SourceFinder(object):
             If True then look for a region mask in globals, only return islands that are within the region.
             Default = False.
 
+        rows : int
+            If not None then the image is segmented in bands of (about) this many rows, and the islands
+            in each band are returned before the next band is segmented. The islands, and their order,
+            are the same as when the whole image is segmented at once. Default = None.
+
         Yields
         ------
         data_box : 2d-array
@@ -116,45 +289,76 @@ class SourceFinder(object):
 
         if outerclip is None:
             outerclip = innerclip
+        nrows = data.shape[0]
+        if rows is None:
+            rows = nrows
+
+        # The islands are numbered in the order of their first pixel. The islands in a band that touch the
+        # last row may continue into the next band, so the band is extended until it contains the first of these
+        # islands in its entirety. Islands that come before it are returned, and the rest are found again.
+        start, end = 0, min(rows, nrows)
+        done = None  # the pixels of islands that were returned, in the rows that are segmented again
+        total = 0
+        while start < nrows:
+            # compute SNR image (data has already been background subtracted)
+            snr = abs(data[start:end]) / rmsimg[start:end]
+            # mask of pixles that are above the outerclip
+            a = snr >= outerclip
+            if done is not None:
+                a[:done.shape[0]] &= ~done
+            # segmentation a la scipy
+            l, n = label(a)
+            f = find_objects(l)
+            unfinished = n + 1
+            if end < nrows:
+                edge = l[-1][l[-1] > 0]
+                if len(edge) > 0:
+                    unfinished = edge.min()
+            total += unfinished - 1
+            if n > 0:
+                self.log.debug("{1} Found {0} islands in rows {2}-{3} above flood limit".format(
+                    unfinished - 1, data.shape, start, end))
+            if unfinished > 1:
+                # the peak snr of each island, so that islands without a seed are skipped before any copying
+                peaks = maximum(snr, labels=l, index=np.arange(1, unfinished))
+                seeded = np.where(peaks > innerclip)[0]
+            else:
+                seeded = []
+            # Yield values as before, though they are not sorted by flux
+            for i in seeded:
+                xmin, xmax = f[i][0].start, f[i][0].stop
+                ymin, ymax = f[i][1].start, f[i][1].stop
+                # the pixels of this island are all above the outerclip
+                island = l[xmin:xmax, ymin:ymax] == i + 1
+                if domask and (self.global_data.regionmask is not None):
+                    # if there are no un-masked pixels within the region then we skip this island.
+                    if not np.any(self.global_data.regionmask[start + xmin:start + xmax, ymin:ymax][island]):
+                        continue
+                # a new array so that we don't blank the master data, with other islands blanked
+                data_box = np.where(island, data[start + xmin:start + xmax, ymin:ymax], np.nan)
+                yield data_box, start + xmin, start + xmax, ymin, ymax
 
-        # compute SNR image (data has already been background subtracted)
-        snr = abs(data) / rmsimg
-        # mask of pixles that are above the outerclip
-        a = snr >= outerclip
-        # segmentation a la scipy
-        l, n = label(a)
-        f = find_objects(l)
+            if unfinished > n:
+                start, end, done = end, min(end + rows, nrows), None
+                continue
+            # start again from the first unfinished island
+            top = f[unfinished - 1][0].start
+            previous = done
+            done = (l[top:] > 0) & (l[top:] < unfinished)
+            # islands that were returned from earlier bands were masked out of this one
+            if previous is not None and previous.shape[0] > top:
+                done[:previous.shape[0] - top] |= previous[top:]
+            if top == 0:
+                # no progress, so try a bigger band
+                end = min(start + 2 * (end - start), nrows)
+            else:
+                end = min(end + rows, nrows)
+            start += top
 
-        if n == 0:
+        if total == 0:
             self.log.debug("There are no pixels above the clipping limit")
-            return
-        self.log.debug("{1} Found {0} islands total above flood limit".format(n, data.shape))
-        # Yield values as before, though they are not sorted by flux
-        for i in range(n):
-            xmin, xmax = f[i][0].start, f[i][0].stop
-            ymin, ymax = f[i][1].start, f[i][1].stop
-            if np.any(snr[xmin:xmax, ymin:ymax] > innerclip):  # obey inner clip constraint
-                # self.log.info("{1} Island {0} is above the inner clip limit".format(i, data.shape))
-                data_box = copy.copy(data[xmin:xmax, ymin:ymax])  # copy so that we don't blank the master data
-                data_box[np.where(
-                    snr[xmin:xmax, ymin:ymax] < outerclip)] = np.nan  # blank pixels that are outside the outerclip
-                data_box[np.where(l[xmin:xmax, ymin:ymax] != i + 1)] = np.nan  # blank out other summits
-                # check if there are any pixels left unmasked
-                if not np.any(np.isfinite(data_box)):
-                    # self.log.info("{1} Island {0} has no non-masked pixels".format(i,data.shape))
-                    continue
-                if domask and (self.global_data.region is not None):
-                    y, x = np.where(snr[xmin:xmax, ymin:ymax] >= outerclip)
-                    # convert indices of this sub region to indices in the greater image
-                    yx = list(zip(y + ymin, x + xmin))
-                    ra, dec = self.global_data.wcshelper.wcs.wcs_pix2world(yx, 1).transpose()
-                    mask = self.global_data.region.sky_within(ra, dec, degin=True)
-                    # if there are no un-masked pixels within the region then we skip this island.
-                    if not np.any(mask):
-                        continue
-                    self.log.debug("Mask {0}".format(mask))
-                # self.log.info("{1} Island {0} will be fit".format(i, data.shape))
-                yield data_box, xmin, xmax, ymin, ymax
+        else:
+            self.log.debug("{1} Found {0} islands total above flood limit".format(total, data.shape))
 
     ##
     # Estimating parameters, converting params -> sources, and sources -> params
@@ -424,9 +628,19 @@ class SourceFinder(object):
         residual = np.median(result.residual), np.std(result.residual)
         is_flag = isflags
 
+        # convert all the component shapes to sky coordinates at once
+        ncomp = model['components'].value
+        comp = np.array([[model["c{0}_{1}".format(j, p)].value for p in ['xo', 'yo', 'sx', 'sy', 'theta']]
+                         for j in range(ncomp)]).reshape(ncomp, 5)
+        sky_ellipses = np.column_stack(global_data.wcshelper.pix2sky_ellipse_array(comp[:, 0] + xmin + 1,
+                                                                                  comp[:, 1] + ymin + 1,
+                                                                                  comp[:, 2] * CC2FHWM,
+                                                                                  comp[:, 3] * CC2FHWM,
+                                                                                  comp[:, 4]))
+
         sources = []
         j = 0
-        for j in range(model['components'].value):
+        for j in range(ncomp):
             src_flags = is_flag
             source = OutputSource()
             source.island = isle_num
@@ -470,10 +684,7 @@ class SourceFinder(object):
             source.peak_flux = amp
 
             # all params are in degrees
-            source.ra, source.dec, source.a, source.b, source.pa = global_data.wcshelper.pix2sky_ellipse((x_pix, y_pix),
-                                                                                                         sx * CC2FHWM,
-                                                                                                         sy * CC2FHWM,
-                                                                                                         theta)
+            source.ra, source.dec, source.a, source.b, source.pa = sky_ellipses[j]
             source.a *= 3600  # arcseconds
             source.b *= 3600
             # force a>=b
@@ -560,11 +771,10 @@ class SourceFinder(object):
 
             # TODO: investigate what happens when the sky coords are skewed w.r.t the pixel coords
             # calculate the area of the island as a fraction of the area of the bounding box
-            bl = global_data.wcshelper.pix2sky([xmax, ymin])
-            tl = global_data.wcshelper.pix2sky([xmax, ymax])
-            tr = global_data.wcshelper.pix2sky([xmin, ymax])
-            height = gcd(tl[0], tl[1], bl[0], bl[1])
-            width = gcd(tl[0], tl[1], tr[0], tr[1])
+            # corners are bl, tl, tr
+            ra, dec = global_data.wcshelper.pix2sky_array([xmax, xmax, xmin], [ymin, ymax, ymax])
+            height = gcd(ra[1], dec[1], ra[0], dec[0])
+            width = gcd(ra[1], dec[1], ra[2], dec[2])
             area = height * width
             source.area = area * source.pixels / source.x_width / source.y_width  # area is in deg^2
 
@@ -573,15 +783,27 @@ class SourceFinder(object):
             source.contour = [(a[0] + xmin, a[1] + ymin) for a in msq.perimeter]
             # calculate the maximum angular size of this island, brute force method
             source.max_angular_size = 0
-            for i, pos1 in enumerate(source.contour):
-                radec1 = global_data.wcshelper.pix2sky(pos1)
-                for j, pos2 in enumerate(source.contour[i:]):
-                    radec2 = global_data.wcshelper.pix2sky(pos2)
-                    dist = gcd(radec1[0], radec1[1], radec2[0], radec2[1])
-                    if dist > source.max_angular_size:
-                        source.max_angular_size = dist
-                        source.pa = bear(radec1[0], radec1[1], radec2[0], radec2[1])
-                        source.max_angular_size_anchors = [pos1[0], pos1[1], pos2[0], pos2[1]]
+            if len(source.contour) > 0:
+                contour = np.array(source.contour, dtype=np.float64)
+                ra, dec = global_data.wcshelper.pix2sky_array(contour[:, 0], contour[:, 1])
+                n = len(ra)
+                # compare a block of rows at a time to limit the memory use
+                step = max(1, 2 ** 20 // n)
+                best, i, j = 0, 0, 0
+                for start in range(0, n, step):
+                    stop = min(start + step, n)
+                    # only consider each pair once (j >= i), and take the first of any tied pairs
+                    dist = gcd(ra[start:stop, np.newaxis], dec[start:stop, np.newaxis], ra[start:], dec[start:])
+                    dist[~np.isfinite(dist)] = -1
+                    dist[np.tril_indices(stop - start, -1, dist.shape[1])] = -1
+                    bi, bj = np.unravel_index(np.argmax(dist), dist.shape)
+                    if dist[bi, bj] > best:
+                        best, i, j = dist[bi, bj], start + bi, start + bj
+                if best > 0:
+                    source.max_angular_size = best
+                    source.pa = bear(ra[i], dec[i], ra[j], dec[j])
+                    pos1, pos2 = source.contour[i], source.contour[j]
+                    source.max_angular_size_anchors = [pos1[0], pos1[1], pos2[0], pos2[1]]
 
             self.log.debug("- peak position {0}, {1} [{2},{3}]".format(source.ra_str, source.dec_str, positions[0][0],
                                                                        positions[1][0]))
@@ -608,8 +830,79 @@ class SourceFinder(object):
     ##
     # Setting up 'global' data and calculating bkg/rms
     ##
+    def _make_region_mask(self, shape, filename, mask, hdu_index=0, slice=None, cache_dir=None):
+        """
+        Rasterise the region onto the pixel grid of the image.
+        If a cache directory is given, and both the image and the region are files, then the mask is saved in that
+        directory and reused until either of them changes.
+
+        Parameters
+        ----------
+        shape : (int, int)
+            The shape of the image.
+
+        filename : str or HDUList
+            The image filename.
+
+        mask : str or :class:`AegeanTools.regions.Region`
+            The region filename or object.
+
+        hdu_index : int
+            The HDU index of the image.
+
+        slice : int
+            The slice of the image cube.
+
+        cache_dir : str
+            Directory in which to cache the mask. Default = None, which disables the cache.
+
+        Returns
+        -------
+        regionmask : 2d-array
+            A boolean array that is True for the pixels that are within the region.
+        """
+        region = self.global_data.region
+        wcs = self.global_data.wcshelper.wcs
+        cache = None
+        if cache_dir is not None and isinstance(filename, six.string_types) and \
+                isinstance(mask, six.string_types):
+            # the mask depends on the pixel grid (hdu, slice, shape, wcs) and the region
+            key = "\n".join([os.path.abspath(filename), str(hdu_index), str(slice), str(tuple(shape)),
+                             wcs.to_header_string(relax=True), os.path.abspath(mask)])
+            key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            cache = os.path.join(cache_dir, "{0}_{1}_mask.npz".format(
+                os.path.splitext(os.path.basename(filename))[0], key))
+            if os.path.exists(cache) and os.path.getmtime(cache) >= max(os.path.getmtime(filename),
+                                                                         os.path.getmtime(mask)):
+                with np.load(cache) as cached:
+                    if str(cached['key']) == key:
+                        self.log.info("Loading region mask from {0}".format(cache))
+                        return np.unpackbits(cached['mask'], axis=1)[:, :shape[1]].astype(bool)
+
+        self.log.info("Rasterising region")
+        regionmask = np.zeros(shape, dtype=bool)
+        cols = np.arange(shape[1])
+        # convert a few rows at a time to limit the memory use
+        step = max(1, 2 ** 20 // shape[1])
+        for start in range(0, shape[0], step):
+            rows = np.arange(start, min(start + step, shape[0]))
+            x, y = np.meshgrid(rows, cols, indexing='ij')
+            ra, dec = wcs.wcs_pix2world(y.ravel(), x.ravel(), 0)
+            regionmask[rows] = region.sky_within(ra, dec, degin=True).reshape(x.shape)
+
+        if cache is not None:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                np.savez(cache, mask=np.packbits(regionmask, axis=1), key=key)
+                self.log.info("Saved region mask to {0}".format(cache))
+            except (IOError, OSError) as e:
+                self.log.warning("Unable to save region mask to {0}: {1}".format(cache, e))
+        return regionmask
+
     def load_globals(self, filename, hdu_index=0, bkgin=None, rmsin=None, beam=None, verb=False, rms=None, cores=1,
-                     do_curve=True, mask=None, lat=None, psf=None, blank=False, docov=True, slice=slice):
+                     do_curve=True, mask=None, lat=None, psf=None, blank=False, docov=True, slice=slice,
+                     mask_cache=None):
         """
         Populate the global_data object by loading or calculating the various components
 
@@ -621,8 +914,8 @@ class SourceFinder(object):
         hdu_index : int
             HDU index of the image within the fits file, default is 0 (first)
 
-        bkgin, rmsin : str or HDUList
-            background and noise image filename or HDUList
+        bkgin, rmsin : str, HDUList, or numpy.ndarray
+            background and noise image filename, HDUList, or data
 
         beam : :class:`AegeanTools.fits_image.Beam`
             Beam object representing the synthsized beam. Will replace what is in the FITS header.
@@ -639,7 +932,8 @@ class SourceFinder(object):
 
 
         do_curve : bool
-            If True a curvature map will be created, default=True.
+            Ignored, the curvature is now computed for each island as it is needed (see :func:`_get_curvature`).
+            Default = True.
 
         mask : str or :class:`AegeanTools.regions.Region`
             filename or Region object
@@ -661,11 +955,16 @@ class SourceFinder(object):
         slice : int
             For an image cube, which slice to use.
 
+        mask_cache : str
+            Directory in which the rasterised region mask is cached.
+            Default = None, which disables the cache.
+
         """
         # don't reload already loaded data
         if self.global_data.img is not None:
             return
-        img = FitsImage(filename, hdu_index=hdu_index, beam=beam, slice=slice)
+        # the pixels are read from the (memory mapped) file as each island is needed
+        img = FitsImage(filename, hdu_index=hdu_index, beam=beam, slice=slice, lazy=True)
         beam = img.beam
 
         debug = logging.getLogger('Aegean').isEnabledFor(logging.DEBUG)
@@ -685,53 +984,44 @@ class SourceFinder(object):
 
         self.global_data.wcshelper = WCSHelper.from_header(img.get_hdu_header(), beam, lat)
         self.global_data.psfhelper = PSFHelper(psf, self.global_data.wcshelper)
+        self.global_data.regionmask = None
+        if self.global_data.region is not None:
+            self.global_data.regionmask = self._make_region_mask(img.get_pixels().shape, filename, mask,
+                                                                   hdu_index=hdu_index, slice=slice,
+                                                                   cache_dir=mask_cache)
 
         self.global_data.beam = self.global_data.wcshelper.beam
         self.global_data.img = img
         self.global_data.data_pix = img.get_pixels()
-        self.global_data.dtype = type(self.global_data.data_pix[0][0])
-        self.global_data.bkgimg = np.zeros(self.global_data.data_pix.shape, dtype=self.global_data.dtype)
-        self.global_data.rmsimg = np.zeros(self.global_data.data_pix.shape, dtype=self.global_data.dtype)
+        self.global_data.dtype = self.global_data.data_pix.dtype.type
+        # bkg/rms are only allocated if they are calculated rather than loaded
+        self.global_data.bkgimg = None
+        self.global_data.rmsimg = None
         self.global_data.pixarea = img.pixarea
         self.global_data.dcurve = None
 
-        if do_curve:
-            self.log.info("Calculating curvature")
-            # calculate curvature but store it as -1,0,+1
-            dcurve = np.zeros(self.global_data.data_pix.shape, dtype=np.int8)
-            peaks = scipy.ndimage.filters.maximum_filter(self.global_data.data_pix, size=3)
-            troughs = scipy.ndimage.filters.minimum_filter(self.global_data.data_pix, size=3)
-            pmask = np.where(self.global_data.data_pix == peaks)
-            tmask = np.where(self.global_data.data_pix == troughs)
-            dcurve[pmask] = -1
-            dcurve[tmask] = 1
-            self.global_data.dcurve = dcurve
-
         # if either of rms or bkg images are not supplied then calculate them both
-        if not (rmsin and bkgin):
+        if rmsin is None or bkgin is None:
             if verb:
                 self.log.info("Calculating background and rms data")
             self._make_bkg_rms(mesh_size=20, forced_rms=rms, cores=cores)
 
-        # if a forced rms was supplied use that instead
-        if rms is not None:
-            self.global_data.rmsimg = np.ones(self.global_data.data_pix.shape) * rms
-
         # replace the calculated images with input versions, if the user has supplied them.
-        if bkgin:
-            if verb:
+        if bkgin is not None:
+            if verb and not isinstance(bkgin, np.ndarray):
                 self.log.info("Loading background data from file {0}".format(bkgin))
-            self.global_data.bkgimg = self._load_aux_image(img, bkgin)
-        if rmsin:
-            if verb:
+            self.global_data.bkgimg = self._load_aux_image(img, bkgin, slice=slice)
+        if rmsin is not None:
+            if verb and not isinstance(rmsin, np.ndarray):
                 self.log.info("Loading rms data from file {0}".format(rmsin))
-            self.global_data.rmsimg = self._load_aux_image(img, rmsin)
+            self.global_data.rmsimg = self._load_aux_image(img, rmsin, slice=slice)
 
         # subtract the background image from the data image and save
         if verb and debug:
             self.log.debug("Data max is {0}".format(img.get_pixels()[np.isfinite(img.get_pixels())].max()))
             self.log.debug("Doing background subtraction")
-        img.set_pixels(img.get_pixels() - self.global_data.bkgimg)
+        # The background is subtracted as the pixels are read, so that there is no extra copy of the image.
+        img.set_pixels(LazyImage(img.get_pixels().pixels, bkg=self.global_data.bkgimg))
         self.global_data.data_pix = img.get_pixels()
         if verb and debug:
             self.log.debug("Data max is {0}".format(img.get_pixels()[np.isfinite(img.get_pixels())].max()))
@@ -787,10 +1077,14 @@ class SourceFinder(object):
         self.load_globals(image_filename, hdu_index=hdu_index, bkgin=bkgin, rmsin=rmsin, beam=beam, verb=True, rms=rms,
                           cores=cores, do_curve=True)
         img = self.global_data.img
-        bkgimg, rmsimg = self.global_data.bkgimg, self.global_data.rmsimg
-        curve = np.array(self.global_data.dcurve, dtype=bkgimg.dtype)
+        # copies, so that the masking does not alter the images that were loaded
+        bkgimg = np.array(self.global_data.bkgimg, dtype=self.global_data.dtype)
+        rmsimg = np.array(self.global_data.rmsimg, dtype=self.global_data.dtype)
+        data = np.array(self.global_data.data_pix)
+        nx, ny = data.shape
+        curve = np.array(self._get_curvature(0, nx, 0, ny), dtype=bkgimg.dtype)
         # mask these arrays have the same mask the same as the data
-        mask = np.where(np.isnan(self.global_data.data_pix))
+        mask = np.where(np.isnan(data))
         bkgimg[mask] = np.NaN
         rmsimg[mask] = np.NaN
         curve[mask] = np.NaN
@@ -823,7 +1117,7 @@ class SourceFinder(object):
         new_hdu.writeto(curve_out, clobber=True)
         self.log.info("Wrote {0}".format(curve_out))
 
-        new_hdu.data = self.global_data.data_pix / rmsimg
+        new_hdu.data = data / rmsimg
         new_hdu.writeto(snr_out, clobber=True)
         self.log.info("Wrote {0}".format(snr_out))
         return
@@ -839,7 +1133,7 @@ class SourceFinder(object):
             Name for the output file.
         """
         hdu = self.global_data.img.hdu
-        hdu.data = self.global_data.img._pixels
+        hdu.data = np.array(self.global_data.img.get_pixels())
         hdu.header["ORIGIN"] = "Aegean {0}-({1})".format(__version__, __date__)
         # delete some axes that we aren't going to need
         for c in ['CRPIX3', 'CRPIX4', 'CDELT3', 'CDELT4', 'CRVAL3', 'CRVAL4', 'CTYPE3', 'CTYPE4']:
@@ -868,8 +1162,9 @@ class SourceFinder(object):
 
         """
         if forced_rms:
-            self.global_data.bkgimg[:] = 0
-            self.global_data.rmsimg[:] = forced_rms
+            shape = self.global_data.data_pix.shape
+            self.global_data.bkgimg = np.zeros(shape, dtype=self.global_data.dtype)
+            self.global_data.rmsimg = np.full(shape, forced_rms, dtype=np.float64)
             return
 
         data = self.global_data.data_pix
@@ -927,19 +1222,11 @@ class SourceFinder(object):
             ymins = [0]
             ymaxs = [img_y]
 
-        if cores > 1:
-            # set up the queue
-            queue = pprocess.Queue(limit=cores, reuse=1)
-            estimate = queue.manage(pprocess.MakeReusable(self._estimate_bkg_rms))
-            # populate the queue
-            for xmin, xmax in zip(xmins, xmaxs):
-                for ymin, ymax in zip(ymins, ymaxs):
-                    estimate(ymin, ymax, xmin, xmax)
+        boxes = [(xmin, xmax, ymin, ymax) for xmin, xmax in zip(xmins, xmaxs) for ymin, ymax in zip(ymins, ymaxs)]
+        if self.executor is not None or (cores is not None and cores > 1):
+            queue = self._parallel_map('_estimate_bkg_rms', boxes, cores)
         else:
-            queue = []
-            for xmin, xmax in zip(xmins, xmaxs):
-                for ymin, ymax in zip(ymins, ymaxs):
-                    queue.append(self._estimate_bkg_rms(xmin, xmax, ymin, ymax))
+            queue = [self._estimate_bkg_rms(*box) for box in boxes]
 
         # construct the bkg and rms images
         if self.global_data.rmsimg is None:
@@ -986,7 +1273,7 @@ class SourceFinder(object):
         # when compiling the results of multiple processes
         return ymin, ymax, xmin, xmax, bkg, rms
 
-    def _load_aux_image(self, image, auxfile):
+    def _load_aux_image(self, image, auxfile, slice=None):
         """
         Load a fits file (bkg/rms/curve) and make sure that
         it is the same shape as the main image.
@@ -996,18 +1283,28 @@ class SourceFinder(object):
         image : :class:`AegeanTools.fits_image.FitsImage`
             The main image that has already been loaded.
 
-        auxfile : str or HDUList
-            The auxiliary file to be loaded.
+        auxfile : str, HDUList, or numpy.ndarray
+            The auxiliary file to be loaded, or the data itself.
+
+        slice : int
+            If the auxiliary file is a cube, which slice to use.
 
         Returns
         -------
-        aux : :class:`AegeanTools.fits_image.FitsImage`
-            The loaded image.
+        aux : numpy.ndarray or :class:`AegeanTools.fits_image.LazyImage`
+            The loaded image. Images that are loaded from a file are read as they are indexed.
         """
-        auximg = FitsImage(auxfile, beam=self.global_data.beam).get_pixels()
+        if isinstance(auxfile, np.ndarray):
+            auximg = np.squeeze(auxfile)
+            if len(auximg.shape) == 3:
+                auximg = auximg[slice, :, :]
+            name = 'data'
+        else:
+            auximg = FitsImage(auxfile, beam=self.global_data.beam, slice=slice, lazy=True).get_pixels()
+            name = auxfile
         if auximg.shape != image.get_pixels().shape:
-            self.log.error("file {0} is not the same size as the image map".format(auxfile))
-            self.log.error("{0}= {1}, image = {2}".format(auxfile, auximg.shape, image.get_pixels().shape))
+            self.log.error("file {0} is not the same size as the image map".format(name))
+            self.log.error("{0}= {1}, image = {2}".format(name, auximg.shape, image.get_pixels().shape))
             sys.exit(1)
         return auximg
 
@@ -1235,12 +1532,11 @@ class SourceFinder(object):
                         self.log.critical("Cannot determine pixel beam")
                 fac = 1 / np.sqrt(2)
                 if self.global_data.docov:
-                    C = Cmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
-                    B = Bmatrix(C)
+                    C, B = CBmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
                 else:
                     C = B = None
                 errs = np.nanmax(rmsimg[int(xmin):int(xmax), int(ymin):int(ymax)])
-                result, _ = do_lmfit(idata, params, B=B)
+                result, _ = self._do_fit(idata, params, B=B)
                 model = covar_errors(result.params, idata, errs=errs, B=B, C=C)
 
             # convert the results to a source object
@@ -1265,6 +1561,114 @@ class SourceFinder(object):
             sources.extend(new_src)
         return sources
 
+    def _parallel_map(self, method, arglist, cores, ordered=True):
+        """
+        Generator function.
+        Run a method of this SourceFinder on each of the argument tuples, using the executor or a pool of
+        worker processes.
+        By default results are yielded in the same order as the arguments, so the output does not depend on the
+        number of cores that are used.
+
+        Parameters
+        ----------
+        method : str
+            The name of the method to run.
+
+        arglist : iterable
+            An iterable of argument tuples. Each tuple is passed to one call of the method.
+            The iterable is consumed lazily, so it may be a generator.
+
+        cores : int
+            The number of worker processes to use, if there is no executor.
+
+        ordered : bool
+            If False then results are yielded as soon as they are ready. Default = True.
+
+        Yields
+        ------
+        result : object
+            The return value of each method call.
+        """
+        # The workers attach to read-only memory mapped copies of the image planes instead of receiving their own
+        # copy of each image.
+        executor = self.executor
+        if executor is None:
+            executor = LocalExecutor(cores)
+        tmpdir = executor.scratch_dir(prefix='aegean_')
+        try:
+            worker_sf = copy.copy(self)
+            worker_sf.executor = None
+            worker_sf.log = None
+            worker_sf.global_data = self.global_data.memmap_planes(tmpdir)
+            self.log.debug("Running {0} with {1}".format(method, executor.__class__.__name__))
+            for result in executor.map(_sf_worker, ((method, args) for args in arglist),
+                                       initializer=_init_worker, initargs=(worker_sf,), ordered=ordered):
+                yield result
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _get_curvature(self, xmin, xmax, ymin, ymax):
+        """
+        Compute the curvature of the input image within a box.
+        The box is padded by one pixel (where possible) so that the result is the same as for the whole image.
+        Next to blank pixels the min/max filters depend on more than the neighbouring pixels, so if the box contains
+        any blank pixels then the curvature of the whole image is computed once and kept in `global_data.dcurve`.
+
+        Parameters
+        ----------
+        xmin, xmax, ymin, ymax : int
+            The corners of the box.
+
+        Returns
+        -------
+        curve : 2d-array
+            An int8 array of -1, 0, +1 for pixels that are a local maximum, neither, or a local minimum.
+        """
+        if self.global_data.dcurve is not None:
+            return self.global_data.dcurve[xmin:xmax, ymin:ymax]
+        data = self.global_data.data_pix
+        # curvature is measured before the background is subtracted
+        if isinstance(data, LazyImage) and data.bkg is not None:
+            data = data.pixels
+        shape = data.shape
+        x0, y0 = max(xmin - 1, 0), max(ymin - 1, 0)
+        x1, y1 = min(xmax + 1, shape[0]), min(ymax + 1, shape[1])
+        box = data[x0:x1, y0:y1]
+        if np.any(np.isnan(box)):
+            x0, x1, y0, y1 = 0, shape[0], 0, shape[1]
+            box = data[x0:x1, y0:y1]
+        curve = np.zeros(box.shape, dtype=np.int8)
+        curve[box == maximum_filter(box, size=3)] = -1
+        curve[box == minimum_filter(box, size=3)] = 1
+        if curve.shape == shape:
+            self.log.debug("Keeping the curvature of the whole image")
+            self.global_data.dcurve = curve
+        return curve[xmin - x0:xmax - x0, ymin - y0:ymax - y0]
+
+    def _extract_island(self, island_data):
+        """
+        Reconstruct the pixels of an island from the global image data, using the offsets and seed pixel of the
+        island. The result is the same as the island that is produced by :func:`_gen_flood_wrap`.
+
+        Parameters
+        ----------
+        island_data : :class:`AegeanTools.models.IslandFittingData`
+            The island, with `i` = None.
+
+        Returns
+        -------
+        data_box : 2d-array
+            The island pixels, with pixels that are not part of the island set to nan.
+        """
+        xmin, xmax, ymin, ymax = island_data.offsets
+        outerclip = island_data.scalars[1]
+        data_box = self.global_data.data_pix[xmin:xmax, ymin:ymax]
+        snr = abs(data_box) / self.global_data.rmsimg[xmin:xmax, ymin:ymax]
+        # The island is the part of the flood mask that is connected to the seed.
+        # Since the box bounds the island, no part of the island is lost by labelling just this box.
+        l, _ = label(snr >= outerclip)
+        return np.where(l == l[tuple(island_data.seed)], data_box, np.nan)
+
     def _fit_island(self, island_data):
         """
         Take an Island, do all the parameter estimation and fitting.
@@ -1280,14 +1684,39 @@ class SourceFinder(object):
         sources : list
             The sources that were fit.
         """
+        prepared = self._prepare_island(island_data)
+        if prepared is None:
+            return []
+        params, _, _, is_flag, _, B = prepared
+        result = None
+        if not (is_flag & flags.NOTFIT):
+            result, _ = self._do_fit(island_data.i, params, B=B)
+        return self._finish_island(island_data, prepared, result)
+
+    def _prepare_island(self, island_data):
+        """
+        Do the parameter estimation for an island, and set up the correlation matrices for the fitting.
+
+        Parameters
+        ----------
+        island_data : :class:`AegeanTools.models.IslandFittingData`
+            The island to be fit. The island pixels are extracted if they are not present.
+
+        Returns
+        -------
+        prepared : tuple or None
+            (params, pixbeam, rms, is_flag, C, B) for the island, or None if the island has no components.
+            is_flag includes flags.NOTFIT if there are not enough pixels to fit the model.
+        """
         global_data = self.global_data
 
         # global data
-        dcurve = global_data.dcurve
         rmsimg = global_data.rmsimg
 
         # island data
         isle_num = island_data.isle_num
+        if island_data.i is None:
+            island_data.i = self._extract_island(island_data)
         idata = island_data.i
         innerclip, outerclip, max_summits = island_data.scalars
         xmin, xmax, ymin, ymax = island_data.offsets
@@ -1297,14 +1726,14 @@ class SourceFinder(object):
         beam = global_data.psfhelper.get_psf_pix(midra, middec)
         del middec, midra
 
-        icurve = dcurve[xmin:xmax, ymin:ymax]
+        icurve = self._get_curvature(xmin, xmax, ymin, ymax)
         rms = rmsimg[xmin:xmax, ymin:ymax]
 
         is_flag = 0
         pixbeam = global_data.psfhelper.get_pixbeam_pixel((xmin + xmax) / 2., (ymin + ymax) / 2.)
         if pixbeam is None:
             # This island is not 'on' the sky, ignore it
-            return []
+            return None
 
         self.log.debug("=====")
         self.log.debug("Island ({0})".format(isle_num))
@@ -1315,7 +1744,7 @@ class SourceFinder(object):
         # islands at the edge of a region of nans
         # result in no components
         if params is None or params['components'].value < 1:
-            return []
+            return None
 
         self.log.debug("Rms is {0}".format(np.shape(rms)))
         self.log.debug("Isle is {0}".format(np.shape(idata)))
@@ -1325,26 +1754,50 @@ class SourceFinder(object):
         mx, my = np.where(np.isfinite(idata))
         non_blank_pix = len(mx)
         free_vars = len([1 for a in params.keys() if params[a].vary])
+        C = B = None
         if non_blank_pix < free_vars or free_vars == 0:
             self.log.debug("Island {0} doesn't have enough pixels to fit the given model".format(isle_num))
             self.log.debug("non_blank_pix {0}, free_vars {1}".format(non_blank_pix, free_vars))
-            result = DummyLM()
-            model = params
             is_flag |= flags.NOTFIT
         else:
-            # Model is the fitted parameters
             fac = 1 / np.sqrt(2)
             if self.global_data.docov:
-                C = Cmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
-                B = Bmatrix(C)
-            else:
-                C = B = None
+                C, B = CBmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
             self.log.debug(
                 "C({0},{1},{2},{3},{4})".format(len(mx), len(my), pixbeam.a * FWHM2CC, pixbeam.b * FWHM2CC, pixbeam.pa))
-            errs = np.nanmax(rms)
             self.log.debug("Initial params")
             self.log.debug(params)
-            result, _ = do_lmfit(idata, params, B=B)
+        return params, pixbeam, rms, is_flag, C, B
+
+    def _finish_island(self, island_data, prepared, result):
+        """
+        Calculate the parameter errors for a fitted island, and convert the result into sources.
+
+        Parameters
+        ----------
+        island_data : :class:`AegeanTools.models.IslandFittingData`
+            The island that was fit.
+
+        prepared : tuple
+            The output of :func:`_prepare_island`.
+
+        result : lmfit.MinimizerResult or :class:`AegeanTools.fitting.ArrayFitResult`
+            The fitting result, or None if the island was not fit.
+
+        Returns
+        -------
+        sources : list
+            The sources that were fit.
+        """
+        params, pixbeam, rms, is_flag, C, B = prepared
+        idata = island_data.i
+        if result is None:
+            result = DummyLM()
+            model = params
+        else:
+            # Model is the fitted parameters
+            fac = 1 / np.sqrt(2)
+            errs = np.nanmax(rms)
             if not result.errorbars:
                 is_flag |= flags.FITERR
             # get the real (sky) parameter errors
@@ -1367,6 +1820,53 @@ class SourceFinder(object):
 
         return sources
 
+    def _do_fit(self, data, params, B=None):
+        """
+        Fit a model to the data with the chosen fitting engine (see `fitter`).
+
+        Parameters
+        ----------
+        data : 2d-array
+            Image data, with pixels that are not to be fit set to nan.
+
+        params : lmfit.Parameters
+            Initial model guess.
+
+        B : 2d-array
+            B matrix to be used in residual calculations. Default = None.
+
+        Returns
+        -------
+        result : lmfit.MinimizerResult or :class:`AegeanTools.fitting.ArrayFitResult`
+            The fitting result.
+
+        params : lmfit.Parameters
+            The initial model.
+        """
+        if self.fitter == 'array':
+            return do_arrayfit(data, params, B=B)
+        return do_lmfit(data, params, B=B)
+
+    def _fit_island_group(self, islands):
+        """
+        Fit a list of islands as for :func:`_fit_islands`, and also report which islands were fit,
+        so that the results can be put back in island order.
+
+        Parameters
+        ----------
+        islands : list of :class:`AegeanTools.models.IslandFittingData`
+            The islands to be fit.
+
+        Returns
+        -------
+        isle_nums : list
+            The island numbers.
+
+        sources : list
+            The sources that were fit.
+        """
+        return [island.isle_num for island in islands], self._fit_islands(islands)
+
     def _fit_islands(self, islands):
         """
         Execute fitting on a list of islands
@@ -1385,16 +1885,43 @@ class SourceFinder(object):
             The sources that were fit.
         """
         self.log.debug("Fitting group of {0} islands".format(len(islands)))
+        if not self.batch_fit:
+            sources = []
+            for island in islands:
+                res = self._fit_island(island)
+                sources.extend(res)
+            return sources
+
+        # small single component islands are fit together, and the rest are fit one at a time
+        prepared = [self._prepare_island(island) for island in islands]
+        results = [None] * len(islands)
+        batch = [n for n, prep in enumerate(prepared)
+                 if prep is not None and not (prep[3] & flags.NOTFIT) and prep[0]['components'].value == 1
+                 and np.sum(np.isfinite(islands[n].i)) <= BATCH_MAX_PIX]
+        if batch:
+            Bs = None
+            if self.global_data.docov:
+                Bs = [prepared[n][5] for n in batch]
+            fits = do_batchfit([islands[n].i for n in batch], [prepared[n][0] for n in batch], Bs=Bs)
+            for n, result in zip(batch, fits):
+                results[n] = result
+            self.log.debug("Batch fit {0} of {1} islands, {2} did not converge".format(
+                len(batch), len(islands), sum(r is None for r in fits)))
+
         sources = []
-        for island in islands:
-            res = self._fit_island(island)
-            sources.extend(res)
+        for island, prep, result in zip(islands, prepared, results):
+            if prep is None:
+                continue
+            params, _, _, is_flag, _, B = prep
+            if result is None and not (is_flag & flags.NOTFIT):
+                result, _ = self._do_fit(island.i, params, B=B)
+            sources.extend(self._finish_island(island, prep, result))
         return sources
 
     def find_sources_in_image(self, filename, hdu_index=0, outfile=None, rms=None, max_summits=None, innerclip=5,
                               outerclip=4, cores=None, rmsin=None, bkgin=None, beam=None, doislandflux=False,
                               nopositive=False, nonegative=False, mask=None, lat=None, imgpsf=None, blank=False,
-                              docov=True, slice=None):
+                              docov=True, slice=None, mask_cache=None):
         """
         Run the Aegean source finder.
 
@@ -1423,7 +1950,7 @@ class SourceFinder(object):
             Number of CPU cores to use. None means all cores.
 
         rmsin, bkgin : str or HDUList
-            Filename or HDUList for the noise and background images.
+            Filename, HDUList, or data for the noise and background images.
             If either are None, then it will be calculated internally.
 
         beam : (major, minor, pa)
@@ -1457,6 +1984,10 @@ class SourceFinder(object):
         slice : int
             For image cubes, slice determines which slice is used.
 
+        mask_cache : str
+            Directory in which the rasterised region mask is cached.
+            Default = None, which disables the cache.
+
         Returns
         -------
         sources : list
@@ -1465,11 +1996,13 @@ class SourceFinder(object):
 
         # Tell numpy to be quiet
         np.seterr(invalid='ignore')
-        if cores is not None:
-            if not (cores >= 1): raise AssertionError("cores must be one or more")
+        if cores is None:
+            cores = multiprocessing.cpu_count()
+        if not (cores >= 1): raise AssertionError("cores must be one or more")
 
         self.load_globals(filename, hdu_index=hdu_index, bkgin=bkgin, rmsin=rmsin, beam=beam, rms=rms, cores=cores,
-                          verb=True, mask=mask, lat=lat, psf=imgpsf, blank=blank, docov=docov, slice=slice)
+                          verb=True, mask=mask, lat=lat, psf=imgpsf, blank=blank, docov=docov, slice=slice,
+                          mask_cache=mask_cache)
         global_data = self.global_data
         rmsimg = global_data.rmsimg
         data = global_data.data_pix
@@ -1482,42 +2015,81 @@ class SourceFinder(object):
         self.log.info("seedclip={0}".format(innerclip))
         self.log.info("floodclip={0}".format(outerclip))
 
-        isle_num = 0
-
-        if cores == 1:  # single-threaded, no parallel processing
-            queue = []
-        else:
-            queue = pprocess.Queue(limit=cores, reuse=1)
-            fit_parallel = queue.manage(pprocess.MakeReusable(self._fit_islands))
-
-        island_group = []
-        group_size = 20
-        for i, xmin, xmax, ymin, ymax in self._gen_flood_wrap(data, rmsimg, innerclip, outerclip, domask=True):
-            # ignore empty islands
-            # This should now be impossible to trigger
-            if np.size(i) < 1:
-                self.log.warn("Empty island detected, this should be imposisble.")
-                continue
-            isle_num += 1
-            scalars = (innerclip, outerclip, max_summits)
-            offsets = (xmin, xmax, ymin, ymax)
-            island_data = IslandFittingData(isle_num, i, scalars, offsets, doislandflux)
-            # If cores==1 run fitting in main process. Otherwise build up groups of islands
-            # and submit to queue for subprocesses. Passing a group of islands is more
-            # efficient than passing single islands to the subprocesses.
-            if cores == 1:
-                res = self._fit_island(island_data)
-                queue.append(res)
-            else:
+        # blanking is done on the image in the main process, so the islands can't be fit by subprocesses
+        parallel = self.executor is not None or cores > 1
+        if blank and parallel:
+            self.log.info("Image blanking requires cores=1, using one core for fitting")
+            parallel = False
+
+        def gen_islands():
+            isle_num = 0
+            # segment the image in bands so that serial fitting can start before the whole image is segmented
+            for i, xmin, xmax, ymin, ymax in self._gen_flood_wrap(data, rmsimg, innerclip, outerclip, domask=True,
+                                                                  rows=256):
+                # ignore empty islands
+                # This should now be impossible to trigger
+                if np.size(i) < 1:
+                    self.log.warn("Empty island detected, this should be imposisble.")
+                    continue
+                isle_num += 1
+                scalars = (innerclip, outerclip, max_summits)
+                offsets = (xmin, xmax, ymin, ymax)
+                if parallel:
+                    # The subprocesses rebuild the island from the shared image data, so they only need a pixel
+                    # from which to flood.
+                    seed = tuple(np.argwhere(np.isfinite(i))[0])
+                    yield i, IslandFittingData(isle_num, None, scalars, offsets, doislandflux, seed=seed)
+                else:
+                    yield i, IslandFittingData(isle_num, i, scalars, offsets, doislandflux)
+
+        def gen_costs():
+            for i, island_data in gen_islands():
+                xmin, xmax, ymin, ymax = island_data.offsets
+                yield island_data, _island_cost(i, rmsimg[xmin:xmax, ymin:ymax], innerclip, max_summits)
+
+        def gen_groups():
+            # Passing a group of islands is more efficient than passing single islands to the subprocesses,
+            # but one slow island can hold up a whole group. The islands are grouped by their estimated cost,
+            # and the most expensive of each window of islands are fit first, so that the workers all finish
+            # at about the same time.
+            workers = getattr(self.executor, 'cores', None) or cores
+            for island_group in _schedule_windows(gen_costs(), workers):
+                # islands within a group are fit in island order
+                yield (sorted(island_group, key=lambda isle: isle.isle_num),)
+
+        def gen_batches(batch_size=256):
+            # consecutive islands, so that the small ones can be fit together
+            island_group = []
+            for _, island_data in gen_islands():
                 island_group.append(island_data)
-                # If the island group is full queue it for the subprocesses to fit
-                if len(island_group) >= group_size:
-                    fit_parallel(island_group)
+                if len(island_group) >= batch_size:
+                    yield island_group
                     island_group = []
-
-        # The last partially-filled island group also needs to be queued for fitting
-        if len(island_group) > 0:
-            fit_parallel(island_group)
+            if island_group:
+                yield island_group
+
+        def gen_ordered():
+            # The groups finish in any order, so the sources of each island are kept until all of the islands
+            # before it have been fit. Islands are only reordered within a window, so this buffer stays small.
+            pending = {}
+            next_isle = 1
+            for isle_nums, srcs in self._parallel_map('_fit_island_group', gen_groups(), cores, ordered=False):
+                for isle_num in isle_nums:
+                    pending[isle_num] = []
+                for src in srcs:
+                    pending[src.island].append(src)
+                while next_isle in pending:
+                    yield pending.pop(next_isle)
+                    next_isle += 1
+
+        # If cores==1 run fitting in main process. Otherwise fit groups of islands in a pool of subprocesses
+        # (or with the executor). The results are returned in island order either way.
+        if not parallel and self.batch_fit:
+            queue = (self._fit_islands(island_group) for island_group in gen_batches())
+        elif not parallel:
+            queue = (self._fit_island(island_data) for _, island_data in gen_islands())
+        else:
+            queue = gen_ordered()
 
         # Write the output to the output file
         if outfile:
@@ -1537,6 +2109,49 @@ class SourceFinder(object):
         self.sources.extend(sources)
         return sources
 
+    def find_sources_with_bane(self, filename, step_size=None, box_size=None, twopass=False, bane_out=None,
+                               max_mem=None, cores=None, slice=None, **kwargs):
+        """
+        Run BANE to calculate the background and noise of an image, and then run the Aegean source finder on it.
+        The background and noise are passed directly to the source finder rather than via files.
+
+        Parameters
+        ----------
+        filename : str
+            Image filename.
+
+        step_size, box_size : (int, int)
+            The BANE grid and box sizes. Default = None, which means choose them based on the beam size.
+
+        twopass : bool
+            Run BANE with a second pass to get a better noise estimate. Default = False.
+
+        bane_out : str
+            If not None then the background and noise images are also written to `bane_out`_bkg.fits
+            and `bane_out`_rms.fits. Default = None.
+
+        max_mem : float
+            Approximate memory limit (GB) for BANE. Default = None.
+
+        cores : int
+            Number of CPU cores to use. None means all cores.
+
+        slice : int
+            For image cubes, slice determines which slice is used.
+
+        kwargs
+            Other arguments are passed to :func:`AegeanTools.source_finder.SourceFinder.find_sources_in_image`.
+
+        Returns
+        -------
+        sources : list
+            List of sources found.
+        """
+        self.log.info("Running BANE on {0}".format(filename))
+        bkg, rms = filter_image(filename, out_base=bane_out, step_size=step_size, box_size=box_size, twopass=twopass,
+                                cores=cores, max_mem=max_mem, plane=slice, executor=self.executor)
+        return self.find_sources_in_image(filename, bkgin=bkg, rmsin=rms, cores=cores, slice=slice, **kwargs)
+
     def priorized_fit_islands(self, filename, catalogue, hdu_index=0, outfile=None, bkgin=None, rmsin=None, cores=1,
                               rms=None, beam=None, lat=None, imgpsf=None, catpsf=None, stage=3, ratio=None, outerclip=3,
                               doregroup=True, docov=True, slice=None):
@@ -1565,7 +2180,7 @@ class SourceFinder(object):
             file for printing catalog (NOT a table, just a text file of my own design)
 
         rmsin, bkgin : str or HDUList
-            Filename or HDUList for the noise and background images.
+            Filename, HDUList, or data for the noise and background images.
             If either are None, then it will be calculated internally.
 
         cores : int
@@ -1690,34 +2305,27 @@ class SourceFinder(object):
         else:
             groups = list(island_itergen(input_sources))
 
-        if cores == 1:  # single-threaded, no parallel processing
-            queue = []
-        else:
-            queue = pprocess.Queue(limit=cores, reuse=1)
-            fit_parallel = queue.manage(pprocess.MakeReusable(self._refit_islands))
-
-        sources = []
+        # Passing a group of islands is more efficient than passing single islands to the subprocesses.
+        tasks = []
         island_group = []
         group_size = 20
 
         for i, island in enumerate(groups):
             island_group.append(island)
-            # If the island group is full queue it for the subprocesses to fit
+            # If the island group is full queue it for fitting
             if len(island_group) >= group_size:
-                if cores > 1:
-                    fit_parallel(island_group, stage, outerclip, istart=i)
-                else:
-                    res = self._refit_islands(island_group, stage, outerclip, istart=i)
-                    queue.append(res)
+                tasks.append((island_group, stage, outerclip, i))
                 island_group = []
 
         # The last partially-filled island group also needs to be queued for fitting
         if len(island_group) > 0:
-            if cores > 1:
-                fit_parallel(island_group, stage, outerclip, istart=i)
-            else:
-                res = self._refit_islands(island_group, stage, outerclip, istart=i)
-                queue.append(res)
+            tasks.append((island_group, stage, outerclip, i))
+
+        sources = []
+        if self.executor is not None or (cores is not None and cores > 1):
+            queue = self._parallel_map('_refit_islands', tasks, cores)
+        else:  # single-threaded, no parallel processing
+            queue = (self._refit_islands(*task) for task in tasks)
 
         # now unpack the fitting results in to a list of sources
         for s in queue:
@@ -1861,7 +2469,7 @@ def scope2lat(telescope):
 def check_cores(cores):
     """
     Determine how many cores we are able to use.
-    Return 1 if we are not able to make a queue via pprocess.
+    Return 1 if we are not able to make a pool of worker processes.
 
     Parameters
     ----------
@@ -1875,19 +2483,17 @@ def check_cores(cores):
 
     """
     cores = min(multiprocessing.cpu_count(), cores)
-    if six.PY3:
-        log = logging.getLogger("Aegean")
-        log.info("Multi-cores not supported in python 3+, using one core")
+    if cores <= 1:
         return 1
     try:
-        queue = pprocess.Queue(limit=cores, reuse=1)
-    except:
+        pool = multiprocessing.Pool(processes=cores)
+    except (OSError, ImportError, NotImplementedError):
+        log = logging.getLogger("Aegean")
+        log.info("Unable to start worker processes, using one core")
         cores = 1
     else:
-        try:
-            _ = queue.manage(pprocess.MakeReusable(fix_shape))
-        except:
-            cores = 1
+        pool.terminate()
+        pool.join()
     return cores
 
 
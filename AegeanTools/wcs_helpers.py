@@ -23,6 +23,22 @@ import logging
 log = logging.getLogger('Aegean')
 
 
+def _pixbeam_arrays(major, minor, theta):
+    """
+    Apply the same clean up to arrays of pixel beams that
+    :func:`AegeanTools.wcs_helpers.WCSHelper.get_pixbeam` applies to a single beam.
+    Invalid beams are set to nan.
+    """
+    swap = major < minor
+    major, minor = np.where(swap, minor, major), np.where(swap, major, minor)
+    theta = np.where(swap, theta - 90, theta)
+    theta = np.where(swap & (theta < -180), theta + 180, theta)
+    theta = np.where(np.isfinite(theta), theta, 0)
+    bad = ~(np.isfinite(major) & np.isfinite(minor))
+    major[bad] = minor[bad] = theta[bad] = np.nan
+    return major, minor, theta
+
+
 class WCSHelper(object):
     """
     A wrapper around astropy.wcs that provides extra functionality, and hides the c/fortran indexing troubles.
@@ -156,6 +172,44 @@ class WCSHelper(object):
         # wcs and pyfits have oposite ideas of x/y
         return [pixel[0][1], pixel[0][0]]
 
+    def pix2sky_array(self, x, y):
+        """
+        Convert many pixel coordinates into sky coordinates with a single WCS call.
+
+        Parameters
+        ----------
+        x, y : array-like
+            The pixel coordinates. Arrays are broadcast against each other.
+
+        Returns
+        -------
+        ra, dec : :class:`numpy.ndarray`
+            The sky coordinates in degrees, with the same shape as the inputs.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        # wcs and pyfits have oposite ideas of x/y
+        ra, dec = self.wcs.wcs_pix2world(y, x, 1)
+        return ra, dec
+
+    def sky2pix_array(self, ra, dec):
+        """
+        Convert many sky coordinates into pixel coordinates with a single WCS call.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            The sky coordinates (degrees). Arrays are broadcast against each other.
+
+        Returns
+        -------
+        x, y : :class:`numpy.ndarray`
+            The pixel coordinates, with the same shape as the inputs.
+        """
+        ra, dec = np.broadcast_arrays(np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64))
+        pix_y, pix_x = self.wcs.wcs_world2pix(ra, dec, 1)
+        # wcs and pyfits have oposite ideas of x/y
+        return pix_x, pix_y
+
     def sky2pix_vec(self, pos, r, pa):
         """
         Convert a vector from sky to pixel coords.
@@ -243,15 +297,45 @@ class WCSHelper(object):
 
         """
         ra, dec = pos
-        x, y = self.sky2pix(pos)
+        return tuple(v[()] for v in self.sky2pix_ellipse_array(ra, dec, a, b, pa))
 
-        x_off, y_off = self.sky2pix(translate(ra, dec, a, pa))
-        sx = np.hypot((x - x_off), (y - y_off))
-        theta = np.arctan2((y_off - y), (x_off - x))
+    def sky2pix_ellipse_array(self, ra, dec, a, b, pa):
+        """
+        Convert many ellipses from sky to pixel coordinates.
+        All of the required positions are converted with a single WCS call.
 
-        x_off, y_off = self.sky2pix(translate(ra, dec, b, pa - 90))
-        sy = np.hypot((x - x_off), (y - y_off))
-        theta2 = np.arctan2((y_off - y), (x_off - x)) - np.pi / 2
+        Parameters
+        ----------
+        ra, dec : array-like
+            The (ra, dec) of the ellipse centers (degrees).
+        a, b, pa: array-like
+            The semi-major axes, semi-minor axes and position angles of the ellipses (degrees).
+
+        Returns
+        -------
+        x, y : :class:`numpy.ndarray`
+            The (x, y) pixel coordinates of the ellipse centers.
+        sx, sy : :class:`numpy.ndarray`
+            The major and minor axes (FWHM) in pixels.
+        theta : :class:`numpy.ndarray`
+            The rotation angles of the ellipses (degrees).
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.WCSHelper.sky2pix_ellipse`
+        """
+        ra, dec, a, b, pa = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (ra, dec, a, b, pa)])
+        ra_a, dec_a = translate(ra, dec, a, pa)
+        ra_b, dec_b = translate(ra, dec, b, pa - 90)
+        x, y = self.sky2pix_array(np.stack((ra, ra_a, ra_b)), np.stack((dec, dec_a, dec_b)))
+        x, x_a, x_b = x
+        y, y_a, y_b = y
+
+        sx = np.hypot((x - x_a), (y - y_a))
+        theta = np.arctan2((y_a - y), (x_a - x))
+
+        sy = np.hypot((x - x_b), (y - y_b))
+        theta2 = np.arctan2((y_b - y), (x_b - x)) - np.pi / 2
 
         # The a/b vectors are perpendicular in sky space, but not always in pixel space
         # so we have to account for this by calculating the angle between the two vectors
@@ -286,19 +370,50 @@ class WCSHelper(object):
         pa : float
             The position angle of the ellipse (degrees).
         """
-        ra, dec = self.pix2sky(pixel)
         x, y = pixel
-        v_sx = [x + sx * np.cos(np.radians(theta)),
-                y + sx * np.sin(np.radians(theta))]
-        ra2, dec2 = self.pix2sky(v_sx)
-        major = gcd(ra, dec, ra2, dec2)
-        pa = bear(ra, dec, ra2, dec2)
-
-        v_sy = [x + sy * np.cos(np.radians(theta - 90)),
-                y + sy * np.sin(np.radians(theta - 90))]
-        ra2, dec2 = self.pix2sky(v_sy)
-        minor = gcd(ra, dec, ra2, dec2)
-        pa2 = bear(ra, dec, ra2, dec2) - 90
+        return tuple(v[()] for v in self.pix2sky_ellipse_array(x, y, sx, sy, theta))
+
+    def pix2sky_ellipse_array(self, x, y, sx, sy, theta):
+        """
+        Convert many ellipses from pixel to sky coordinates.
+        All of the required positions are converted with a single WCS call.
+
+        Parameters
+        ----------
+        x, y : array-like
+            The (x, y) coordinates of the centers of the ellipses.
+        sx, sy : array-like
+            The major and minor axes (FHWM) of the ellipses, in pixels.
+        theta : array-like
+            The rotation angles of the ellipses (degrees).
+
+        Returns
+        -------
+        ra, dec : :class:`numpy.ndarray`
+            The (ra, dec) coordinates of the centers of the ellipses (degrees).
+        a, b : :class:`numpy.ndarray`
+            The semi-major and semi-minor axes of the ellipses (degrees).
+        pa : :class:`numpy.ndarray`
+            The position angles of the ellipses (degrees).
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.WCSHelper.pix2sky_ellipse`
+        """
+        x, y, sx, sy, theta = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (x, y, sx, sy, theta)])
+        x_a = x + sx * np.cos(np.radians(theta))
+        y_a = y + sx * np.sin(np.radians(theta))
+        x_b = x + sy * np.cos(np.radians(theta - 90))
+        y_b = y + sy * np.sin(np.radians(theta - 90))
+        ra, dec = self.pix2sky_array(np.stack((x, x_a, x_b)), np.stack((y, y_a, y_b)))
+        ra, ra_a, ra_b = ra
+        dec, dec_a, dec_b = dec
+
+        major = gcd(ra, dec, ra_a, dec_a)
+        pa = bear(ra, dec, ra_a, dec_a)
+
+        minor = gcd(ra, dec, ra_b, dec_b)
+        pa2 = bear(ra, dec, ra_b, dec_b) - 90
 
         # The a/b vectors are perpendicular in sky space, but not always in pixel space
         # so we have to account for this by calculating the angle between the two vectors
@@ -346,6 +461,32 @@ class WCSHelper(object):
             factor = np.cos(np.radians(dec - self.lat))
         return Beam(self.beam.a / factor, self.beam.b, self.beam.pa)
 
+    def get_beam_array(self, ra, dec):
+        """
+        Determine the beam at many sky locations.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            The sky coordinates at which the beam is determined.
+
+        Returns
+        -------
+        a, b, pa : :class:`numpy.ndarray`
+            The beam semi-major axis, semi-minor axis and position angle (degrees)
+            at each location.
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.WCSHelper.get_beam`
+        """
+        ra, dec = np.broadcast_arrays(np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64))
+        if self.lat is None:
+            factor = np.ones(dec.shape)
+        else:
+            factor = np.cos(np.radians(dec - self.lat))
+        return self.beam.a / factor, np.full(dec.shape, self.beam.b), np.full(dec.shape, self.beam.pa)
+
     def get_pixbeam(self, ra, dec):
         """
         Determine the beam in pixels at the given location in sky coordinates.
@@ -381,18 +522,41 @@ class WCSHelper(object):
             beam = Beam(major, minor, theta)
         return beam
 
+    def get_pixbeam_array(self, ra, dec):
+        """
+        Determine the beam in pixels at many locations in sky coordinates.
+        All of the locations are converted with a single WCS call.
+
+        Parameters
+        ----------
+        ra , dec : array-like
+            The sky coordinates at which the beam is determined.
+
+        Returns
+        -------
+        a, b, theta : :class:`numpy.ndarray`
+            The beam major axis (pixels), minor axis (pixels), and rotation angle (degrees)
+            at each location. Locations where the beam cannot be determined are nan.
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.WCSHelper.get_pixbeam`
+        """
+        a, b, pa = self.get_beam_array(ra, dec)
+        return _pixbeam_arrays(*self.sky2pix_ellipse_array(ra, dec, a, b, pa)[2:])
+
     def get_beamarea_deg2(self, ra, dec):
         """
         Calculate the area of the synthesized beam in square degrees.
 
         Parameters
         ----------
-        ra, dec : float
+        ra, dec : float or array-like
             The sky coordinates at which the calculation is made.
 
         Returns
         -------
-        area : float
+        area : float or array-like
             The beam area in square degrees.
         """
         barea = abs(self.beam.a * self.beam.b * np.pi)  # in deg**2 at reference coords
@@ -406,13 +570,12 @@ class WCSHelper(object):
 
         Parameters
         ----------
-        ra, dec : float
+        ra, dec : float or array-like
             The sky coordinates at which the calculation is made
-        dec
 
         Returns
         -------
-        area : float
+        area : float or array-like
             The beam area in square pixels.
         """
         parea = abs(self.pixscale[0] * self.pixscale[1])  # in deg**2 at reference coords
@@ -511,6 +674,37 @@ class PSFHelper(WCSHelper):
         psf_sky = self.data[:, x, y]
         return psf_sky
 
+    def get_psf_sky_array(self, ra, dec):
+        """
+        Determine the local psf at many sky locations.
+        The psf is returned in degrees.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            The sky positions (degrees).
+
+        Returns
+        -------
+        a, b, pa : :class:`numpy.ndarray`
+            The psf semi-major axis, semi-minor axis, and position angle in (degrees) at each location.
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.PSFHelper.get_psf_sky`
+        """
+        if self.data is None:
+            return self.wcshelper.get_beam_array(ra, dec)
+
+        x, y = self.sky2pix_array(ra, dec)
+        # positions without a valid WCS can't be looked up in the psf map
+        good = np.isfinite(x) & np.isfinite(y)
+        x = np.clip(np.where(good, x, 0), 0, self.data.shape[1] - 1).astype(int)
+        y = np.clip(np.where(good, y, 0), 0, self.data.shape[2] - 1).astype(int)
+        psf_sky = self.data[:, x, y].astype(np.float64)
+        psf_sky[:, ~good] = np.nan
+        return psf_sky[0], psf_sky[1], psf_sky[2]
+
     def get_psf_pix(self, ra, dec):
         """
         Determine the local psf (a,b,pa) at a given sky location.
@@ -585,6 +779,34 @@ class PSFHelper(WCSHelper):
             return None
         return Beam(psf[0], psf[1], psf[2])
 
+    def get_pixbeam_array(self, ra, dec):
+        """
+        Get the psf at many locations specified in sky coordinates.
+        The psf is in pixel coordinates.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            The sky positions (degrees).
+
+        Returns
+        -------
+        a, b, pa : :class:`numpy.ndarray`
+            The psf semi-major axis (pixels), semi-minor axis (pixels), and rotation angle (degrees)
+            at each location. Locations where the psf is not defined are nan.
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.PSFHelper.get_pixbeam`
+        """
+        if self.data is None:
+            return self.wcshelper.get_pixbeam_array(ra, dec)
+        a, b, pa = self.get_psf_sky_array(ra, dec)
+        _, _, a, b, pa = self.wcshelper.sky2pix_ellipse_array(ra, dec, a, b, pa)
+        bad = ~(np.isfinite(a) & np.isfinite(b) & np.isfinite(pa))
+        a[bad] = b[bad] = pa[bad] = np.nan
+        return a, b, pa
+
     def get_beam(self, ra, dec):
         """
         Get the psf as a :class:`AegeanTools.fits_image.Beam` object.
@@ -607,6 +829,34 @@ class PSFHelper(WCSHelper):
                 return None
             return Beam(psf[0], psf[1], psf[2])
 
+    def get_beam_array(self, ra, dec):
+        """
+        Get the psf at many sky locations.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            The sky positions (degrees).
+
+        Returns
+        -------
+        a, b, pa : :class:`numpy.ndarray`
+            The psf semi-major axis, semi-minor axis and position angle (degrees) at each location.
+            Locations where the psf is not defined are nan.
+
+        See Also
+        --------
+        :func:`AegeanTools.wcs_helpers.PSFHelper.get_beam`
+        """
+        if self.data is None:
+            ra, dec = np.broadcast_arrays(np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64))
+            beam = self.wcshelper.beam
+            return np.full(ra.shape, beam.a), np.full(ra.shape, beam.b), np.full(ra.shape, beam.pa)
+        a, b, pa = self.get_psf_sky_array(ra, dec)
+        bad = ~(np.isfinite(a) & np.isfinite(b) & np.isfinite(pa))
+        a[bad] = b[bad] = pa[bad] = np.nan
+        return a, b, pa
+
     def get_beamarea_pix(self, ra, dec):
         """
         Calculate the area of the beam in square pixels.
@@ -20,7 +20,6 @@ def get_version():
 reqs = ['numpy>=1.10',
         'scipy>=0.16',
         'astropy>=1.0',
-        'pprocess>=0.5',
         'healpy >=1.10']
 
 if sys.version_info < (2, 7):
@@ -42,7 +41,8 @@ setup(
     long_description=read('README.md'),
     packages=['AegeanTools'],
     install_requires=reqs,
-    scripts=['scripts/aegean', 'scripts/BANE', 'scripts/SR6', 'scripts/AeRes', 'scripts/MIMAS'],
+    scripts=['scripts/aegean', 'scripts/BANE', 'scripts/SR6', 'scripts/AeRes', 'scripts/MIMAS',
+             'scripts/AeWorker'],
     data_files=[('AegeanTools', [os.path.join(data_dir, 'MOC.fits')]) ],
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'nose']
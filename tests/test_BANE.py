@@ -1,9 +1,13 @@
 #! python
 from __future__ import print_function
 
-from AegeanTools import BANE
+from AegeanTools import BANE, fits_interp
+from AegeanTools.executors import FileQueueExecutor
+from astropy.io import fits
 import numpy as np
 import os
+import shutil
+import tempfile
 
 __author__ = 'Paul Hancock'
 __date__ = '23/08/2017'
@@ -29,6 +33,71 @@ def test_sigmaclip():
         raise AssertionError()
 
 
+def test_box_stats():
+    data = np.random.normal(size=(40, 50)).astype(np.float32)
+    data[0:14, 10:28] = np.nan  # the box at (7, 18) is empty
+    data[20, 20] = 100
+    xvals = [0, 7, 14, 21, 28, 35, 40]
+    yvals = [0, 9, 18, 27, 36, 45, 50]
+    box_size = (9, 12)
+    bkg, rms = BANE.box_stats(data, xvals, yvals, box_size)
+    if not (bkg.shape == (len(xvals), len(yvals))):
+        raise AssertionError()
+
+    # compare with clipping one box at a time
+    for i, x in enumerate(xvals):
+        for j, y in enumerate(yvals):
+            x_min = int(max(0, x - box_size[0] / 2.))
+            x_max = int(min(data.shape[0] - 1, x + box_size[0] / 2.))
+            y_min = int(max(0, y - box_size[1] / 2.))
+            y_max = int(min(data.shape[1] - 1, y + box_size[1] / 2.))
+            clipped = BANE.sigmaclip(data[x_min:x_max, y_min:y_max].ravel(), 3, 3)
+            if len(clipped) < 1:
+                if not (np.isnan(bkg[i, j]) and np.isnan(rms[i, j])):
+                    raise AssertionError()
+                continue
+            if not np.allclose(np.median(clipped), bkg[i, j], rtol=1e-5):
+                raise AssertionError()
+            if not np.allclose(np.std(clipped), rms[i, j], rtol=1e-5):
+                raise AssertionError()
+
+    # no background
+    bkg, rms = BANE.box_stats(data, xvals, yvals, box_size, dobkg=False)
+    if bkg is not None:
+        raise AssertionError()
+
+
+def test_interpolate_grid():
+    xvals = [0, 10, 20, 25]
+    yvals = [0, 5, 10]
+    values = np.arange(12, dtype=np.float64).reshape(4, 3)
+    values[3, 2] = np.nan
+    xpix = np.arange(25)
+    ypix = np.arange(11)
+    bands = list(BANE.interpolate_grid(values, xvals, yvals, xpix, ypix, rows=7))
+    if not [b[0] for b in bands] == [0, 7, 14, 21]:
+        raise AssertionError()
+    img = np.vstack([b[1] for b in bands])
+    if not (img.shape == (25, 11) and img.dtype == np.float32):
+        raise AssertionError()
+    # the grid points are reproduced
+    if not np.allclose(img[::10, ::5], values[:3]):
+        raise AssertionError()
+    # bilinear between grid points
+    if not np.allclose(img[5, 2], 0.5 * (0 * 0.6 + 1 * 0.4) + 0.5 * (3 * 0.6 + 4 * 0.4)):
+        raise AssertionError()
+    # the nan grid point is ignored
+    if not np.all(np.isfinite(img)):
+        raise AssertionError()
+    if not np.allclose(img[24, 10], values[2, 2]):
+        raise AssertionError()
+
+    # no valid grid points gives nan everywhere
+    bands = list(BANE.interpolate_grid(values * np.nan, xvals, yvals, xpix, ypix))
+    if not np.all(np.isnan(bands[0][1])):
+        raise AssertionError()
+
+
 def test_optimum_sections():
     # typical case
     if not BANE.optimum_sections(8, (64, 64)) == (2, 4):
@@ -39,6 +108,61 @@ def test_optimum_sections():
         raise AssertionError()
 
 
+def test_tile_edges():
+    edges = BANE.tile_edges(100, 8, 20, 9)
+    if not (edges[0] == 0 and edges[-1] == 100):
+        raise AssertionError()
+    # tiles are multiples of the step size and no smaller than the box
+    widths = np.diff(edges[:-1])
+    if not (np.all(widths % 8 == 0) and np.all(widths >= 20)):
+        raise AssertionError()
+    # a single tile
+    if not BANE.tile_edges(100, 8, 20, 1) == [0, 100]:
+        raise AssertionError()
+    # limited tiles are rounded down to a multiple of the step size
+    if not BANE.tile_edges(100, 8, 20, 1, max_width=50) == [0, 48, 96, 100]:
+        raise AssertionError()
+    # but are never smaller than the box
+    if not BANE.tile_edges(100, 8, 20, 1, max_width=10)[:2] == [0, 24]:
+        raise AssertionError()
+
+
+def test_count_finite():
+    fname = 'tests/test_files/1904-66_SIN.fits'
+    data = fits.getdata(fname)
+    counts = BANE.count_finite(fname, [0, 50, 192], [0, 100, 150, 192])
+    if not counts.shape == (2, 3):
+        raise AssertionError()
+    if not counts[1, 2] == np.sum(np.isfinite(data[50:192, 150:192])):
+        raise AssertionError()
+    if not counts.sum() == np.sum(np.isfinite(data)):
+        raise AssertionError()
+    # reading fewer rows at a time gives the same counts
+    if not np.all(BANE.count_finite(fname, [0, 50, 192], [0, 100, 150, 192], max_pix=1000) == counts):
+        raise AssertionError()
+
+
+def test_sample_pixels():
+    fname = 'tests/test_files/1904-66_SIN.fits'
+    data = fits.getdata(fname)[:181, :]
+    factor = 10
+    # the same pixels as fits_interp.compress, one tile at a time
+    expected = fits_interp.compress(fits.HDUList([fits.PrimaryHDU(data, header=fits.getheader(fname))]), factor)[0].data
+    if not BANE.compressed_shape(data.shape, factor) == expected.shape:
+        raise AssertionError()
+    result = np.empty(expected.shape, dtype=np.float32)
+    for start, stop in [(0, 80), (80, 181)]:
+        xpix, xout = BANE.sample_pixels(start, stop, data.shape[0], factor)
+        ypix, yout = BANE.sample_pixels(0, data.shape[1], data.shape[1], factor)
+        result[xout:xout + len(xpix), yout:yout + len(ypix)] = data[np.ix_(xpix, ypix)]
+    if not np.all((result == expected) | (np.isnan(result) & np.isnan(expected))):
+        raise AssertionError()
+    # no compression
+    xpix, xout = BANE.sample_pixels(5, 10, 20, None)
+    if not (list(xpix) == [5, 6, 7, 8, 9] and xout == 5):
+        raise AssertionError()
+
+
 def test_mask_data():
     data = np.ones((10, 10), dtype=np.float32)
     mask = data.copy()
@@ -49,6 +173,28 @@ def test_mask_data():
         raise AssertionError()
 
 
+def test_fits_output():
+    fname = 'dlme.fits'
+    header = fits.getheader('tests/test_files/1904-66_SIN.fits')
+    shape = (10, 15)
+    offset = BANE.init_fits_output(fname, header, shape)
+    data = BANE.open_fits_output((fname, offset), shape)
+    data[:] = np.arange(150).reshape(shape)
+    data[3, 4] = np.nan
+    data.flush()
+    del data
+    # the file should be a valid fits file with the data we wrote
+    with fits.open(fname) as hdulist:
+        hdulist.verify('exception')
+        if not hdulist[0].data.shape == shape:
+            raise AssertionError()
+        if not hdulist[0].data[9, 14] == 149:
+            raise AssertionError()
+        if not np.isnan(hdulist[0].data[3, 4]):
+            raise AssertionError()
+    os.remove(fname)
+
+
 def test_filter_image():
     # data = np.random.random((30, 30), dtype=np.float32)
     fname = 'tests/test_files/1904-66_SIN.fits'
@@ -77,6 +223,55 @@ def test_filter_image():
     os.remove(bkg)
 
 
+def test_filter_executor():
+    fname = 'tests/test_files/1904-66_SIN.fits'
+    queue_dir = tempfile.mkdtemp()
+    try:
+        # the tiles are run (by this process) via the queue, and the results written here
+        executor = FileQueueExecutor(queue_dir, poll=0.01)
+        bkg, rms = BANE.filter_image(fname, None, step_size=[10, 10], box_size=[50, 50], cores=2, twopass=True,
+                                     executor=executor)
+    finally:
+        shutil.rmtree(queue_dir)
+    bkg2, rms2 = BANE.filter_image(fname, None, step_size=[10, 10], box_size=[50, 50], cores=1, twopass=True)
+    for a, b in [(bkg, bkg2), (rms, rms2)]:
+        if not np.all((a == b) | (np.isnan(a) & np.isnan(b))):
+            raise AssertionError()
+
+
+def test_filter_cube():
+    fname = 'dlme_cube.fits'
+    outbase = 'dlme'
+    rms = outbase + '_rms.fits'
+    bkg = outbase + '_bkg.fits'
+    hdulist = fits.open('tests/test_files/1904-66_SIN.fits')
+    data = hdulist[0].data
+    # the second plane is a scaled copy of the first
+    cube = np.array([data, 2 * data], dtype=np.float32)
+    fits.PrimaryHDU(cube, header=hdulist[0].header).writeto(fname)
+    BANE.filter_image(fname, step_size=[10, 10], box_size=[50, 50], cores=1, out_base=outbase, cube=True)
+    # a single plane can be filtered on its own
+    planes = BANE.filter_image(fname, None, step_size=[10, 10], box_size=[50, 50], cores=1, plane=1)
+    first = BANE.filter_image(fname, None, step_size=[10, 10], box_size=[50, 50], cores=1, plane=0, twopass=True)
+    second = BANE.filter_image(fname, None, step_size=[10, 10], box_size=[50, 50], cores=1, plane=1, twopass=True)
+    os.remove(fname)
+    for a, b in zip(first, second):
+        if not (a.shape == data.shape and np.allclose(b, 2 * a, rtol=1e-4, equal_nan=True)):
+            raise AssertionError()
+    for out, plane in zip([bkg, rms], planes):
+        result = fits.getdata(out)
+        os.remove(out)
+        if not result.shape == cube.shape:
+            raise AssertionError()
+        if not np.allclose(plane, result[1], equal_nan=True):
+            raise AssertionError()
+        if not np.all(np.isnan(result[0]) == np.isnan(result[1])):
+            raise AssertionError()
+        finite = np.isfinite(result[0])
+        if not np.allclose(result[1][finite], 2 * result[0][finite], rtol=1e-4):
+            raise AssertionError()
+
+
 if __name__ == "__main__":
     # introspect and run all the functions starting with 'test'
     for f in dir():
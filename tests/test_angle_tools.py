@@ -101,6 +101,26 @@ def test_translate_rhumb():
         assert_almost_equal(ans, (ra2, dec2), err_msg="{0:5.2f},{1:5.2f} -> {2:g},{3:g} -> {4:5.2f},{5:5.2f} != {6:g},{7:g}".format(ra1, dec1, r, theta, ra2, dec2, *ans))
 
 
+def test_arrays():
+    # the array versions give the same answers as the scalar versions
+    ra1, dec1 = np.array([0, 0, 120, 12., 45]), np.array([0, -89, 89, -45, 89.75])
+    ra2, dec2 = np.array([0, 180, 300, 12.5, 225]), np.array([1, 89, 89, -44, 89.75])
+    r, theta = np.array([1, 0.5, -1, 2, 0.1]), np.array([0, 30, 180, 270, 45])
+    for func in [at.gcd, at.bear, at.dist_rhumb, at.bear_rhumb]:
+        ans = func(ra1, dec1, ra2, dec2)
+        if not (ans.shape == ra1.shape): raise AssertionError()
+        for i in range(len(ra1)):
+            assert_almost_equal(ans[i], func(ra1[i], dec1[i], ra2[i], dec2[i]))
+    for func in [at.translate, at.translate_rhumb]:
+        ans = func(ra1, dec1, r, theta)
+        for i in range(len(ra1)):
+            assert_almost_equal((ans[0][i], ans[1][i]), func(ra1[i], dec1[i], r[i], theta[i]))
+    # arrays are broadcast
+    dist = at.gcd(ra1[:, np.newaxis], dec1[:, np.newaxis], ra2, dec2)
+    if not (dist.shape == (5, 5)): raise AssertionError()
+    assert_almost_equal(np.diag(dist), at.gcd(ra1, dec1, ra2, dec2))
+
+
 if __name__ == "__main__":
     # introspect and run all the functions starting with 'test'
     for f in dir():
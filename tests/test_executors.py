@@ -0,0 +1,142 @@
+#! python
+from __future__ import print_function
+
+from AegeanTools import executors
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+__author__ = 'Paul Hancock'
+
+_offset = 0
+
+
+def _init(offset):
+    global _offset
+    _offset = offset
+
+
+def _add(x):
+    return x + _offset
+
+
+def _fail(x):
+    raise ValueError("bad task {0}".format(x))
+
+
+def test_local_executor():
+    for cores in [1, 2]:
+        ex = executors.LocalExecutor(cores=cores)
+        result = list(ex.map(_add, range(10), initializer=_init, initargs=(5,)))
+        if not result == list(range(5, 15)):
+            raise AssertionError()
+        if not sorted(ex.map(_add, range(10), initializer=_init, initargs=(1,), ordered=False)) == list(range(1, 11)):
+            raise AssertionError()
+
+
+def test_file_queue_executor():
+    queue_dir = tempfile.mkdtemp()
+    try:
+        # with no other workers this process does all of the tasks
+        ex = executors.FileQueueExecutor(queue_dir, poll=0.01)
+        result = list(ex.map(_add, range(10), initializer=_init, initargs=(5,)))
+        if not result == list(range(5, 15)):
+            raise AssertionError()
+        if not sorted(ex.map(_add, range(10), initializer=_init, initargs=(1,), ordered=False)) == list(range(1, 11)):
+            raise AssertionError()
+        # failed tasks are reported here
+        try:
+            list(ex.map(_fail, range(3)))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError()
+
+        # now with a separate worker doing all of the tasks
+        worker = multiprocessing.Process(target=executors.run_worker, args=(queue_dir, 0.01, 2))
+        worker.start()
+        ex = executors.FileQueueExecutor(queue_dir, poll=0.01, work=False)
+        result = list(ex.map(_add, range(10), initializer=_init, initargs=(3,)))
+        worker.join()
+        if not result == list(range(3, 13)):
+            raise AssertionError()
+    finally:
+        shutil.rmtree(queue_dir)
+
+
+def test_file_queue_lazy():
+    queue_dir = tempfile.mkdtemp()
+    consumed = []
+
+    def tasks():
+        for i in range(10):
+            consumed.append(i)
+            yield i
+
+    try:
+        ex = executors.FileQueueExecutor(queue_dir, poll=0.01, max_queued=3)
+        results = ex.map(_add, tasks(), initializer=_init, initargs=(0,))
+        if not next(results) == 0:
+            raise AssertionError()
+        # only a few tasks are queued before the first result is collected
+        if not len(consumed) == 3:
+            raise AssertionError()
+        if not list(results) == list(range(1, 10)):
+            raise AssertionError()
+    finally:
+        shutil.rmtree(queue_dir)
+
+
+def test_file_queue_timeout():
+    queue_dir = tempfile.mkdtemp()
+    try:
+        ex = executors.FileQueueExecutor(queue_dir, poll=0.01, timeout=0.1)
+        tasks = ex.map(_add, range(2), initializer=_init, initargs=(0,))
+        # the first result is found by running the first task
+        if not next(tasks) == 0:
+            raise AssertionError()
+        # pretend that a worker claimed the second task and then died
+        job = [d for d in os.listdir(queue_dir) if d.startswith('job_')][0]
+        job_dir = os.path.join(queue_dir, job)
+        name = executors._task_name(1)
+        os.rename(os.path.join(job_dir, 'todo', name), os.path.join(job_dir, 'claimed', name + '@deadworker'))
+        if not list(tasks) == [1]:
+            raise AssertionError()
+    finally:
+        shutil.rmtree(queue_dir)
+
+
+def test_file_queue_lost_claim():
+    queue_dir = tempfile.mkdtemp()
+    read_pickle = executors._read_pickle
+    requeued = []
+
+    def requeue_then_read(filename):
+        # pretend that the task timed out and was put back in the queue just after it was claimed
+        claimed, name = os.path.split(filename)
+        if os.path.basename(claimed) == 'claimed' and not requeued:
+            requeued.append(name)
+            os.rename(filename, os.path.join(os.path.dirname(claimed), 'todo', name.split('@')[0]))
+        return read_pickle(filename)
+
+    executors._read_pickle = requeue_then_read
+    try:
+        ex = executors.FileQueueExecutor(queue_dir, poll=0.01)
+        # the lost claim is not reported as a failure, and the task is run again
+        if not list(ex.map(_add, range(3), initializer=_init, initargs=(5,))) == [5, 6, 7]:
+            raise AssertionError()
+        # claims are named after the worker that made them
+        if not requeued[0].split('@')[1] == executors._worker_name():
+            raise AssertionError()
+    finally:
+        executors._read_pickle = read_pickle
+        shutil.rmtree(queue_dir)
+
+
+if __name__ == "__main__":
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
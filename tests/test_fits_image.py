@@ -114,6 +114,37 @@ def test_init():
     assert_raises(Exception, fi.FitsImage, hdu)
 
 
+def test_lazy_image():
+    pixels = np.arange(12, dtype='>f4').reshape(3, 4)
+    pixels[0, 0] = np.inf
+    bkg = np.ones((3, 4))
+    im = fi.LazyImage(pixels, bkg=bkg)
+    if not (im.shape == (3, 4)): raise AssertionError()
+    if not (im.dtype == np.float64): raise AssertionError()
+    # inf -> nan and the background is subtracted as the pixels are read
+    if not np.isnan(im[0, 0]): raise AssertionError()
+    if not (im[1, 2] == 5): raise AssertionError()
+    assert_array_almost_equal(im[1:], pixels[1:] - 1)
+    # the underlying data are not changed by reading
+    if not np.isinf(pixels[0, 0]): raise AssertionError()
+    # values that are set are returned when read
+    im[2, 3] = np.nan
+    if not np.isnan(im[2, 3]): raise AssertionError()
+    if not (np.isnan(np.array(im)).sum() == 2): raise AssertionError()
+
+    # background must be the same shape as the image
+    assert_raises(AssertionError, fi.LazyImage, pixels, np.ones((2, 2)))
+
+
+def test_lazy_init():
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    im = fi.FitsImage(filename)
+    lazy = fi.FitsImage(filename, lazy=True)
+    if not isinstance(lazy.get_pixels(), fi.LazyImage): raise AssertionError()
+    if not (lazy.get_pixels().shape == im.get_pixels().shape): raise AssertionError()
+    assert_array_almost_equal(np.array(lazy.get_pixels()), im.get_pixels())
+
+
 def test_get_background_rms():
     filename = 'tests/test_files/1904-66_SIN.fits'
     hdu = fits.open(filename)
@@ -5,6 +5,7 @@ __author__ = 'Paul Hancock'
 __date__ = ''
 
 from AegeanTools import fitting, models
+import copy
 import lmfit
 import numpy as np
 
@@ -35,6 +36,58 @@ def test_CandBmatrix():
     if np.any(np.isnan(C)): raise AssertionError()
     B = fitting.Bmatrix(C)
     if np.any(np.isnan(B)): raise AssertionError()
+    # each row is a gaussian centered on one pixel
+    for n, (i, j) in enumerate(zip(x, y)):
+        row = fitting.elliptical_gaussian(x, y, 1, i, j, sx=1, sy=2, theta=30)
+        if not np.allclose(fitting.Cmatrix(x, y, sx=1, sy=2, theta=30)[n], row): raise AssertionError()
+
+
+def test_CBmatrix():
+    x, y = map(np.ravel, np.indices((3, 3)))
+    C, B = fitting.CBmatrix(x, y, sx=1, sy=2, theta=0)
+    if not np.allclose(C, fitting.Cmatrix(x, y, sx=1, sy=2, theta=0), atol=1e-2): raise AssertionError()
+    if not np.allclose(B, fitting.Bmatrix(C)): raise AssertionError()
+    # the same pattern elsewhere in the image reuses the cached matrices
+    C2, B2 = fitting.CBmatrix(x + 10, y + 5, sx=1, sy=2, theta=0)
+    if not (C2 is C and B2 is B): raise AssertionError()
+    # as does a slightly different beam
+    C2, B2 = fitting.CBmatrix(x, y, sx=1.001, sy=1.999, theta=0.1)
+    if not (C2 is C and B2 is B): raise AssertionError()
+    # a different beam does not
+    C3, _ = fitting.CBmatrix(x, y, sx=2, sy=2, theta=0)
+    if C3 is C: raise AssertionError()
+
+    # large islands are split into independent bands
+    x, y = map(np.ravel, np.indices((30, 30)))
+    C, B = fitting.CBmatrix(x, y, sx=1, sy=2, theta=0)
+    n = fitting.MAX_CORRELATED_PIX
+    if not (C.shape == B.shape == (900, 900)): raise AssertionError()
+    if not np.all(C[:n, n:] == 0): raise AssertionError()
+    if not np.allclose(C[:n, :n], fitting.Cmatrix(x[:n], y[:n], sx=1, sy=2, theta=0), atol=1e-2):
+        raise AssertionError()
+    if not np.allclose(B[:n, :n], fitting.Bmatrix(C[:n, :n])): raise AssertionError()
+
+
+def test_Binverse_dot():
+    x, y = map(np.ravel, np.indices((4, 4)))
+    C = fitting.Cmatrix(x, y, sx=1, sy=2, theta=0)
+    B = fitting.Bmatrix(C)
+    r = np.random.random(len(x))
+    if not np.allclose(fitting.Binverse_dot(r.dot(B), B), r): raise AssertionError()
+    if not np.allclose(fitting.Binverse_dot(r, B), r.dot(np.linalg.inv(B))): raise AssertionError()
+
+
+def test_covar_errors():
+    x, y = np.indices((10, 10))
+    model = make_model()
+    data = fitting.ntwodgaussian_lmfit(model)(x, y)
+    C, B = fitting.CBmatrix(x.ravel(), y.ravel(), sx=1, sy=1, theta=0)
+    # the errors are the same with B, or with C alone
+    err_b = fitting.covar_errors(copy.deepcopy(model), data, errs=0.1, B=B, C=C)
+    err_c = fitting.covar_errors(copy.deepcopy(model), data, errs=0.1, B=None, C=C + 1e-6 * np.eye(100))
+    for p in ['c0_amp', 'c0_xo', 'c0_yo']:
+        if not (err_b[p].stderr > 0): raise AssertionError()
+        if not np.isclose(err_b[p].stderr, err_c[p].stderr, rtol=0.1): raise AssertionError()
 
 
 def test_hessian_shape():
@@ -126,6 +179,136 @@ def test_emp_vs_ana_jacobian():
     if not (np.max(diff) < 1e-3): raise AssertionError()
 
 
+def test_model_jacobian():
+    model = make_model()
+    model.add('c1_amp', 2, vary=True)
+    model.add('c1_xo', 3, vary=True)
+    model.add('c1_yo', 6, vary=True)
+    model.add('c1_sx', 3, vary=True)
+    model.add('c1_sy', 2, vary=True)
+    model.add('c1_theta', 30, vary=True)
+    model['components'].value = 2
+    x, y = map(np.ravel, np.indices((10, 10)))
+    values, vary, lower, upper = fitting.params_to_arrays(model)
+    if not (list(vary) == [True] * 3 + [False] * 3 + [True] * 6): raise AssertionError()
+    m, jac = fitting.model_jacobian(values, x, y)
+    if not np.allclose(m, fitting.ntwodgaussian_lmfit(model)(x, y)): raise AssertionError()
+    if not np.allclose(jac[vary], fitting.jacobian(model, x, y)): raise AssertionError()
+    # a buffer is reused
+    m2, jac2 = fitting.model_jacobian(values, x, y, out=jac)
+    if not np.shares_memory(jac, jac2): raise AssertionError()
+    if not np.allclose(m2, m): raise AssertionError()
+    # the derivative with respect to theta is per degree, as are the empirical derivatives
+    diff = np.abs(fitting.emp_jacobian(model, x, y) - jac[vary])
+    if not (np.max(diff) < 1e-3): raise AssertionError()
+    # and the hessian of a rotated component
+    model = lmfit.Parameters()
+    for p, v in zip(fitting.COMPONENT_PARAMS, [1, 5, 4.6, 3, 1.5, 30]):
+        model.add('c0_' + p, v, vary=True)
+    model.add('components', 1, vary=False)
+    x, y = np.indices((10, 10))
+    diff = np.abs(fitting.emp_hessian(model, x, y) - fitting.hessian(model, x, y))
+    if not (np.max(diff) < 1e-3): raise AssertionError()
+
+
+def test_do_lmfit_theta():
+    # the fitted rotation angle converges, rather than stalling near the initial guess
+    x, y = np.indices((15, 15))
+    data = fitting.elliptical_gaussian(x, y, 1, 7, 7.2, 3, 1.5, 30)
+    model = make_model()
+    model['c0_xo'].value, model['c0_yo'].value = 7, 7
+    for p, v in [('sx', 2.5), ('sy', 1.8), ('theta', 20)]:
+        model['c0_' + p].set(value=v, vary=True)
+    result, _ = fitting.do_lmfit(data, model)
+    if not np.isclose(result.params['c0_theta'].value, 30, atol=1e-3): raise AssertionError()
+
+
+def test_do_arrayfit():
+    model = make_model()
+    x, y = np.indices((10, 10))
+    data = fitting.ntwodgaussian_lmfit(model)(x, y)
+    data[0, 0] = np.nan
+    model['c0_amp'].value = 0.8
+    model['c0_xo'].value = 5.3
+    model['c0_yo'].value = 4.6
+    result, _ = fitting.do_arrayfit(data, model)
+    if not result.success: raise AssertionError()
+    if not np.isclose(result.params['c0_amp'].value, 1): raise AssertionError()
+    if not np.isclose(result.params['c0_xo'].value, 5): raise AssertionError()
+    if not np.isclose(result.params['c0_yo'].value, 5): raise AssertionError()
+    if not (len(result.residual) == 99): raise AssertionError()
+    # the initial model is not changed
+    if not (model['c0_amp'].value == 0.8): raise AssertionError()
+
+    # parameters stay within their bounds
+    model['c0_amp'].max = 0.9
+    result, _ = fitting.do_arrayfit(data, model)
+    if not (result.params['c0_amp'].value <= 0.9): raise AssertionError()
+
+    # with a B matrix the residual is returned as (model - data)
+    mx, my = np.where(np.isfinite(data))
+    C, B = fitting.CBmatrix(mx, my, sx=1, sy=1, theta=0)
+    result, _ = fitting.do_arrayfit(data, make_model(), B=B)
+    if not np.allclose(result.residual, 0, atol=1e-6): raise AssertionError()
+
+    # the fit and the errors (theta in degrees) are the same as those from lmfit
+    np.random.seed(1)
+    x, y = np.indices((15, 15))
+    data = fitting.elliptical_gaussian(x, y, 1, 7, 7.2, 3, 1.5, 30) + np.random.normal(0, 0.05, x.shape)
+    model = make_model()
+    model['c0_xo'].set(value=7, min=3, max=11)
+    model['c0_yo'].set(value=7, min=3, max=11)
+    for p, v in [('sx', 2.5), ('sy', 1.8), ('theta', 20)]:
+        model['c0_' + p].set(value=v, vary=True)
+    result, _ = fitting.do_arrayfit(data, model)
+    expected, _ = fitting.do_lmfit(data, model)
+    if not result.errorbars: raise AssertionError()
+    for p in fitting.COMPONENT_PARAMS:
+        name = 'c0_' + p
+        if not np.isclose(result.params[name].value, expected.params[name].value, rtol=1e-4): raise AssertionError()
+        if not np.isclose(result.params[name].stderr, expected.params[name].stderr, rtol=1e-3): raise AssertionError()
+    if not np.allclose(result.covar, expected.covar, rtol=1e-3): raise AssertionError()
+
+
+def test_do_batchfit():
+    x, y = np.indices((10, 10))
+    datas, models = [], []
+    for amp, xo, yo in [(1, 5, 5), (2, 4, 6), (0.5, 5.5, 4.5)]:
+        model = make_model()
+        model['c0_amp'].value = amp
+        model['c0_xo'].value = xo
+        model['c0_yo'].value = yo
+        datas.append(fitting.ntwodgaussian_lmfit(model)(x, y))
+        models.append(make_model())
+    # islands can have different numbers of pixels
+    datas[1][:2] = np.nan
+    results = fitting.do_batchfit(datas, models)
+    if not (len(results) == 3): raise AssertionError()
+    for data, model, result in zip(datas, models, results):
+        single, _ = fitting.do_arrayfit(data, model)
+        if result is None: raise AssertionError()
+        if not result.success: raise AssertionError()
+        if not (len(result.residual) == np.sum(np.isfinite(data))): raise AssertionError()
+        for p in ['c0_amp', 'c0_xo', 'c0_yo']:
+            if not np.isclose(result.params[p].value, single.params[p].value, rtol=1e-4): raise AssertionError()
+    if not (fitting.do_batchfit([], []) == []): raise AssertionError()
+    # islands that have not converged are left for the regular fitter, the first one starts at the answer
+    results = fitting.do_batchfit(datas, models, maxfev=2)
+    if results[0] is None: raise AssertionError()
+    if not (results[1] is None and results[2] is None): raise AssertionError()
+
+    # the errors are in the same units as those of do_arrayfit
+    np.random.seed(1)
+    data = datas[0] + np.random.normal(0, 0.05, datas[0].shape)
+    model = make_model()
+    model['c0_theta'].vary = True
+    model['c0_sx'].set(value=2.5, vary=True)
+    result = fitting.do_batchfit([data], [model])[0]
+    single, _ = fitting.do_arrayfit(data, model)
+    for p in ['c0_amp', 'c0_xo', 'c0_yo', 'c0_sx', 'c0_theta']:
+        if not np.isclose(result.params[p].stderr, single.params[p].stderr, rtol=1e-2): raise AssertionError()
+
+
 def test_emp_vs_ana_hessian():
     model = lmfit.Parameters()
     model.add('c0_amp', 1, vary=True)
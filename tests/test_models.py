@@ -4,7 +4,12 @@ __author__ = 'Paul Hancock'
 __date__ = ''
 
 from AegeanTools import models
+from AegeanTools.fits_image import LazyImage
 import numpy as np
+import os
+import pickle
+import shutil
+import tempfile
 
 
 def test_simple_source():
@@ -44,6 +49,50 @@ def test_global_fitting_data():
     models.GlobalFittingData()
 
 
+def test_global_fitting_data_memmap():
+    gd = models.GlobalFittingData()
+    gd.data_pix = np.arange(12, dtype=np.float32).reshape(3, 4)
+    gd.rmsimg = np.ones((3, 4))
+    gd.regionmask = np.ones((3, 4), dtype=bool)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shared = gd.memmap_planes(tmpdir)
+        if not (isinstance(shared.data_pix, np.memmap)): raise AssertionError()
+        if shared.bkgimg is not None: raise AssertionError()
+        # the region mask is only needed by this process
+        if shared.regionmask is not None: raise AssertionError()
+        if not (sorted(os.listdir(tmpdir)) == ['data_pix.dat', 'rmsimg.dat']): raise AssertionError()
+        # the planes should be pickled as a reference to their file
+        state = shared.__getstate__()
+        if not (isinstance(state['data_pix'], models.MemmapPlane)): raise AssertionError()
+        gd2 = pickle.loads(pickle.dumps(shared))
+        if not (isinstance(gd2.rmsimg, np.memmap)): raise AssertionError()
+        if not (np.all(gd2.data_pix == gd.data_pix)): raise AssertionError()
+        if not (gd2.rmsimg.dtype == np.float64): raise AssertionError()
+        del shared, gd2, state
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_global_fitting_data_memmap_unsubtracted():
+    gd = models.GlobalFittingData()
+    gd.bkgimg = np.ones((3, 4), dtype=np.float32)
+    gd.data_pix = LazyImage(np.arange(12, dtype=np.float32).reshape(3, 4), bkg=gd.bkgimg)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shared = gd.memmap_planes(tmpdir)
+        # the pixels are shared before the background is subtracted
+        if not (isinstance(shared.data_pix, LazyImage)): raise AssertionError()
+        if not (np.all(shared.data_pix.pixels == gd.data_pix.pixels)): raise AssertionError()
+        gd2 = pickle.loads(pickle.dumps(shared))
+        if not (isinstance(gd2.data_pix.pixels, np.memmap)): raise AssertionError()
+        if not (gd2.data_pix.bkg is gd2.bkgimg): raise AssertionError()
+        if not (np.all(gd2.data_pix[:, :] == gd.data_pix[:, :])): raise AssertionError()
+        del shared, gd2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def test_island_fitting_data():
     models.IslandFittingData()
 
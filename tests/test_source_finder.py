@@ -3,11 +3,17 @@ __author__ = 'Paul Hancock'
 __date__ = ''
 
 from AegeanTools import source_finder as sf
+from AegeanTools.executors import FileQueueExecutor
+from AegeanTools.fits_image import LazyImage
+from astropy.io import fits
 from copy import deepcopy
+from scipy.ndimage import maximum_filter, minimum_filter
 import numpy as np
 import logging
 import os
-import six
+import shutil
+import tempfile
+import threading
 
 logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
 log = logging.getLogger("Aegean")
@@ -63,6 +69,13 @@ def test_load_globals():
     sfinder.load_globals(filename, bkgin=aux_files['bkg'], rms=1, mask=aux_files['mask'])
     # region isn't available due to healpy not being installed/required
     if sfinder.global_data.region is None: raise AssertionError()
+    # the background is subtracted as the pixels are read
+    data = sfinder.global_data.data_pix
+    if not isinstance(data, LazyImage): raise AssertionError()
+    raw = np.squeeze(fits.getdata(filename))[:10, :10]
+    bkg = np.squeeze(fits.getdata(aux_files['bkg']))[:10, :10]
+    if not np.allclose(data[:10, :10], raw - bkg, equal_nan=True): raise AssertionError()
+    if not (np.all(sfinder.global_data.rmsimg == 1)): raise AssertionError()
 
     del sfinder
     sfinder = sf.SourceFinder(log=log)
@@ -79,6 +92,172 @@ def test_load_globals():
     if sfinder.global_data.region is None: raise AssertionError()
 
 
+def test_get_curvature():
+    log = logging.getLogger("Aegean")
+    sfinder = sf.SourceFinder(log=log)
+    sfinder.load_globals('tests/test_files/1904-66_SIN.fits')
+    if sfinder.global_data.dcurve is not None: raise AssertionError()
+    nx, ny = sfinder.global_data.data_pix.shape
+    # the curvature of the image before the background is subtracted
+    raw = np.squeeze(fits.getdata('tests/test_files/1904-66_SIN.fits'))
+    curve = np.zeros(raw.shape, dtype=np.int8)
+    curve[raw == maximum_filter(raw, size=3)] = -1
+    curve[raw == minimum_filter(raw, size=3)] = 1
+    # any box gives the same result as the whole image, including boxes at the edges and next to nans
+    for xmin, xmax, ymin, ymax in [(0, 10, 0, 10), (80, 100, 90, 120), (nx - 5, nx, 30, ny), (20, 21, 40, 41)]:
+        sfinder.global_data.dcurve = None
+        box = sfinder._get_curvature(xmin, xmax, ymin, ymax)
+        if not (box.dtype == np.int8 and np.all(box == curve[xmin:xmax, ymin:ymax])): raise AssertionError()
+    # the curvature of the whole image is kept once it has been needed
+    if not (np.all(sfinder.global_data.dcurve == curve)): raise AssertionError()
+    # a precomputed map is used instead
+    sfinder.global_data.dcurve = np.ones((nx, ny), dtype=np.int8)
+    if not (np.all(sfinder._get_curvature(0, 10, 0, 10) == 1)): raise AssertionError()
+
+    # an image with many blank pixels
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(200, 200))
+    data[rng.random_sample(data.shape) < 0.02] = np.nan
+    curve = np.zeros(data.shape, dtype=np.int8)
+    curve[data == maximum_filter(data, size=3)] = -1
+    curve[data == minimum_filter(data, size=3)] = 1
+    sfinder = sf.SourceFinder(log=log)
+    sfinder.global_data.data_pix = data
+    for _ in range(200):
+        sfinder.global_data.dcurve = None
+        xmin, ymin = rng.randint(0, 195, size=2)
+        xmax, ymax = xmin + rng.randint(1, 6), ymin + rng.randint(1, 6)
+        if not (np.all(sfinder._get_curvature(xmin, xmax, ymin, ymax) == curve[xmin:xmax, ymin:ymax])):
+            raise AssertionError()
+
+
+def test_region_mask():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    region = 'tests/test_files/1904-66_SIN.mim'
+    cache_dir = tempfile.mkdtemp()
+    try:
+        sfinder = sf.SourceFinder(log=log)
+        sfinder.load_globals(filename, rms=1, mask=region, do_curve=False)
+        mask = sfinder.global_data.regionmask
+        if not (mask.shape == sfinder.global_data.data_pix.shape): raise AssertionError()
+        if not (0 < np.sum(mask) < mask.size): raise AssertionError()
+        # the mask agrees with the region
+        ra, dec = sfinder.global_data.wcshelper.wcs.wcs_pix2world([[100, 90], [0, 0]], 0).transpose()
+        within = sfinder.global_data.region.sky_within(ra, dec, degin=True)
+        if not (mask[90, 100] == within[0] and mask[0, 0] == within[1]): raise AssertionError()
+        # nothing is cached unless asked for
+        if os.path.exists('tests/test_files/1904-66_SIN_mask.npz'): raise AssertionError()
+        # the mask is cached, and reused
+        sfinder = sf.SourceFinder(log=log)
+        sfinder.load_globals(filename, rms=1, mask=region, do_curve=False, mask_cache=cache_dir)
+        if not (np.all(sfinder.global_data.regionmask == mask)): raise AssertionError()
+        cached = os.listdir(cache_dir)
+        if not (len(cached) == 1): raise AssertionError()
+        sfinder = sf.SourceFinder(log=log)
+        sfinder.load_globals(filename, rms=1, mask=region, do_curve=False, mask_cache=cache_dir)
+        if not (np.all(sfinder.global_data.regionmask == mask)): raise AssertionError()
+        if not (os.listdir(cache_dir) == cached): raise AssertionError()
+        # the slice is part of the key
+        sfinder = sf.SourceFinder(log=log)
+        sfinder.load_globals(filename, rms=1, mask=region, do_curve=False, mask_cache=cache_dir, slice=0)
+        if not (np.all(sfinder.global_data.regionmask == mask)): raise AssertionError()
+        if not (len(os.listdir(cache_dir)) == 2): raise AssertionError()
+        # a region object is not cached
+        from AegeanTools.regions import Region
+        sfinder = sf.SourceFinder(log=log)
+        sfinder.load_globals(filename, rms=1, mask=Region(), do_curve=False, mask_cache=cache_dir)
+        if not (len(os.listdir(cache_dir)) == 2): raise AssertionError()
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_gen_flood_wrap_rows():
+    log = logging.getLogger("Aegean")
+    sfinder = sf.SourceFinder(log=log)
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    sfinder.load_globals(filename)
+    data = sfinder.global_data.data_pix
+    rmsimg = sfinder.global_data.rmsimg
+    islands = list(sfinder._gen_flood_wrap(data, rmsimg, 5, 4))
+    # segmenting in bands gives the same islands in the same order
+    for rows in [1, 10, 50]:
+        banded = list(sfinder._gen_flood_wrap(data, rmsimg, 5, 4, rows=rows))
+        if not (len(banded) == len(islands)): raise AssertionError()
+        for a, b in zip(islands, banded):
+            if not (a[1:] == b[1:]): raise AssertionError()
+            if not (np.all(np.isnan(a[0]) == np.isnan(b[0]))): raise AssertionError()
+
+
+def test_gen_flood_wrap_seeds():
+    log = logging.getLogger("Aegean")
+    sfinder = sf.SourceFinder(log=log)
+    data = np.zeros((10, 10), dtype=np.float32)
+    rms = np.ones_like(data)
+    # a seeded island, and an unseeded island that is within its bounding box
+    data[1:8, 1] = 10
+    data[1, 1:8] = 10
+    data[4, 4] = 4
+    islands = list(sfinder._gen_flood_wrap(data, rms, 5, 3))
+    if not (len(islands) == 1): raise AssertionError()
+    box, xmin, xmax, ymin, ymax = islands[0]
+    if not ((xmin, xmax, ymin, ymax) == (1, 8, 1, 8)): raise AssertionError()
+    # only the pixels of the seeded island are unmasked
+    if not (np.sum(np.isfinite(box)) == 13): raise AssertionError()
+
+
+def test_extract_island():
+    log = logging.getLogger("Aegean")
+    sfinder = sf.SourceFinder(log=log)
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    sfinder.load_globals(filename)
+    data = sfinder.global_data.data_pix
+    rmsimg = sfinder.global_data.rmsimg
+    for i, xmin, xmax, ymin, ymax in sfinder._gen_flood_wrap(data, rmsimg, 5, 4):
+        seed = tuple(np.argwhere(np.isfinite(i))[0])
+        isle = sf.IslandFittingData(0, None, (5, 4, None), (xmin, xmax, ymin, ymax), seed=seed)
+        isle_pix = sfinder._extract_island(isle)
+        # the reconstructed island should be identical to the flooded island
+        if not (np.all(np.isnan(isle_pix) == np.isnan(i))): raise AssertionError()
+        if not (np.all(isle_pix[np.isfinite(i)] == i[np.isfinite(i)])): raise AssertionError()
+
+
+def test_schedule_islands():
+    # a single pixel island, and an island with two summits
+    single = np.full((3, 3), np.nan)
+    single[1, 1] = 10
+    double = np.array([[10, 5, 5, 10]], dtype=float)
+    rms = np.ones((3, 3))
+    if not (sf._island_cost(single, rms, 5) == 1): raise AssertionError()
+    if not (sf._island_cost(double, np.ones((1, 4)), 5) == 16): raise AssertionError()
+    if not (sf._island_cost(double, np.ones((1, 4)), 5, max_summits=1) == 4): raise AssertionError()
+
+    costs = [1, 100, 2, 1, 50, 1, 1, 3]
+    islands = list(range(len(costs)))
+    groups = sf._schedule_islands(islands, costs, 2)
+    # every island is scheduled once, and the most expensive are first
+    if not (sorted(sum(groups, [])) == islands): raise AssertionError()
+    if not (groups[0] == [1]): raise AssertionError()
+    # the last groups are single islands
+    if not (len(groups[-1]) == 1): raise AssertionError()
+
+    # islands are scheduled within windows, which are consumed lazily
+    consumed = []
+
+    def island_costs():
+        for island, cost in zip(islands, costs):
+            consumed.append(island)
+            yield island, cost
+
+    windows = sf._schedule_windows(island_costs(), 2, window=4)
+    first = next(windows)
+    if not (first == [1] and len(consumed) == 4): raise AssertionError()
+    order = sum([first] + list(windows), [])
+    # every island is scheduled once, and the first window is scheduled before the second
+    if not (sorted(order) == islands): raise AssertionError()
+    if not (sorted(order[:4]) == [0, 1, 2, 3]): raise AssertionError()
+
+
 def test_find_and_prior_sources():
     log = logging.getLogger("Aegean")
     sfinder = sf.SourceFinder(log=log)
@@ -99,11 +278,7 @@ def test_find_and_prior_sources():
     if not (os.path.exists('dlme')): raise AssertionError()
     os.remove('dlme')
 
-    # pprocess is broken in python3 at the moment so just use 1 core.
-    if six.PY3:
-        cores = 1
-    else:
-        cores = 2
+    cores = 2
     # this should find one less source as one of the source centers is outside the image.
     priorized = sfinder.priorized_fit_islands(filename, catalogue=found, doregroup=False, ratio=1.2, cores=cores, docov=False)
     if not (len(priorized) == 2): raise AssertionError()
@@ -116,6 +291,115 @@ def test_find_and_prior_sources():
     os.remove('dlme')
 
 
+def test_find_sources_count():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    found = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    if not (len(found) == 65): raise AssertionError()
+    # the workers see the same image data
+    found2 = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=2)
+    if not (all(str(a) == str(b) for a, b in zip(found, found2))): raise AssertionError()
+    if not (len(found) == len(found2)): raise AssertionError()
+
+
+def test_find_with_arrayfit():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    found = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    found2 = sf.SourceFinder(log=log, fitter='array').find_sources_in_image(filename, cores=1)
+    # both fitters find the same sources
+    if not (len(found) == len(found2)): raise AssertionError()
+    for a, b in zip(found, found2):
+        if not (a.island == b.island and a.source == b.source): raise AssertionError()
+        if not np.isclose(a.peak_flux, b.peak_flux, rtol=1e-2): raise AssertionError()
+
+
+def test_find_with_batchfit():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    found = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    found2 = sf.SourceFinder(log=log, batch_fit=True).find_sources_in_image(filename, cores=1)
+    if not (len(found) == len(found2)): raise AssertionError()
+    for a, b in zip(found, found2):
+        if not (a.island == b.island and a.source == b.source): raise AssertionError()
+        if not np.isclose(a.peak_flux, b.peak_flux, rtol=1e-2): raise AssertionError()
+
+
+def test_find_sources_with_bane():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    sfinder = sf.SourceFinder(log=log)
+    found = sfinder.find_sources_with_bane(filename, step_size=(10, 10), box_size=(50, 50), bane_out='dlme', cores=1)
+    if not (len(found) > 0): raise AssertionError()
+    # the same sources are found when the background and noise are loaded from the files
+    sfinder = sf.SourceFinder(log=log)
+    found2 = sfinder.find_sources_in_image(filename, bkgin='dlme_bkg.fits', rmsin='dlme_rms.fits', cores=1)
+    os.remove('dlme_bkg.fits')
+    os.remove('dlme_rms.fits')
+    if not (len(found) == len(found2)): raise AssertionError()
+    if not (all(a.peak_flux == b.peak_flux for a, b in zip(found, found2))): raise AssertionError()
+    # only the requested slice of a cube is filtered
+    cube = 'tests/test_files/1904-66_SIN_cube.fits'
+    sfinder = sf.SourceFinder(log=log)
+    found = sfinder.find_sources_with_bane(cube, step_size=(10, 10), box_size=(50, 50), bane_out='dlme', cores=1,
+                                           slice=3)
+    bkg = fits.getdata('dlme_bkg.fits')
+    os.remove('dlme_bkg.fits')
+    os.remove('dlme_rms.fits')
+    if not (bkg.shape == (192, 192)): raise AssertionError()
+    if not (len(found) > 0): raise AssertionError()
+
+
+def test_find_with_executor():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    found = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    queue_dir = tempfile.mkdtemp()
+    try:
+        # the tasks are pickled, and so must not include a logger that holds a lock
+        locked_log = logging.LoggerAdapter(log, {'lock': threading.Lock()})
+        sfinder = sf.SourceFinder(log=locked_log, executor=FileQueueExecutor(queue_dir, poll=0.01))
+        found2 = sfinder.find_sources_in_image(filename, cores=1)
+        if not (sfinder.log is locked_log): raise AssertionError()
+    finally:
+        shutil.rmtree(queue_dir)
+    # the results are merged in island order
+    if not (len(found) == len(found2)): raise AssertionError()
+    if not (all(str(a) == str(b) for a, b in zip(found, found2))): raise AssertionError()
+
+
+def test_find_parallel_streams():
+    log = logging.getLogger("Aegean")
+    filename = 'tests/test_files/1904-66_SIN.fits'
+    found = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    sfinder = sf.SourceFinder(log=log)
+    # count the groups of islands that have been fit when each line is written
+    received = [0]
+    parallel_map = sfinder._parallel_map
+
+    def counting_map(*args, **kwargs):
+        for result in parallel_map(*args, **kwargs):
+            received[0] += 1
+            yield result
+    sfinder._parallel_map = counting_map
+
+    class Recorder(object):
+        lines = []
+
+        def write(self, line):
+            self.lines.append((line, received[0]))
+    window = sf.SCHEDULE_WINDOW
+    try:
+        sf.SCHEDULE_WINDOW = 1
+        found2 = sfinder.find_sources_in_image(filename, cores=2, outfile=Recorder())
+    finally:
+        sf.SCHEDULE_WINDOW = window
+    # the sources are in island order, and are written before all of the islands have been fit
+    if not (all(str(a) == str(b) for a, b in zip(found, found2))): raise AssertionError()
+    written = [n for line, n in Recorder.lines if line.strip() == str(found2[0])]
+    if not (written and written[0] < received[0]): raise AssertionError()
+
+
 def test_find_and_prior_parallel():
     log = logging.getLogger("Aegean")
     cores = sf.check_cores(2)
@@ -126,7 +410,10 @@ def test_find_and_prior_parallel():
     # vanilla source finding
     sfinder = sf.SourceFinder(log=log)
     found = sfinder.find_sources_in_image(filename, cores=cores)
-    if not (len(found) == 68): raise AssertionError()
+    # parallel fitting should give exactly the same result as serial fitting
+    serial = sf.SourceFinder(log=log).find_sources_in_image(filename, cores=1)
+    if not (len(found) == len(serial)): raise AssertionError()
+    if not ([str(s) for s in found] == [str(s) for s in serial]): raise AssertionError()
     # now with some options
     aux_files = sf.get_aux_files(filename)
 
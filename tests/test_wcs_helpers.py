@@ -107,6 +107,50 @@ def test_ellipse_round_trip():
         if not (abs(pa-pa_f) < 1): raise AssertionError()
 
 
+def test_array_conversions():
+    """
+    The array versions of the conversions should agree with the scalar versions.
+    """
+    fname = 'tests/test_files/1904-66_SIN.fits'
+    helper = WCSHelper.from_file(fname)
+    x = np.array([0, 10, 50.5, 100])
+    y = np.array([0, 20, 70, 100.5])
+    ra, dec = helper.pix2sky_array(x, y)
+    xf, yf = helper.sky2pix_array(ra, dec)
+    assert_almost_equal(xf, x)
+    assert_almost_equal(yf, y)
+    for i in range(len(x)):
+        assert_almost_equal((ra[i], dec[i]), helper.pix2sky([x[i], y[i]]))
+
+    # ellipses, with scalars broadcast against arrays
+    sky = helper.pix2sky_ellipse_array(x, y, 3, 2, np.array([0, 30, 60, 90]))
+    pix = helper.sky2pix_ellipse_array(sky[0], sky[1], sky[2], sky[3], sky[4])
+    for i in range(len(x)):
+        assert_almost_equal([v[i] for v in sky], helper.pix2sky_ellipse([x[i], y[i]], 3, 2, [0, 30, 60, 90][i]))
+        assert_almost_equal([v[i] for v in pix],
+                            helper.sky2pix_ellipse([sky[0][i], sky[1][i]], sky[2][i], sky[3][i], sky[4][i]))
+
+    # empty inputs give empty outputs
+    ra, dec = helper.pix2sky_array([], [])
+    if not (len(ra) == 0 and len(dec) == 0): raise AssertionError()
+
+
+def test_array_beams():
+    fname = 'tests/test_files/1904-66_SIN.fits'
+    helper = WCSHelper.from_file(fname)
+    helper.lat = -65
+    ra = np.array([285, 290, 300.])
+    dec = np.array([-66, -60, -70.])
+    a, b, pa = helper.get_beam_array(ra, dec)
+    pix_a, pix_b, pix_pa = helper.get_pixbeam_array(ra, dec)
+    for i in range(len(ra)):
+        beam = helper.get_beam(ra[i], dec[i])
+        assert_almost_equal((a[i], b[i], pa[i]), (beam.a, beam.b, beam.pa))
+        beam = helper.get_pixbeam(ra[i], dec[i])
+        assert_almost_equal((pix_a[i], pix_b[i], pix_pa[i]), (beam.a, beam.b, beam.pa))
+    assert_almost_equal(helper.get_beamarea_deg2(ra, dec)[0], helper.get_beamarea_deg2(ra[0], dec[0]))
+
+
 if __name__ == "__main__":
     # introspect and run all the functions starting with 'test'
     for f in dir():